@@ -1,21 +1,166 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, g, has_app_context, has_request_context, Response, current_app
+from flask import before_render_template, template_rendered, stream_template
 from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup, escape
 import sqlite3
 import hashlib
+import gzip
+import mimetypes
 import os
-from datetime import datetime
+import posixpath
+import re
+from datetime import date, datetime, timedelta, timezone
 import secrets
+import itertools
+import json
+import queue
+import threading
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+import heapq
+import math
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Iterator
 
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+bp = Blueprint('main', __name__)
 
-# Database setup
+# Database setup. These are the defaults; create_app() replaces them with the
+# application's DATABASE, DB_*, SHARDS, SHARD_FOLDER, WRITE_QUEUE and ARCHIVE_*
+# settings.
 DATABASE = 'askme.db'
 
-def init_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
+# Connection pool and per-connection tuning
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 10  # seconds to wait for a free connection
+DB_STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'mmap_size': 64 * 1024 * 1024,  # bytes
+    'foreign_keys': 'ON',
+}
+JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'OFF')
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Optional sharding: each project's requests and messages, with their tags,
+# counters, search indexes and archive, live in a database file of their own,
+# so writes to different projects never wait for each other's lock. The main
+# database stays the catalog of projects, user preferences and deletion jobs.
+SHARDS_ENABLED = False
+SHARD_FOLDER = None  # default: <database>-shards beside the database
+SHARD_ID_BITS = 32  # request and message ids are <project id> << SHARD_ID_BITS plus a sequence number
+SHARD_POOL_SIZE = 4  # connections per shard
+SHARD_POOLS_OPEN = 256  # shards a process keeps connections to; the least recently used are closed
+SHARD_FANOUT_WORKERS = 8  # threads querying shards at once for the admin's cross-project views
+SHARD_SUMMARY_DELAY = 0.5  # seconds changed shards are gathered before their summaries go to the catalog
+
+# Optional single-writer queue that group-commits request and message inserts
+WRITE_QUEUE_ENABLED = False
+WRITE_QUEUE_MAX_BATCH = 200  # writes per transaction
+WRITE_QUEUE_MAX_DELAY = 0  # extra seconds to wait for more writes; 0 batches whatever queued up during the last commit
+WRITE_QUEUE_TIMEOUT = 10  # seconds a request waits for its write to commit
+
+# Background project deletion
+DELETION_CHUNK_SIZE = 500  # rows deleted per transaction
+DELETION_CHUNK_PAUSE = 0.01  # seconds between chunks, so that other writers get the lock
+
+# Hot/cold archival: resolved requests move with their messages into a
+# separate database, ATTACHed as `archive` when needed
+ARCHIVE_DATABASE = None  # default: <database>-archive.db beside the database; shards always use that
+ARCHIVE_AFTER_DAYS = 90  # resolved requests without activity for this long are archived
+ARCHIVE_INTERVAL = 0  # seconds between automatic runs in each process; 0 archives only when an admin asks
+ARCHIVE_BATCH_SIZE = 200  # requests moved per transaction
+ARCHIVE_BATCH_PAUSE = 0.01  # seconds between batches
+ARCHIVED_STATUSES = ('completed', 'rejected')
+
+# User preferences served to visitors without a stored row, and their cache
+DEFAULT_USER_PREFERENCES = {'custom_nickname': None, 'language': 'en', 'theme': 'light'}
+PREFERENCES_CACHE_SIZE = 10000  # entries
+PREFERENCES_CACHE_TTL = 300  # seconds
+
+# Rendered public pages, keyed by the data versions they were built from
+PAGE_CACHE_SIZE = 2000  # entries
+PAGE_CACHE_TTL = 600  # seconds
+DATA_VERSION_MAX_AGE = 1  # seconds before re-reading data versions changed by other processes
+
+# Large pages are streamed as they render, and text responses are gzipped
+# for clients that accept it
+STREAM_CHUNK_SIZE = 16 * 1024  # characters of a streamed page sent at a time
+COMPRESS_MIMETYPES = ('text/html', 'text/plain', 'text/css', 'text/javascript', 'application/json',
+                      'application/x-ndjson')
+COMPRESS_MIN_SIZE = 1024  # bytes; smaller bodies are sent as they are
+COMPRESS_LEVEL = 6
+
+# Optional per-route instrumentation, served at /admin/metrics
+METRICS_ENABLED = False
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # request duration, seconds
+SLOW_REQUEST_THRESHOLD = 0  # seconds; requests slower than this log their statements, 0 disables
+
+# Static files, served from /assets under names carrying a hash of their
+# content. Vendored libraries live in static/vendor (fetched by assets.py);
+# until they are there, pages load them from these CDN URLs.
+ASSETS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60  # seconds browsers keep a hashed asset
+ASSET_HASH_LENGTH = 12  # hex digits of SHA-256 in hashed names
+ASSET_COMPRESSED_TYPES = ('.css', '.js', '.map', '.svg', '.ttf', '.json', '.txt')  # others are compressed already
+ASSET_MIN_COMPRESS_SIZE = 256  # bytes
+BOOTSTRAP_CDN = 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist'
+FONT_AWESOME_CDN = 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0'
+VENDOR_ASSETS = {
+    'vendor/bootstrap/css/bootstrap.min.css': f'{BOOTSTRAP_CDN}/css/bootstrap.min.css',
+    'vendor/bootstrap/js/bootstrap.bundle.min.js': f'{BOOTSTRAP_CDN}/js/bootstrap.bundle.min.js',
+    'vendor/fontawesome/css/all.min.css': f'{FONT_AWESOME_CDN}/css/all.min.css',
+    **{f'vendor/fontawesome/webfonts/{font}.{kind}': f'{FONT_AWESOME_CDN}/webfonts/{font}.{kind}'
+       for font in ('fa-brands-400', 'fa-regular-400', 'fa-solid-900', 'fa-v4compatibility')
+       for kind in ('woff2', 'ttf')},
+}
+
+# Per-IP token buckets on user writes (new requests, messages, preferences);
+# admins are not limited. Each process keeps its own buckets.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_BURST = 20  # writes an IP can make in a row
+RATE_LIMIT_RATE = 1  # writes per second added back to the bucket
+RATE_LIMIT_PROJECT_BURST = 0  # writes an IP can make in a row to one project; 0 disables
+RATE_LIMIT_PROJECT_RATE = 0.2  # writes per second to one project
+RATE_LIMIT_MAX_BUCKETS = 100000  # least recently used buckets are evicted beyond this
+DUPLICATE_WINDOW = 10  # seconds an identical request or message from the same IP is ignored; 0 disables
+DUPLICATE_CACHE_SIZE = 100000  # submission hashes remembered
+
+# Admin dashboard page sizes (keyset pagination)
+DASHBOARD_PROJECTS_PER_PAGE = 20
+DASHBOARD_REQUESTS_PER_PROJECT = 20
+INBOX_PER_PAGE = 20
+INBOX_BADGE_LIMIT = 99  # unread conversations counted for the dashboard badge before showing "99+"
+
+# Incremental message API and Server-Sent Events
+MESSAGE_BATCH_SIZE = 200  # most messages returned by one poll
+SSE_POLL_INTERVAL = 15  # seconds between database polls on an idle stream
+
+# Admin full-text search
+SEARCH_RESULTS_PER_PAGE = 20
+SNIPPET_TOKENS = 12  # words of context around a match
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'  # match markers, replaced by <mark> after escaping
+REQUEST_STATUSES = ['pending', 'approved', 'rejected', 'completed']
+
+# Admin bulk operations and the verb shown after each one
+BULK_ACTIONS = {'status': 'Updated', 'tags': 'Retagged', 'block': 'Blocked',
+                'unblock': 'Unblocked', 'delete': 'Deleted'}
+
+# JSON Lines export and import
+EXPORT_FORMAT_VERSION = 1
+IMPORT_CHUNK_SIZE = 1000  # lines per executemany() batch and per transaction
+PROJECT_FIELDS = ('id', 'name', 'description', 'is_locked', 'created_at')
+REQUEST_FIELDS = ('id', 'project_id', 'username', 'user_ip', 'title', 'description', 'status', 'tags',
+                  'is_blocked', 'created_at', 'updated_at')
+MESSAGE_FIELDS = ('id', 'request_id', 'sender_type', 'sender_name', 'message', 'created_at')
+PREFERENCE_FIELDS = ('user_ip', 'custom_nickname', 'language', 'theme', 'created_at', 'updated_at')
+
+def migrate_initial_schema(cursor):
+    """Create the base tables"""
     # Projects table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS projects (
@@ -58,104 +203,2967 @@ def init_db():
         )
     ''')
     
-    # User preferences table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_ip TEXT NOT NULL UNIQUE,
-            custom_nickname TEXT,
-            language TEXT DEFAULT 'en',
-            theme TEXT DEFAULT 'light',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    # User preferences table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_ip TEXT NOT NULL UNIQUE,
+            custom_nickname TEXT,
+            language TEXT DEFAULT 'en',
+            theme TEXT DEFAULT 'light',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migrate_drop_admin_response(cursor):
+    """Drop the legacy requests.admin_response column (replaced by messages)"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(requests)')]
+    if 'admin_response' in columns:
+        cursor.execute('ALTER TABLE requests DROP COLUMN admin_response')
+
+def migrate_add_hot_query_indexes(cursor):
+    """Add the indexes used by the public pages, the chat and the dashboard"""
+    # Visible project list on the home page
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_projects_locked ON projects (is_locked, id)')
+    # A user's own requests in project_detail(), newest first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_requests_project_user 
+        ON requests (project_id, user_ip, is_blocked, created_at)
+    ''')
+    # Per-project request pages on the admin dashboard
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_requests_project_created 
+        ON requests (project_id, created_at, id)
+    ''')
+    # Conversation history of a request, oldest first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_request_created 
+        ON messages (request_id, created_at)
+    ''')
+
+def migrate_add_full_text_search(cursor):
+    """Index request titles, descriptions and messages with FTS5 and backfill them"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts 
+        USING fts5(title, description, content='requests', content_rowid='id')
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts 
+        USING fts5(message, content='messages', content_rowid='id')
+    ''')
+    create_full_text_search_triggers(cursor)
+    
+    # One-time backfill of the rows written before this migration
+    cursor.execute("INSERT INTO requests_fts (requests_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def create_full_text_search_triggers(cursor, schema='main'):
+    """Keep the external-content indexes of a schema in step with its tables"""
+    triggers = [
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.requests_fts_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO requests_fts (rowid, title, description) 
+            VALUES (new.id, new.title, new.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.requests_fts_delete AFTER DELETE ON requests BEGIN
+            INSERT INTO requests_fts (requests_fts, rowid, title, description) 
+            VALUES ('delete', old.id, old.title, old.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.requests_fts_update AFTER UPDATE OF title, description ON requests BEGIN
+            INSERT INTO requests_fts (requests_fts, rowid, title, description) 
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO requests_fts (rowid, title, description) 
+            VALUES (new.id, new.title, new.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        ''',
+    ]
+    for trigger in triggers:
+        cursor.execute(trigger.replace('{schema}', schema))
+
+def migrate_add_request_tags(cursor):
+    """Move the free-text requests.tags column into an indexed request_tags table"""
+    # project_id is copied from the request (it never changes) so that
+    # per-project tag counts can be answered from the index alone
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request_tags (
+            request_id INTEGER NOT NULL,
+            project_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (request_id, tag),
+            FOREIGN KEY (request_id) REFERENCES requests (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_request_tags_project_tag 
+        ON request_tags (project_id, tag, request_id)
+    ''')
+    # Status filters and per-project status counts
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_requests_project_status 
+        ON requests (project_id, status, created_at, id)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS request_tags_delete AFTER DELETE ON requests BEGIN
+            DELETE FROM request_tags WHERE request_id = old.id;
+        END
+    ''')
+    
+    rows = cursor.execute("SELECT id, project_id, tags FROM requests WHERE project_id IS NOT NULL AND tags != ''").fetchall()
+    for request_id, project_id, tags in rows:
+        tag_list = parse_tags(tags)
+        cursor.execute('UPDATE requests SET tags = ? WHERE id = ?', (', '.join(tag_list) or None, request_id))
+        cursor.executemany(
+            'INSERT OR IGNORE INTO request_tags (request_id, project_id, tag) VALUES (?, ?, ?)',
+            [(request_id, project_id, tag) for tag in tag_list])
+
+def migrate_add_data_versions(cursor):
+    """Count changes to the project list and to each project's conversations.
+    
+    Rendered pages are cached under these versions. Triggers bump them, so
+    every code path and every worker process invalidates the cached pages.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            changed_at TIMESTAMP NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    create_data_version_triggers(cursor)
+
+def create_data_version_triggers(cursor):
+    """Bump 'projects' and 'project:<id>' whenever their rows change"""
+    # 'projects' covers the project list, 'project:<id>' one project's requests and messages
+    sources = {
+        'projects': ("'projects'", 'WHERE true'),
+        'requests': ("'project:' || {row}.project_id", 'WHERE {row}.project_id IS NOT NULL'),
+        'messages': ("'project:' || project_id", 'FROM requests WHERE id = {row}.request_id'),
+    }
+    for table, (name, source) in sources.items():
+        for event, row in [('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')]:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS data_versions_{table}_{event.lower()} 
+                AFTER {event} ON {table} BEGIN
+                    INSERT INTO data_versions (name, version, changed_at) 
+                    SELECT {name.format(row=row)}, 1, CURRENT_TIMESTAMP {source.format(row=row)}
+                    ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = CURRENT_TIMESTAMP;
+                END
+            ''')
+
+def migrate_add_request_versions(cursor):
+    """Count changes to each request and its messages under 'request:<id>'.
+    
+    The admin dashboard caches the conversation and edit form of a request
+    under this version.
+    """
+    sources = {
+        'requests': ('{row}.id', 'WHERE true'),
+        'messages': ('{row}.request_id', 'WHERE {row}.request_id IS NOT NULL'),
+    }
+    for table, (request_id, source) in sources.items():
+        for event, row in [('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')]:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS request_versions_{table}_{event.lower()} 
+                AFTER {event} ON {table} BEGIN
+                    INSERT INTO data_versions (name, version, changed_at) 
+                    SELECT 'request:' || {request_id.format(row=row)}, 1, CURRENT_TIMESTAMP {source.format(row=row)}
+                    ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = CURRENT_TIMESTAMP;
+                END
+            ''')
+
+def migrate_add_foreign_key_cascades(cursor):
+    """Rebuild requests, messages and request_tags with ON DELETE CASCADE foreign keys.
+    
+    SQLite cannot change the constraints of a table, so each one is copied
+    into a new table that replaces it. migrate_db() turns foreign key
+    enforcement off meanwhile. Rows whose parent no longer exists are dropped.
+    """
+    sequences = dict(cursor.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('requests', 'messages')"))
+    
+    cursor.execute('''
+        CREATE TABLE requests_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER,
+            username TEXT NOT NULL,
+            user_ip TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            status TEXT DEFAULT 'pending',
+            tags TEXT,
+            is_blocked BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            sender_type TEXT NOT NULL, -- 'user' or 'admin'
+            sender_name TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id) REFERENCES requests (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE request_tags_new (
+            request_id INTEGER NOT NULL,
+            project_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (request_id, tag),
+            FOREIGN KEY (request_id) REFERENCES requests (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('''
+        INSERT INTO requests_new 
+        SELECT id, project_id, username, user_ip, title, description, status, tags, is_blocked, created_at, updated_at 
+        FROM requests 
+        WHERE project_id IS NULL OR project_id IN (SELECT id FROM projects)
+    ''')
+    cursor.execute('''
+        INSERT INTO messages_new 
+        SELECT id, request_id, sender_type, sender_name, message, created_at 
+        FROM messages 
+        WHERE request_id IS NULL OR request_id IN (SELECT id FROM requests_new)
+    ''')
+    cursor.execute('''
+        INSERT INTO request_tags_new 
+        SELECT request_id, project_id, tag FROM request_tags 
+        WHERE request_id IN (SELECT id FROM requests_new)
+    ''')
+    
+    # Dropping a table also drops its indexes and triggers. The cascade
+    # replaces request_tags_delete, which would not survive the renames.
+    cursor.execute('DROP TRIGGER IF EXISTS request_tags_delete')
+    for table in ['request_tags', 'messages', 'requests']:
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    # Keep ids of deleted rows from being handed out again
+    for table, seq in sequences.items():
+        cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (seq, table))
+        cursor.execute('''
+            INSERT INTO sqlite_sequence (name, seq) 
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', (table, seq, table))
+    
+    # The FTS indexes keep their rows: ids did not change
+    migrate_add_hot_query_indexes(cursor)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_request_tags_project_tag 
+        ON request_tags (project_id, tag, request_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_requests_project_status 
+        ON requests (project_id, status, created_at, id)
+    ''')
+    create_full_text_search_triggers(cursor)
+    create_data_version_triggers(cursor)
+    migrate_add_request_versions(cursor)
+    # Rows the FTS index knew about but were dropped as orphans
+    cursor.execute("INSERT INTO requests_fts (requests_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def migrate_add_deletion_jobs(cursor):
+    """Hide projects that are being deleted and track their background deletion"""
+    cursor.execute('ALTER TABLE projects ADD COLUMN is_deleted BOOLEAN DEFAULT 0')
+    # Project pickers list visible projects by name
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_projects_deleted_name ON projects (is_deleted, name)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deletion_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            project_name TEXT NOT NULL,
+            requests_total INTEGER NOT NULL,
+            messages_total INTEGER NOT NULL,
+            requests_deleted INTEGER NOT NULL DEFAULT 0,
+            messages_deleted INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deletion_jobs_finished ON deletion_jobs (finished_at, id)')
+
+def migrate_add_activity_counters(cursor):
+    """Keep per-project status counts and per-request message activity up to date with triggers.
+    
+    The dashboard summary and the admin inbox read these instead of counting
+    requests or reading messages. admin_reads holds each admin's read marker.
+    """
+    for column in ['message_count INTEGER NOT NULL DEFAULT 0', 'last_message_id INTEGER',
+                   'last_message_at TIMESTAMP', 'last_sender_type TEXT', 'last_user_message_id INTEGER']:
+        cursor.execute(f'ALTER TABLE requests ADD COLUMN {column}')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS project_request_counts (
+            project_id INTEGER NOT NULL REFERENCES projects (id) ON DELETE CASCADE,
+            status TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            PRIMARY KEY (project_id, status)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_reads (
+            admin TEXT NOT NULL,
+            request_id INTEGER NOT NULL REFERENCES requests (id) ON DELETE CASCADE,
+            last_read_message_id INTEGER NOT NULL,
+            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (admin, request_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_reads_request ON admin_reads (request_id)')
+    # The inbox: conversations with user messages, most recent activity first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_requests_inbox 
+        ON requests (last_message_at, id, last_user_message_id) WHERE last_user_message_id IS NOT NULL
+    ''')
+    
+    # One-time backfill from the existing rows
+    cursor.execute('''
+        UPDATE requests 
+        SET message_count = totals.messages, last_message_id = totals.last_id, 
+            last_user_message_id = totals.last_user_id
+        FROM (
+            SELECT request_id, COUNT(*) AS messages, MAX(id) AS last_id, 
+                   MAX(CASE WHEN sender_type = 'user' THEN id END) AS last_user_id
+            FROM messages GROUP BY request_id
+        ) AS totals
+        WHERE totals.request_id = requests.id
+    ''')
+    cursor.execute('''
+        UPDATE requests SET last_message_at = m.created_at, last_sender_type = m.sender_type 
+        FROM messages m WHERE m.id = requests.last_message_id
+    ''')
+    cursor.execute('''
+        INSERT INTO project_request_counts (project_id, status, requests) 
+        SELECT project_id, IFNULL(status, 'pending'), COUNT(*) FROM requests 
+        WHERE project_id IN (SELECT id FROM projects) 
+        GROUP BY project_id, IFNULL(status, 'pending')
+    ''')
+    create_activity_triggers(cursor)
+    
+    # Messages already bump the versions of their request and project, so the
+    # counter columns they update do not need to bump them a second time
+    cursor.execute('DROP TRIGGER IF EXISTS data_versions_requests_update')
+    cursor.execute('DROP TRIGGER IF EXISTS request_versions_requests_update')
+    columns = 'project_id, username, user_ip, title, description, status, tags, is_blocked, created_at, updated_at'
+    for name, version, source in [('data_versions_requests_update', "'project:' || new.project_id",
+                                   'WHERE new.project_id IS NOT NULL'),
+                                  ('request_versions_requests_update', "'request:' || new.id", 'WHERE true')]:
+        cursor.execute(f'''
+            CREATE TRIGGER {name} AFTER UPDATE OF {columns} ON requests BEGIN
+                INSERT INTO data_versions (name, version, changed_at) 
+                SELECT {version}, 1, CURRENT_TIMESTAMP {source}
+                ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = CURRENT_TIMESTAMP;
+            END
+        ''')
+
+def create_activity_triggers(cursor):
+    """Maintain project_request_counts and the message counters of requests"""
+    # The newest remaining message of a request, found from idx_messages_request_created
+    latest = '''(SELECT {column} FROM messages WHERE request_id = old.request_id {condition}
+                ORDER BY created_at DESC, id DESC LIMIT 1)'''
+    triggers = [
+        '''
+        CREATE TRIGGER IF NOT EXISTS project_counts_requests_insert AFTER INSERT ON requests 
+        WHEN new.project_id IS NOT NULL BEGIN
+            INSERT INTO project_request_counts (project_id, status, requests) 
+            VALUES (new.project_id, IFNULL(new.status, 'pending'), 1)
+            ON CONFLICT (project_id, status) DO UPDATE SET requests = requests + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS project_counts_requests_delete AFTER DELETE ON requests BEGIN
+            UPDATE project_request_counts SET requests = requests - 1 
+            WHERE project_id = old.project_id AND status = IFNULL(old.status, 'pending');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS project_counts_requests_update AFTER UPDATE OF project_id, status ON requests 
+        WHEN old.project_id IS NOT new.project_id OR old.status IS NOT new.status BEGIN
+            UPDATE project_request_counts SET requests = requests - 1 
+            WHERE project_id = old.project_id AND status = IFNULL(old.status, 'pending');
+            INSERT INTO project_request_counts (project_id, status, requests) 
+            SELECT new.project_id, IFNULL(new.status, 'pending'), 1 WHERE new.project_id IS NOT NULL
+            ON CONFLICT (project_id, status) DO UPDATE SET requests = requests + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS request_counters_messages_insert AFTER INSERT ON messages BEGIN
+            UPDATE requests 
+            SET message_count = message_count + 1, last_message_id = new.id, 
+                last_message_at = new.created_at, last_sender_type = new.sender_type,
+                last_user_message_id = CASE WHEN new.sender_type = 'user' THEN new.id ELSE last_user_message_id END
+            WHERE id = new.request_id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS request_counters_messages_delete AFTER DELETE ON messages BEGIN
+            UPDATE requests SET message_count = message_count - 1 WHERE id = old.request_id;
+            UPDATE requests 
+            SET last_message_id = {latest.format(column='id', condition='')},
+                last_message_at = {latest.format(column='created_at', condition='')},
+                last_sender_type = {latest.format(column='sender_type', condition='')},
+                last_user_message_id = {latest.format(column='id', condition="AND sender_type = 'user'")}
+            WHERE id = old.request_id AND old.id IN (last_message_id, last_user_message_id);
+        END
+        ''',
+    ]
+    for trigger in triggers:
+        cursor.execute(trigger)
+
+def migrate_add_shard_summaries(cursor):
+    """Keep a summary of every shard in the catalog, for views across projects.
+    
+    With sharding, the catalog's project_request_counts mirrors the counts
+    of each shard, shard_unread_counts the number of conversations each
+    admin has not read (admin '' stands for any admin without read markers
+    in the project), and shard_summaries the newest message id. They are
+    refreshed shortly after writes to a shard; see mark_shard_changed().
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_summaries (
+            project_id INTEGER PRIMARY KEY REFERENCES projects (id) ON DELETE CASCADE,
+            last_message_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_unread_counts (
+            project_id INTEGER NOT NULL REFERENCES projects (id) ON DELETE CASCADE,
+            admin TEXT NOT NULL,
+            conversations INTEGER NOT NULL,
+            PRIMARY KEY (project_id, admin)
+        ) WITHOUT ROWID
+    ''')
+
+# Ordered schema migrations. PRAGMA user_version stores how many of them
+# have been applied, so only append to this list and never reorder it.
+MIGRATIONS = [
+    migrate_initial_schema,
+    migrate_drop_admin_response,
+    migrate_add_hot_query_indexes,
+    migrate_add_full_text_search,
+    migrate_add_request_tags,
+    migrate_add_data_versions,
+    migrate_add_request_versions,
+    migrate_add_foreign_key_cascades,
+    migrate_add_deletion_jobs,
+    migrate_add_activity_counters,
+    migrate_add_shard_summaries,
+]
+
+def migrate_db(conn):
+    """Apply pending migrations, each one in its own transaction.
+    
+    Foreign keys are not enforced while migrations run, so that tables can
+    be rebuilt; each migration must leave none dangling. The version is read
+    under the write lock, so processes opening the same new shard at once
+    apply each migration only once.
+    """
+    # Up to date already, as nearly always: no need for the write lock
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+    conn.execute('PRAGMA foreign_keys = OFF')
+    try:
+        while True:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.rollback()
+                    break
+                MIGRATIONS[version](cursor)
+                cursor.execute(f'PRAGMA user_version = {version + 1}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute(f"PRAGMA foreign_keys = {DB_PRAGMAS['foreign_keys']}")
+
+def init_db():
+    """Create the database or bring its schema up to date, with every project's shard when sharding is on"""
+    conn = connect_db()
+    migrate_db(conn)
+    if SHARDS_ENABLED:
+        for project_id in live_project_ids(conn):
+            prepare_shard(conn, project_id)
+    conn.close()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection that times its statements while a request's stats are attached"""
+    
+    stats = None
+    
+    def execute(self, sql, parameters=()):
+        stats = self.stats
+        if stats is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            stats.add_sql(sql, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        stats = self.stats
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            stats.add_sql(sql, time.perf_counter() - started)
+
+def connect_db(database=None):
+    """Open a new tuned connection; prefer get_db() inside a request"""
+    conn = sqlite3.connect(database or DATABASE, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE_SIZE,
+                           factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    for pragma, value in DB_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+class ConnectionPool:
+    """A bounded pool of connections to one database file.
+    
+    At most `size` connections exist at once; acquire() blocks up to `timeout`
+    seconds for one to be released and raises sqlite3.OperationalError after that.
+    """
+    
+    def __init__(self, database, size, timeout):
+        self.database = database
+        self.timeout = timeout
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+    
+    def acquire(self, stats=None):
+        """Take a connection; `stats` counts the waits for a free one"""
+        if not self._slots.acquire(blocking=False):
+            started = time.perf_counter()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            if stats is not None:
+                stats.lock_waits += 1
+                stats.lock_wait_seconds += time.perf_counter() - started
+            if not acquired:
+                raise sqlite3.OperationalError('timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect_db(self.database)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def release(self, conn):
+        try:
+            if self.closed:
+                conn.close()
+                return
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        """Close the idle connections; connections still in use are closed when they are released"""
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the pool for the current DATABASE, replacing it if the path changed"""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None or db_pool.database != DATABASE or db_pool.closed:
+            if db_pool is not None:
+                db_pool.close()
+            db_pool = ConnectionPool(DATABASE, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+        return db_pool
+
+def get_db():
+    """Return the current request's connection, taking one from the pool on first use.
+    
+    The connection is returned to the pool when the request ends, so callers
+    must not close it. Outside an application context a standalone connection
+    is returned and the caller owns it.
+    """
+    if not has_app_context():
+        return connect_db()
+    if 'db' not in g:
+        g.db_pool = get_pool()
+        g.db = borrow_connection(g.db_pool, g.get('request_stats'))
+    return g.db
+
+def borrow_connection(pool, stats=None):
+    """Take a connection from a pool, counting its statements in `stats` if given"""
+    conn = pool.acquire(stats)
+    if stats is not None:
+        conn.stats = stats
+        conn.set_trace_callback(stats.trace)
+    return conn
+
+def return_connection(pool, conn):
+    if conn.stats is not None:
+        conn.stats = None
+        conn.set_trace_callback(None)
+    pool.release(conn)
+
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        return_connection(g.pop('db_pool'), conn)
+    # Shards written to during the request get their summaries refreshed in the catalog
+    for project_id, (pool, conn, changes, admins) in g.pop('shard_dbs', {}).items():
+        if conn.total_changes != changes:
+            mark_shard_changed(project_id, admins)
+        return_connection(pool, conn)
+
+class GroupCommitWriter:
+    """A single background thread that applies queued writes in group commits.
+    
+    Writes submitted within `max_delay` seconds of each other, up to
+    `max_batch` of them, share one transaction and therefore one fsync. Each
+    write runs in its own savepoint, so a failing write only fails its own
+    future. stop() flushes everything queued before it was called.
+    """
+    
+    def __init__(self, database, max_batch, max_delay):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='askme-writer', daemon=True)
+        self._thread.start()
+    
+    def submit(self, write):
+        """Queue write(conn) and return a Future for its return value"""
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('the write queue has been stopped')
+            self._queue.put((write, future))
+        return future
+    
+    def stop(self, timeout=None):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+    
+    def _run(self):
+        conn = connect_db(self.database)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                
+                # Gather everything that arrives within the batching window
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+    
+    def _commit(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for write, future in batch:
+                conn.execute('SAVEPOINT queued_write')
+                try:
+                    outcomes.append((future, write(conn), None))
+                except Exception as error:
+                    conn.execute('ROLLBACK TO queued_write')
+                    outcomes.append((future, None, error))
+                conn.execute('RELEASE queued_write')
+            conn.commit()
+        except Exception as error:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        
+        self.batches += 1
+        self.writes += len(batch)
+        # Only resolve the futures once the batch is durable
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+db_writers = {}  # database path -> GroupCommitWriter; one per shard written to
+db_writer_lock = threading.Lock()
+
+def get_writer(database=None):
+    """Return the group-commit writer of a database (default: DATABASE), starting it if needed"""
+    database = database or DATABASE
+    with db_writer_lock:
+        writer = db_writers.get(database)
+        if writer is None:
+            writer = db_writers[database] = GroupCommitWriter(database, WRITE_QUEUE_MAX_BATCH,
+                                                              WRITE_QUEUE_MAX_DELAY)
+        return writer
+
+@atexit.register
+def stop_writer(database=None):
+    """Flush queued writes and stop the writer threads, or only a database's; also runs at exit"""
+    with db_writer_lock:
+        for path in [database] if database else list(db_writers):
+            writer = db_writers.pop(path, None)
+            if writer is not None:
+                writer.stop()
+
+def run_write(write, project_id=None):
+    """Run write(conn), commit it and return its result.
+    
+    The write goes to the shard of project_id when given, otherwise to the
+    main database. With WRITE_QUEUE_ENABLED it is handed to that database's
+    background writer and group-committed with concurrent writes; otherwise
+    it runs and commits on the request's own connection. The write must not
+    touch request state.
+    """
+    if WRITE_QUEUE_ENABLED:
+        database = DATABASE
+        if SHARDS_ENABLED and project_id is not None:
+            pool = get_shard_pool(project_id)
+            if pool is not None:
+                database = pool.database
+        result = get_writer(database).submit(write).result(timeout=WRITE_QUEUE_TIMEOUT)
+        if database != DATABASE:
+            # The writer's connection is not the request's, whose changes mark the shard when released
+            mark_shard_changed(project_id)
+        return result
+    
+    conn = get_db() if project_id is None else get_shard_db(project_id)
+    result = write(conn)
+    conn.commit()
+    return result
+
+def shard_path(project_id):
+    """The database file that holds a project's requests and messages when sharding is on"""
+    folder = SHARD_FOLDER
+    if not folder:
+        root, _ = os.path.splitext(DATABASE)
+        folder = f'{root}-shards'
+    return os.path.join(folder, f'project-{project_id}.db')
+
+def request_project_id(request_id):
+    """The project whose shard holds a request or message id.
+    
+    Each shard hands out ids from its own range, starting at
+    project_id << SHARD_ID_BITS, so ids stay unique across shards and a
+    route given only a request id knows where to find it.
+    """
+    return request_id >> SHARD_ID_BITS
+
+def live_project_ids(conn):
+    return [row[0] for row in conn.execute('SELECT id FROM projects WHERE is_deleted = 0 ORDER BY id')]
+
+def prepare_shard(catalog, project_id):
+    """Create or migrate a project's shard and refresh its copy of the project row; returns its path.
+    
+    Shards carry the whole schema, and the row of their own project: the
+    foreign keys and the queries that join projects find it there. Returns
+    None when the catalog has no such project, or when it is being deleted
+    and its files are gone. Safe to run in several processes at once; a
+    shard that is up to date is only read.
+    """
+    project = catalog.execute('SELECT * FROM projects WHERE id = ?', (project_id,)).fetchone()
+    path = shard_path(project_id)
+    if project is None or (project['is_deleted'] and not os.path.exists(path)):
+        return None
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = connect_db(path)
+    try:
+        migrate_db(conn)
+        copy_project_row(conn, project)
+    finally:
+        conn.close()
+    with shard_pools_lock:
+        prepared_shards.add(path)
+    return path
+
+def copy_project_row(conn, project):
+    """Write a project's catalog row into its shard, starting the shard's id ranges if they are new"""
+    first_id = project['id'] << SHARD_ID_BITS
+    values = dict(project, first_id=first_id)
+    current = conn.execute('''
+        SELECT (SELECT COUNT(*) FROM projects 
+                WHERE id = :id AND name IS :name AND description IS :description 
+                  AND is_locked IS :is_locked AND is_deleted IS :is_deleted)
+             + (SELECT COUNT(*) FROM sqlite_sequence WHERE name IN ('requests', 'messages') AND seq >= :first_id)
+    ''', values).fetchone()[0]
+    if current == 3:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            INSERT INTO projects (id, name, description, is_locked, is_deleted, created_at)
+            VALUES (:id, :name, :description, :is_locked, :is_deleted, :created_at)
+            ON CONFLICT (id) DO UPDATE
+            SET name = excluded.name, description = excluded.description,
+                is_locked = excluded.is_locked, is_deleted = excluded.is_deleted
+            WHERE name IS NOT excluded.name OR description IS NOT excluded.description
+               OR is_locked IS NOT excluded.is_locked OR is_deleted IS NOT excluded.is_deleted
+        ''', dict(project))
+        # The migrations that rebuild tables leave sequences at 0
+        for table in ('requests', 'messages'):
+            conn.execute('UPDATE sqlite_sequence SET seq = :seq WHERE name = :name AND seq < :seq',
+                         {'name': table, 'seq': first_id})
+            conn.execute('''
+                INSERT INTO sqlite_sequence (name, seq) 
+                SELECT :name, :seq WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)
+            ''', {'name': table, 'seq': first_id})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def refresh_project_copy(catalog, project_id):
+    """After a project's catalog row changed, copy it into the project's shard when sharding is on"""
+    if not SHARDS_ENABLED:
+        return
+    project = catalog.execute('SELECT * FROM projects WHERE id = ?', (project_id,)).fetchone()
+    if project is None:
+        return
+    with borrow_shard(catalog, project_id) as shard:
+        if shard is not catalog:
+            copy_project_row(shard, project)
+
+def write_shard_summary(catalog, shard, project_id, admins=()):
+    """Copy a shard's status counts, unread counts and newest message id into the catalog, without committing.
+    
+    Unread counts are refreshed for the admins the catalog has counts of in
+    the project and for `admins`, each counted up to one past
+    INBOX_BADGE_LIMIT. The caller holds the catalog's write lock, so the
+    shard is read after any write that finished before it: a summary never
+    goes back to an older state.
+    """
+    counts = shard.execute('''
+        SELECT project_id, status, requests FROM project_request_counts WHERE project_id = ?
+    ''', (project_id,)).fetchall()
+    catalog.execute('DELETE FROM project_request_counts WHERE project_id = ?', (project_id,))
+    catalog.executemany('''
+        INSERT INTO project_request_counts (project_id, status, requests) VALUES (?, ?, ?)
+    ''', [tuple(row) for row in counts])
+    
+    names = {row[0] for row in catalog.execute('''
+        SELECT admin FROM shard_unread_counts WHERE project_id = ?
+    ''', (project_id,))}
+    catalog.executemany('''
+        INSERT INTO shard_unread_counts (project_id, admin, conversations) VALUES (?, ?, ?)
+        ON CONFLICT (project_id, admin) DO UPDATE SET conversations = excluded.conversations
+    ''', [(project_id, admin, len(get_inbox(shard, admin, limit=INBOX_BADGE_LIMIT + 1)))
+          for admin in sorted(names | set(admins) | {''})])
+    
+    last_message_id = shard.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    catalog.execute('''
+        INSERT INTO shard_summaries (project_id, last_message_id) VALUES (?, ?)
+        ON CONFLICT (project_id) DO UPDATE SET last_message_id = excluded.last_message_id
+    ''', (project_id, last_message_id))
+
+# Shards written to by this process whose summaries the catalog has yet to
+# get (project id -> admins to count unread conversations for), and the
+# thread writing them
+changed_shards = {}
+summary_worker = None
+summary_worker_lock = threading.Lock()
+
+def mark_shard_changed(project_id, admins=()):
+    """Have a background thread of this process refresh a shard's summary in the catalog.
+    
+    Writes to a shard never wait for the catalog's write lock: the thread
+    gathers the shards changed within SHARD_SUMMARY_DELAY seconds and
+    refreshes their summaries in one catalog transaction.
+    """
+    global summary_worker
+    with summary_worker_lock:
+        changed_shards.setdefault(project_id, set()).update(admins)
+        if summary_worker is None or not summary_worker.is_alive():
+            summary_worker = threading.Thread(target=run_summary_writer, args=(DATABASE,),
+                                              name='askme-summaries', daemon=True)
+            summary_worker.start()
+
+def run_summary_writer(database):
+    """Write the summaries of the changed shards every SHARD_SUMMARY_DELAY seconds, until none are left"""
+    global summary_worker
+    conn = connect_db(database)
+    try:
+        while True:
+            time.sleep(SHARD_SUMMARY_DELAY)
+            with summary_worker_lock:
+                if not changed_shards:
+                    summary_worker = None
+                    return
+            write_changed_summaries(conn)
+    finally:
+        conn.close()
+
+def write_changed_summaries(catalog):
+    """Refresh the summaries of the shards marked changed in one catalog transaction.
+    
+    On failure the shards stay marked, for the next thread to try again.
+    """
+    with summary_worker_lock:
+        changed = dict(changed_shards)
+        changed_shards.clear()
+    try:
+        catalog.execute('BEGIN IMMEDIATE')
+        for project_id, admins in sorted(changed.items()):
+            with borrow_shard(catalog, project_id) as shard:
+                # Projects deleted since have no shard left to summarize
+                if shard is not catalog:
+                    write_shard_summary(catalog, shard, project_id, admins)
+        catalog.commit()
+    except Exception:
+        catalog.rollback()
+        with summary_worker_lock:
+            for project_id, admins in changed.items():
+                changed_shards.setdefault(project_id, set()).update(admins)
+        raise
+
+@atexit.register
+def wait_for_summaries():
+    """Wait until the summaries of the shards this process changed are in the catalog; also runs at exit"""
+    with summary_worker_lock:
+        worker = summary_worker
+    if worker is not None:
+        worker.join()
+
+# Each process's pools of shard connections, least recently used first, and
+# the paths of the shards it has prepared: a pool closed to make room is
+# reopened without preparing its shard again
+shard_pools = OrderedDict()
+prepared_shards = set()
+shard_pools_lock = threading.Lock()
+
+def get_shard_pool(project_id):
+    """The connection pool of a project's shard, preparing the shard on first use in this process.
+    
+    Returns None when prepare_shard() does. A pool whose file has been
+    removed, by a project deletion in any process, is dropped. Beyond
+    SHARD_POOLS_OPEN pools the least recently used one is closed.
+    """
+    path = shard_path(project_id)
+    with shard_pools_lock:
+        pool = shard_pools.get(project_id)
+        if pool is not None:
+            if pool.database == path and not pool.closed and os.path.exists(path):
+                shard_pools.move_to_end(project_id)
+                return pool
+            del shard_pools[project_id]
+            pool.close()
+        prepared = path in prepared_shards
+    
+    if not prepared or not os.path.exists(path):
+        # Outside the lock, so that shards are prepared in parallel
+        catalog = connect_db()
+        try:
+            if prepare_shard(catalog, project_id) is None:
+                return None
+        finally:
+            catalog.close()
+    
+    with shard_pools_lock:
+        pool = shard_pools.get(project_id)
+        if pool is None or pool.database != path or pool.closed:
+            pool = shard_pools[project_id] = ConnectionPool(path, SHARD_POOL_SIZE, DB_POOL_TIMEOUT)
+        shard_pools.move_to_end(project_id)
+        while len(shard_pools) > SHARD_POOLS_OPEN:
+            shard_pools.popitem(last=False)[1].close()
+        return pool
+
+def close_shards(project_id=None):
+    """Close this process's connections to a project's shard, or to every shard, and stop their writers"""
+    with shard_pools_lock:
+        if project_id is None:
+            prepared_shards.clear()
+        else:
+            prepared_shards.discard(shard_path(project_id))
+        project_ids = list(shard_pools) if project_id is None else [project_id]
+        pools = [shard_pools.pop(project_id, None) for project_id in project_ids]
+    for project_id, pool in zip(project_ids, pools):
+        if pool is not None:
+            pool.close()
+            stop_writer(pool.database)
+
+def get_shard_db(project_id):
+    """Return the current request's connection to a project's shard, borrowing one on first use.
+    
+    Without sharding this is get_db(), and so it is for projects the catalog
+    does not know: once sharded, the main database holds no requests, so
+    looking one up there finds nothing. Outside an application context the
+    caller owns the returned connection.
+    """
+    if not SHARDS_ENABLED:
+        return get_db()
+    if not has_app_context():
+        pool = get_shard_pool(project_id)
+        return connect_db(pool.database if pool else None)
+    
+    shard_dbs = g.setdefault('shard_dbs', {})
+    if project_id not in shard_dbs:
+        pool = get_shard_pool(project_id)
+        if pool is None:
+            return get_db()
+        conn = borrow_connection(pool, g.get('request_stats'))
+        # Whoever reads conversations here gets unread counts of their own in the summary
+        admins = (current_admin(),) if has_request_context() and session.get('admin') else ()
+        shard_dbs[project_id] = (pool, conn, conn.total_changes, admins)
+    return shard_dbs[project_id][1]
+
+def get_request_db(request_id):
+    """Return the current request's connection to the shard holding a request id"""
+    return get_shard_db(request_project_id(request_id))
+
+@contextlib.contextmanager
+def borrow_shard(catalog, project_id):
+    """A connection to a project's shard for the duration of a block, for code outside a request.
+    
+    Without sharding, and for projects the catalog does not know, this is
+    the catalog connection itself; otherwise one borrowed from the shard's pool.
+    """
+    pool = get_shard_pool(project_id) if SHARDS_ENABLED else None
+    if pool is None:
+        yield catalog
+        return
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def each_shard(catalog, project_ids=None):
+    """Yield (connection, project ids) for every database holding requests of project_ids (default: all).
+    
+    Without sharding that is the catalog connection once, with project_ids
+    as given; otherwise each project's shard in turn, on a borrowed connection.
+    """
+    if not SHARDS_ENABLED:
+        yield catalog, project_ids
+        return
+    for project_id in live_project_ids(catalog) if project_ids is None else project_ids:
+        with borrow_shard(catalog, project_id) as conn:
+            if conn is not catalog:
+                yield conn, [project_id]
+
+# Threads that query shards in parallel, started on first use: serve.py
+# forks its workers before that
+shard_executor = None
+shard_executor_lock = threading.Lock()
+
+def get_shard_executor():
+    global shard_executor
+    with shard_executor_lock:
+        if shard_executor is None:
+            shard_executor = ThreadPoolExecutor(SHARD_FANOUT_WORKERS, thread_name_prefix='askme-shards')
+        return shard_executor
+
+def map_shards(query, project_ids=None):
+    """Run query(conn, project_ids) for the requests of project_ids (default: every project); returns the results.
+    
+    Without sharding that is a single call on get_db(), with project_ids as
+    given. With sharding it is one call per project, with [project_id], on
+    a connection borrowed from that project's shard; the calls run in
+    parallel on SHARD_FANOUT_WORKERS threads and their results come back in
+    project order. Iterators are read to the end before the connection goes
+    back. As with get_shard_db(), projects the catalog does not know are
+    queried on the catalog, which finds nothing. Only inside a request.
+    """
+    if not SHARDS_ENABLED:
+        return [query(get_db(), project_ids)]
+    if project_ids is None:
+        project_ids = live_project_ids(get_db())
+    stats = g.get('request_stats')
+    
+    def run(project_id, stats):
+        pool = get_shard_pool(project_id) or get_pool()
+        conn = borrow_connection(pool, stats)
+        try:
+            changes = conn.total_changes
+            result = query(conn, [project_id])
+            if isinstance(result, Iterator):
+                result = list(result)
+            if pool.database != DATABASE and conn.total_changes != changes:
+                mark_shard_changed(project_id)
+            return result
+        finally:
+            return_connection(pool, conn)
+    
+    project_ids = list(project_ids)
+    if len(project_ids) == 1:
+        return [run(project_ids[0], stats)]
+    if stats is None:
+        return list(get_shard_executor().map(run, project_ids, itertools.repeat(None)))
+    # Each thread counts into stats of its own, added to the request's here
+    shard_stats = [stats.fork() for _ in project_ids]
+    results = list(get_shard_executor().map(run, project_ids, shard_stats))
+    for own in shard_stats:
+        stats.merge(own)
+    return results
+
+def merge_sorted(results, key, reverse=False, offset=0, limit=None):
+    """Merge lists that are each sorted by key, such as map_shards() results, and slice the merged list"""
+    merged = heapq.merge(*results, key=key, reverse=reverse)
+    return list(itertools.islice(merged, offset, None if limit is None else offset + limit))
+
+def project_schemas(conn):
+    """The schemas holding requests: main, and the archive when there is one"""
+    return ['main', 'archive'] if attach_archive(conn, create=False) else ['main']
+
+def schedule_project_deletion(conn, project_id):
+    """Hide a project at once and queue a job that deletes its rows; returns the job id.
+    
+    Returns None if the project does not exist or is already being deleted.
+    """
+    project = conn.execute('SELECT * FROM projects WHERE id = ? AND is_deleted = 0', (project_id,)).fetchone()
+    if not project:
+        return None
+    
+    # Counted before taking the write lock; only used to show progress
+    requests_total = messages_total = 0
+    with borrow_shard(conn, project_id) as shard:
+        for schema in project_schemas(shard):
+            requests, messages = shard.execute(f'''
+                SELECT COUNT(*), (SELECT COUNT(*) FROM {schema}.requests r JOIN {schema}.messages m ON m.request_id = r.id 
+                                  WHERE r.project_id = :project_id)
+                FROM {schema}.requests WHERE project_id = :project_id
+            ''', {'project_id': project_id}).fetchone()
+            requests_total += requests
+            messages_total += messages
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Renaming frees the name for a new project straight away
+        conn.execute('''
+            UPDATE projects SET is_deleted = 1, name = name || ' [deleted #' || id || ']' WHERE id = ?
+        ''', (project_id,))
+        cursor = conn.execute('''
+            INSERT INTO deletion_jobs (project_id, project_name, requests_total, messages_total) 
+            VALUES (?, ?, ?, ?)
+        ''', (project_id, project['name'], requests_total, messages_total))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # So that the shard's archiver leaves the project alone too
+    refresh_project_copy(conn, project_id)
+    return cursor.lastrowid
+
+def delete_project_chunk(conn, job):
+    """Delete the next chunk of a job's rows in one transaction; False once the project is gone.
+    
+    Messages go first, then the requests (cascading to their tags), so every
+    transaction touches at most DELETION_CHUNK_SIZE rows of either kind.
+    Archived rows of the project follow the hot ones. With sharding the
+    project's files are removed instead, all at once.
+    """
+    if SHARDS_ENABLED:
+        return delete_project_shard(conn, job)
+    schemas = project_schemas(conn)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for schema in schemas:
+            messages = conn.execute(f'''
+                DELETE FROM {schema}.messages WHERE id IN (
+                    SELECT m.id FROM {schema}.requests r JOIN {schema}.messages m ON m.request_id = r.id 
+                    WHERE r.project_id = ? LIMIT ?
+                )
+            ''', (job['project_id'], DELETION_CHUNK_SIZE)).rowcount
+            requests = 0
+            if not messages:
+                requests = conn.execute(f'''
+                    DELETE FROM {schema}.requests WHERE id IN (SELECT id FROM {schema}.requests WHERE project_id = ? LIMIT ?)
+                ''', (job['project_id'], DELETION_CHUNK_SIZE)).rowcount
+            if messages or requests:
+                break
+        finished = not messages and not requests
+        if finished:
+            conn.execute('DELETE FROM projects WHERE id = ?', (job['project_id'],))
+        conn.execute('''
+            UPDATE deletion_jobs 
+            SET messages_deleted = messages_deleted + ?, requests_deleted = requests_deleted + ?,
+                updated_at = CURRENT_TIMESTAMP, 
+                finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+            WHERE id = ?
+        ''', (messages, requests, finished, job['id']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return not finished
+
+def delete_project_shard(conn, job):
+    """Remove a project's shard and its archive, then the project itself; returns False"""
+    close_shards(job['project_id'])
+    path = shard_path(job['project_id'])
+    for database in (path, archive_path(path)):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(database + suffix)
+            except FileNotFoundError:
+                pass
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM projects WHERE id = ?', (job['project_id'],))
+        conn.execute('''
+            UPDATE deletion_jobs 
+            SET messages_deleted = messages_total, requests_deleted = requests_total,
+                updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (job['id'],))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return False
+
+# The process's deletion thread, if one is running, and whether it has
+# been asked to look for jobs again since it last did
+deletion_worker = None
+deletion_requested = False
+deletion_worker_lock = threading.Lock()
+deletion_resumed_pid = None
+
+def run_deletion_jobs(database):
+    """Work through the unfinished deletion jobs, oldest first, until none are left"""
+    global deletion_worker, deletion_requested
+    conn = connect_db(database)
+    try:
+        while True:
+            with deletion_worker_lock:
+                deletion_requested = False
+            jobs = conn.execute('''
+                SELECT * FROM deletion_jobs WHERE finished_at IS NULL ORDER BY id
+            ''').fetchall()
+            for job in jobs:
+                while delete_project_chunk(conn, job):
+                    time.sleep(DELETION_CHUNK_PAUSE)
+            with deletion_worker_lock:
+                if not deletion_requested:
+                    deletion_worker = None
+                    return
+    finally:
+        conn.close()
+
+def start_deletion_worker():
+    """Make sure a background thread of this process is working on the deletion jobs"""
+    global deletion_worker, deletion_requested
+    with deletion_worker_lock:
+        deletion_requested = True
+        if deletion_worker is None or not deletion_worker.is_alive():
+            deletion_worker = threading.Thread(target=run_deletion_jobs, args=(DATABASE,),
+                                               name='askme-deletions', daemon=True)
+            deletion_worker.start()
+        return deletion_worker
+
+def archive_path(database):
+    """The archive database that belongs to a database file"""
+    # Shards each keep their own archive beside them
+    if ARCHIVE_DATABASE and not SHARDS_ENABLED:
+        return ARCHIVE_DATABASE
+    root, extension = os.path.splitext(database)
+    return f'{root}-archive{extension or ".db"}'
+
+def attach_archive(conn, create=True):
+    """Attach the archive database as schema `archive`, creating its tables; True once attached.
+    
+    With create=False a missing archive file is left alone and False is
+    returned. Must be called outside a transaction. Pooled connections keep
+    the archive attached for their next requests.
+    """
+    databases = {row['name']: row['file'] for row in conn.execute('PRAGMA database_list')}
+    if 'archive' in databases:
+        return True
+    path = archive_path(databases['main'])
+    if not create and not os.path.exists(path):
+        return False
+    
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    conn.execute(f"PRAGMA archive.journal_mode = {DB_PRAGMAS['journal_mode']}")
+    conn.execute(f"PRAGMA archive.synchronous = {DB_PRAGMAS['synchronous']}")
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS archive.requests (
+            id INTEGER PRIMARY KEY,
+            project_id INTEGER,
+            username TEXT NOT NULL,
+            user_ip TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            status TEXT,
+            tags TEXT,
+            is_blocked BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.messages (
+            id INTEGER PRIMARY KEY,
+            request_id INTEGER NOT NULL,
+            sender_type TEXT NOT NULL,
+            sender_name TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP
+        )
+    ''')
+    # The archive view's newest-first list, a user's archived requests, a
+    # project's archived requests in export order and a conversation
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_requests_archived ON requests (archived_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_requests_project_user ON requests (project_id, user_ip)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_requests_project_created ON requests (project_id, created_at, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_messages_request_created ON messages (request_id, created_at)
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS archive.requests_fts 
+        USING fts5(title, description, content='requests', content_rowid='id')
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS archive.messages_fts 
+        USING fts5(message, content='messages', content_rowid='id')
+    ''')
+    create_full_text_search_triggers(conn, 'archive')
+    return True
+
+def archive_request_batch(conn, cutoff, after_id):
+    """Move the next batch of resolved requests idle since before `cutoff` into the archive.
+    
+    Requests are scanned in id order from after_id, so a whole run reads the
+    hot table once. Each batch is one transaction: the requests and their
+    messages are copied, then deleted from the hot tables, which cascades to
+    their tags and updates the search indexes and data versions. Returns
+    how many requests were moved and the last of their ids.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM archive_batch')
+        conn.execute(f'''
+            INSERT INTO archive_batch (id) 
+            SELECT id FROM requests r 
+            WHERE id > ? AND status IN ({', '.join('?' * len(ARCHIVED_STATUSES))}) AND updated_at < ? 
+              AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.request_id = r.id AND m.created_at >= ?)
+              AND project_id NOT IN (SELECT id FROM projects WHERE is_deleted = 1)
+            ORDER BY id LIMIT ?
+        ''', (after_id, *ARCHIVED_STATUSES, cutoff, cutoff, ARCHIVE_BATCH_SIZE))
+        moved, last_id = conn.execute('SELECT COUNT(*), MAX(id) FROM archive_batch').fetchone()
+        if moved:
+            batch = 'SELECT id FROM archive_batch'
+            # Rows left behind by a batch whose archive commit outlived its
+            # hot-table commit (WAL commits are atomic per database) are replaced
+            conn.execute(f'DELETE FROM archive.messages WHERE request_id IN ({batch})')
+            conn.execute(f'DELETE FROM archive.requests WHERE id IN ({batch})')
+            conn.execute(f'''
+                INSERT INTO archive.requests ({', '.join(REQUEST_FIELDS)}) 
+                SELECT {', '.join(REQUEST_FIELDS)} FROM requests WHERE id IN ({batch})
+            ''')
+            conn.execute(f'''
+                INSERT INTO archive.messages ({', '.join(MESSAGE_FIELDS)}) 
+                SELECT {', '.join(MESSAGE_FIELDS)} FROM messages WHERE request_id IN ({batch})
+            ''')
+            conn.execute(f'DELETE FROM requests WHERE id IN ({batch})')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moved, last_id
+
+def archive_resolved_requests(conn, older_than_days=None):
+    """Move every resolved request idle for older_than_days (default ARCHIVE_AFTER_DAYS) to the archive.
+    
+    Returns how many requests were moved.
+    """
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    attach_archive(conn)
+    total = 0
+    after_id = 0
+    while True:
+        moved, after_id = archive_request_batch(conn, cutoff, after_id)
+        if not moved:
+            return total
+        total += moved
+        time.sleep(ARCHIVE_BATCH_PAUSE)
+
+def restore_archived_request(conn, request_id, viewer_ip=None):
+    """Move an archived request and its messages back to the hot tables; True if it was restored.
+    
+    Users (viewer_ip) can only restore their own non-blocked requests, and
+    only while the project exists. Ids are kept: AUTOINCREMENT never hands
+    them out again, so they cannot clash with newer rows.
+    """
+    if not attach_archive(conn, create=False):
+        return False
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        req = conn.execute('''
+            SELECT * FROM archive.requests 
+            WHERE id = :id AND (:viewer_ip IS NULL OR (user_ip = :viewer_ip AND is_blocked = 0))
+              AND project_id IN (SELECT id FROM main.projects WHERE is_deleted = 0)
+        ''', {'id': request_id, 'viewer_ip': viewer_ip}).fetchone()
+        if req:
+            conn.execute(f'''
+                INSERT INTO main.requests ({', '.join(REQUEST_FIELDS)}) 
+                SELECT {', '.join(REQUEST_FIELDS)} FROM archive.requests WHERE id = ?
+            ''', (request_id,))
+            conn.execute(f'''
+                INSERT INTO main.messages ({', '.join(MESSAGE_FIELDS)}) 
+                SELECT {', '.join(MESSAGE_FIELDS)} FROM archive.messages WHERE request_id = ? ORDER BY id
+            ''', (request_id,))
+            set_request_tags(conn, request_id, parse_tags(req['tags']))
+            conn.execute('DELETE FROM archive.messages WHERE request_id = ?', (request_id,))
+            conn.execute('DELETE FROM archive.requests WHERE id = ?', (request_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return req is not None
+
+# The process's archiving thread, if one is running, and when it started
+archive_worker = None
+archive_worker_lock = threading.Lock()
+archive_last_started = None
+
+def run_archiver(database, older_than_days):
+    conn = connect_db(database)
+    try:
+        for shard, project_ids in each_shard(conn):
+            if archive_resolved_requests(shard, older_than_days) and SHARDS_ENABLED:
+                mark_shard_changed(project_ids[0])
+    finally:
+        conn.close()
+
+def start_archive_worker():
+    """Make sure a background thread of this process is archiving resolved requests"""
+    global archive_worker, archive_last_started
+    with archive_worker_lock:
+        if archive_worker is None or not archive_worker.is_alive():
+            archive_last_started = time.monotonic()
+            archive_worker = threading.Thread(target=run_archiver, args=(DATABASE, ARCHIVE_AFTER_DAYS),
+                                              name='askme-archiver', daemon=True)
+            archive_worker.start()
+        return archive_worker
+
+def date_bounds(since=None, until=None):
+    """Turn an inclusive range of dates into created_at bounds: lower <= created_at < upper"""
+    lower = since.isoformat() if since else ''
+    upper = (until + timedelta(days=1)).isoformat() if until else '~'
+    return lower, upper
+
+def export_records(conn, project_ids=None, since=None, until=None):
+    """Yield the dataset as records ready for json.dumps(), in the order import_jsonl() expects.
+    
+    A header comes first, then user preferences, then every project followed
+    by its requests, each followed by its messages. Rows are read one at a
+    time from open cursors inside a single read transaction, so the export is
+    a consistent snapshot and memory use does not grow with the dataset.
+    Archived requests follow the hot ones of their project. project_ids
+    and the since/until dates (matched against the request's created_at)
+    narrow it down; filtered exports leave out preferences. With sharding
+    each project's requests are a snapshot of their shard of their own.
+    """
+    lower, upper = date_bounds(since, until)
+    schemas = project_schemas(conn)
+    conn.execute('BEGIN')
+    try:
+        yield {'type': 'askme', 'version': EXPORT_FORMAT_VERSION,
+               'exported_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
+        
+        if project_ids is None and since is None and until is None:
+            for row in conn.execute(f'SELECT {", ".join(PREFERENCE_FIELDS)} FROM user_preferences ORDER BY id'):
+                yield {'type': 'preferences', **dict(row)}
+        
+        clause = ''
+        params = []
+        if project_ids is not None:
+            # One JSON parameter instead of one placeholder per id
+            clause = 'AND id IN (SELECT value FROM json_each(?))'
+            params.append(json.dumps(list(project_ids)))
+        projects = conn.execute(f'''
+            SELECT {", ".join(PROJECT_FIELDS)} FROM projects 
+            WHERE is_deleted = 0 {clause}
+            ORDER BY id
+        ''', params)
+        for project in projects:
+            yield {'type': 'project', **dict(project)}
+            
+            with borrow_shard(conn, project['id']) as shard:
+                shard_schemas = schemas
+                if shard is not conn:
+                    shard_schemas = project_schemas(shard)
+                    shard.execute('BEGIN')
+                for schema in shard_schemas:
+                    # Walks idx_requests_project_created and idx_messages_request_created,
+                    # so rows come out in order without a sort
+                    rows = shard.execute(f'''
+                        SELECT {", ".join('r.' + field for field in REQUEST_FIELDS)}, 
+                               {", ".join(f'm.{field} AS m_{field}' for field in MESSAGE_FIELDS)}
+                        FROM {schema}.requests r LEFT JOIN {schema}.messages m ON m.request_id = r.id
+                        WHERE r.project_id = ? AND r.created_at >= ? AND r.created_at < ?
+                        ORDER BY r.created_at, r.id, m.created_at, m.id
+                    ''', (project['id'], lower, upper))
+                    request_id = None
+                    for row in rows:
+                        if row['id'] != request_id:
+                            request_id = row['id']
+                            yield {'type': 'request', **{field: row[field] for field in REQUEST_FIELDS}}
+                        if row['m_id'] is not None:
+                            yield {'type': 'message', **{field: row['m_' + field] for field in MESSAGE_FIELDS}}
+    finally:
+        conn.rollback()
+
+def export_jsonl(conn, project_ids=None, since=None, until=None):
+    """Yield the export one JSON line at a time"""
+    for record in export_records(conn, project_ids, since, until):
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+def import_jsonl(conn, lines, project_ids=None, since=None, until=None):
+    """Add the records of an export to the database; returns how many rows of each kind were added.
+    
+    lines is any iterable of JSON lines, such as an open file, and is read
+    one line at a time. Rows are buffered and written with executemany(),
+    committing every IMPORT_CHUNK_SIZE lines, so memory use stays flat and
+    other writers get the lock between chunks. A failure keeps the chunks
+    committed before it; a row the schema rejects fails its whole chunk,
+    reported by its line range. Projects and requests get new ids; a project whose
+    name is already taken is merged into that project, and preferences of
+    user IPs that already have some are left alone. Archived requests are
+    imported into the hot tables; the next archiving run moves them back. Messages must follow
+    their request and requests their project, as export_jsonl() writes them.
+    The filters refer to the project ids in the file and to request dates.
+    With sharding, each project is committed to the catalog before its
+    requests and messages go to its shard.
+    """
+    lower, upper = date_bounds(since, until)
+    wanted = set(project_ids) if project_ids is not None else None
+    counts = {'projects': 0, 'requests': 0, 'messages': 0, 'preferences': 0}
+    preference_rows = []
+    request_rows = []
+    tag_rows = []
+    message_rows = []
+    
+    # The connection that takes the current project's requests: the project's shard, if sharded
+    shard = conn
+    shard_pool = shard_project = None
+    
+    def flush(last_line):
+        nonlocal first_line
+        try:
+            write_rows()
+        except sqlite3.IntegrityError as error:
+            raise ValueError(f'lines {first_line}-{last_line}: {error}') from error
+        first_line = last_line + 1
+    
+    def write_rows():
+        counts['preferences'] += conn.executemany('''
+            INSERT INTO user_preferences (user_ip, custom_nickname, language, theme, created_at, updated_at) 
+            VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+            ON CONFLICT (user_ip) DO NOTHING
+        ''', preference_rows).rowcount
+        shard.executemany('''
+            INSERT INTO requests (id, project_id, username, user_ip, title, description, status, tags, 
+                                  is_blocked, created_at, updated_at) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+        ''', request_rows)
+        shard.executemany('INSERT INTO request_tags (request_id, project_id, tag) VALUES (?, ?, ?)', tag_rows)
+        shard.executemany('''
+            INSERT INTO messages (request_id, sender_type, sender_name, message, created_at) 
+            VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', message_rows)
+        for rows in (preference_rows, request_rows, tag_rows, message_rows):
+            rows.clear()
+    
+    def commit():
+        for connection in (conn,) if shard is conn else (conn, shard):
+            connection.commit()
+            connection.execute('BEGIN IMMEDIATE')
+    
+    def next_request_id():
+        # Ids are handed out while holding the write lock, so no other
+        # writer can take them before the chunk commits
+        return shard.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'requests'), 0), 
+                       COALESCE((SELECT MAX(id) FROM requests), 0)) + 1
+        ''').fetchone()[0]
+    
+    def switch_shard(project_id):
+        nonlocal shard, shard_pool, shard_project
+        if shard_pool is None and project_id is None:
+            return
+        # The project's own line is not in the chunk
+        flush(number - 1)
+        commit()
+        if shard_pool is not None:
+            # Committed with the catalog's next chunk
+            write_shard_summary(conn, shard, shard_project)
+            shard_pool.release(shard)
+            shard, shard_pool, shard_project = conn, None, None
+        if project_id is not None:
+            shard_pool = get_shard_pool(project_id)
+            shard, shard_project = shard_pool.acquire(), project_id
+            shard.execute('BEGIN IMMEDIATE')
+    
+    source_project = source_request = None
+    project_id = request_id = None
+    number = 0
+    first_line = 1  # of the rows waiting for flush()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        new_request_id = next_request_id()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record['type']
+                if kind == 'askme':
+                    if record['version'] > EXPORT_FORMAT_VERSION:
+                        raise ValueError(f"export format version {record['version']} is not supported")
+                elif kind == 'preferences':
+                    preference_rows.append(tuple(record.get(field) for field in PREFERENCE_FIELDS))
+                elif kind == 'project':
+                    source_project, source_request = record['id'], None
+                    project_id = request_id = None
+                    if wanted is None or source_project in wanted:
+                        existing = conn.execute('''
+                            SELECT id FROM projects WHERE name = ? AND is_deleted = 0
+                        ''', (record['name'],)).fetchone()
+                        if existing:
+                            project_id = existing['id']
+                        else:
+                            project_id = conn.execute('''
+                                INSERT INTO projects (name, description, is_locked, created_at) 
+                                VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                            ''', (record['name'], record.get('description'), record.get('is_locked') or 0,
+                                  record.get('created_at'))).lastrowid
+                            counts['projects'] += 1
+                    if SHARDS_ENABLED:
+                        switch_shard(project_id)
+                        new_request_id = next_request_id()
+                elif kind == 'request':
+                    if source_project is None or record['project_id'] != source_project:
+                        raise ValueError(f"request {record['id']} does not follow its project")
+                    source_request = record['id']
+                    request_id = None
+                    if project_id is not None and lower <= (record.get('created_at') or '') < upper:
+                        request_id = new_request_id
+                        new_request_id += 1
+                        counts['requests'] += 1
+                        request_rows.append((request_id, project_id, record['username'], record['user_ip'],
+                                             record['title'], record.get('description'),
+                                             record.get('status') or 'pending', record.get('tags'),
+                                             record.get('is_blocked') or 0, record.get('created_at'),
+                                             record.get('updated_at')))
+                        tag_rows.extend((request_id, project_id, tag) for tag in parse_tags(record.get('tags')))
+                elif kind == 'message':
+                    if source_request is None or record['request_id'] != source_request:
+                        raise ValueError(f"message {record['id']} does not follow its request")
+                    if request_id is not None:
+                        counts['messages'] += 1
+                        message_rows.append((request_id, record['sender_type'], record['sender_name'],
+                                             record['message'], record.get('created_at')))
+                else:
+                    raise ValueError(f'unknown record type {kind!r}')
+            except (KeyError, TypeError) as error:
+                raise ValueError(f'line {number}: missing or invalid field {error}') from error
+            except (ValueError, sqlite3.IntegrityError) as error:
+                # Such as a project the schema rejects; rows are checked when their chunk is flushed
+                raise ValueError(f'line {number}: {error}') from error
+            
+            if number % IMPORT_CHUNK_SIZE == 0:
+                flush(number)
+                commit()
+                new_request_id = next_request_id()
+        flush(number)
+        shard.commit()
+        if shard_pool is not None:
+            write_shard_summary(conn, shard, shard_project)
+        conn.commit()
+    except Exception:
+        shard.rollback()
+        conn.rollback()
+        raise
+    finally:
+        if shard_pool is not None:
+            shard_pool.release(shard)
+    
+    if counts['preferences']:
+        preferences_cache.clear()
+    return counts
+
+def get_username_from_ip(ip):
+    """Generate a consistent username from IP address"""
+    hash_object = hashlib.md5(ip.encode())
+    return f"user_{hash_object.hexdigest()[:8]}"
+
+class LRUCache:
+    """Bounded, thread-safe LRU cache whose entries expire after a time-to-live.
+    
+    The TTL bounds how long a worker process can serve an entry that another
+    process has since changed.
+    """
+    
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+    
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+    
+    def add(self, key, value):
+        """Store value unless key holds a live entry; returns whether it was stored"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._set(key, value)
+            return True
+    
+    def _set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+preferences_cache = LRUCache(PREFERENCES_CACHE_SIZE, PREFERENCES_CACHE_TTL)
+
+def get_user_preferences(ip):
+    """Get user preferences, falling back to the defaults for unknown users.
+    
+    Reads never write: a row is only created once the user changes something.
+    """
+    prefs = preferences_cache.get(ip)
+    if prefs is not None:
+        return prefs
+    
+    conn = get_db()
+    row = conn.execute('SELECT * FROM user_preferences WHERE user_ip = ?', (ip,)).fetchone()
+    prefs = dict(row) if row else dict(DEFAULT_USER_PREFERENCES, user_ip=ip)
+    preferences_cache.set(ip, prefs)
+    return prefs
+
+def preferences_key(prefs):
+    """The preference values that change how a page renders"""
+    return (prefs['custom_nickname'], prefs['language'], prefs['theme'])
+
+def get_display_name(ip):
+    """Get user's display name (custom nickname or auto-generated)"""
+    prefs = get_user_preferences(ip)
+    if prefs['custom_nickname']:
+        return prefs['custom_nickname']
+    return get_username_from_ip(ip)
+
+def update_user_preferences(ip, **kwargs):
+    """Update user preferences, creating the row on the first change"""
+    updates = {key: value for key, value in kwargs.items()
+               if key in ['custom_nickname', 'language', 'theme']}
+    if not updates:
+        return
+    
+    columns = ', '.join(updates)
+    placeholders = ', '.join('?' * len(updates))
+    assignments = ', '.join(f"{key} = excluded.{key}" for key in updates)
+    
+    conn = get_db()
+    conn.execute(f'''
+        INSERT INTO user_preferences (user_ip, {columns}) 
+        VALUES (?, {placeholders})
+        ON CONFLICT (user_ip) DO UPDATE SET {assignments}, updated_at = CURRENT_TIMESTAMP
+    ''', [ip, *updates.values()])
+    conn.commit()
+    preferences_cache.invalidate(ip)
+
+class TokenBuckets:
+    """Thread-safe token buckets, one per key, in bounded memory.
+    
+    A bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second; each write takes one. Buckets are kept in least recently used
+    order: ones that have refilled completely are dropped from the front as
+    they are met, since a missing bucket counts as full, and beyond
+    max_entries the least recently used bucket goes regardless. Every call
+    is O(1) amortized.
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # key -> (tokens, updated, full_at)
+        self._lock = threading.Lock()
+    
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; returns 0, or the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            while self._buckets:
+                oldest = next(iter(self._buckets))
+                if self._buckets[oldest][2] > now:
+                    break
+                del self._buckets[oldest]
+            return retry_after
+    
+    def __len__(self):
+        return len(self._buckets)
+    
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+rate_limits = TokenBuckets(RATE_LIMIT_MAX_BUCKETS)
+recent_submissions = LRUCache(DUPLICATE_CACHE_SIZE, DUPLICATE_WINDOW)
+
+def take_write_token(user_ip, project_id=None):
+    """Charge a user write to the IP's bucket, and to its bucket for the project
+    when per-project limits are set; returns 0, or the seconds to wait"""
+    config = current_app.config
+    if not config['RATE_LIMIT'] or session.get('admin'):
+        return 0
+    retry_after = rate_limits.take(user_ip, float(config['RATE_LIMIT_BURST']),
+                                   float(config['RATE_LIMIT_RATE']))
+    if not retry_after and project_id is not None and config['RATE_LIMIT_PROJECT_BURST']:
+        retry_after = rate_limits.take((user_ip, project_id), float(config['RATE_LIMIT_PROJECT_BURST']),
+                                       float(config['RATE_LIMIT_PROJECT_RATE']))
+    return retry_after
+
+def too_many_requests(retry_after):
+    """429 response telling the client when it may write again"""
+    seconds = math.ceil(retry_after)
+    message = f'Too many submissions, please wait {seconds} seconds and try again'
+    if wants_json():
+        response = jsonify(error=message, retry_after=seconds)
+    else:
+        response = Response(message, mimetype='text/plain')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+def claim_submission(*fields):
+    """Remember a submission's content for the duplicate window.
+    
+    Returns (key, True) the first time, or (key, False) when the same content
+    was claimed within the window, e.g. by a double-clicked form. Store the
+    id of what was written under the key with recent_submissions.set(), and
+    release it with recent_submissions.invalidate() if the write fails.
+    """
+    key = hashlib.sha256(json.dumps(fields).encode()).digest()
+    if not recent_submissions.ttl:
+        return key, True
+    return key, recent_submissions.add(key, None)
+
+def parse_tags(text):
+    """Split a comma-separated tag string into unique, lower-case tags, keeping their order"""
+    tags = []
+    for tag in (text or '').split(','):
+        tag = tag.strip().lower()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def set_request_tags(conn, request_id, tags):
+    """Replace the tags of a request in request_tags without committing"""
+    conn.execute('DELETE FROM request_tags WHERE request_id = ?', (request_id,))
+    conn.executemany('''
+        INSERT INTO request_tags (request_id, project_id, tag) 
+        SELECT id, project_id, ? FROM requests WHERE id = ?
+    ''', [(tag, request_id) for tag in tags])
+
+def get_dashboard_requests(conn, project_ids, requests_after=None, tag=None, status=None):
+    """Load the newest requests of several projects in a single query.
+    
+    Yields (project id, requests) in project id order, for the projects that
+    have any, as the rows come off the cursor. Each list holds at most
+    DASHBOARD_REQUESTS_PER_PROJECT + 1 requests, newest first; the extra row
+    tells the caller another page exists. With requests_after only requests
+    older than that request are returned, and tag and status narrow the
+    requests down further.
+    """
+    if not project_ids:
+        return
+    
+    placeholders = ', '.join('?' * len(project_ids))
+    params = list(project_ids)
+    filters = ''
+    if tag is not None:
+        filters += f'''
+            AND id IN (SELECT request_id FROM request_tags WHERE project_id IN ({placeholders}) AND tag = ?)'''
+        params.extend(project_ids)
+        params.append(tag)
+    if status is not None:
+        filters += ' AND status = ?'
+        params.append(status)
+    if requests_after is not None:
+        filters += ' AND (created_at, id) < (SELECT created_at, id FROM requests WHERE id = ?)'
+        params.append(requests_after)
+    params.append(DASHBOARD_REQUESTS_PER_PROJECT + 1)
+    
+    rows = conn.execute(f'''
+        SELECT * FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY project_id ORDER BY created_at DESC, id DESC
+            ) AS page_position
+            FROM requests
+            WHERE project_id IN ({placeholders}) {filters}
+        )
+        WHERE page_position <= ?
+        ORDER BY project_id, page_position
+    ''', params)
+    
+    for project_id, requests in itertools.groupby(rows, key=lambda row: row['project_id']):
+        yield project_id, list(requests)
+
+def get_request_facets(conn, project_ids):
+    """Count requests per status (kept by triggers) and per tag (from an index) for each project.
+    
+    Returns a dict mapping project id to {'statuses': {status: count},
+    'tags': {tag: count}}, tags ordered from most to least used.
+    """
+    facets = {project_id: {'statuses': {}, 'tags': {}} for project_id in project_ids}
+    if not project_ids:
+        return facets
+    
+    placeholders = ', '.join('?' * len(project_ids))
+    for row in conn.execute(f'''
+        SELECT project_id, status, requests FROM project_request_counts 
+        WHERE project_id IN ({placeholders}) AND requests > 0
+    ''', project_ids):
+        facets[row['project_id']]['statuses'][row['status']] = row['requests']
+    
+    for row in conn.execute(f'''
+        SELECT project_id, tag, COUNT(*) AS count FROM request_tags 
+        WHERE project_id IN ({placeholders}) 
+        GROUP BY project_id, tag 
+        ORDER BY project_id, count DESC, tag
+    ''', project_ids):
+        facets[row['project_id']]['tags'][row['tag']] = row['count']
+    return facets
+
+def get_status_totals(conn):
+    """Count the requests of every live project per status, from the counters kept by triggers.
+    
+    With sharding, the catalog's counters are the summaries of the shards.
+    """
+    return conn.execute('''
+        SELECT c.status, SUM(c.requests) AS requests 
+        FROM project_request_counts c JOIN projects p ON p.id = c.project_id 
+        WHERE p.is_deleted = 0 
+        GROUP BY c.status
+    ''').fetchall()
+
+def select_bulk_requests(conn, request_ids=None, project_id=None, status=None, tag=None, user_ip=None):
+    """Collect the targets of a bulk operation into the bulk_requests temp table.
+    
+    Targets are either the given request ids or every request matching the
+    filters. Must run inside the transaction that applies the operation, so
+    that later statements see exactly these rows. Returns their number.
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS bulk_requests (id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM bulk_requests')
+    if request_ids is not None:
+        # One JSON parameter instead of one placeholder per id
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO bulk_requests (id) 
+            SELECT r.id FROM json_each(?) ids JOIN requests r ON r.id = ids.value
+        ''', (json.dumps(request_ids),))
+    else:
+        clauses = []
+        params = []
+        for clause, value in [('project_id = ?', project_id), ('status = ?', status), ('user_ip = ?', user_ip),
+                              ('id IN (SELECT request_id FROM request_tags WHERE tag = ?)', tag)]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        cursor = conn.execute(f'''
+            INSERT INTO bulk_requests (id) 
+            SELECT id FROM requests 
+            WHERE {' AND '.join(clauses) or 'true'}
+        ''', params)
+    return cursor.rowcount
+
+def apply_bulk_action(conn, action, status=None, tags=None):
+    """Apply one admin action to every request in bulk_requests without committing"""
+    targets = 'SELECT id FROM bulk_requests'
+    if action == 'status':
+        conn.execute(f'''
+            UPDATE requests SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id IN ({targets})
+        ''', (status,))
+    elif action == 'tags':
+        conn.execute(f'''
+            UPDATE requests SET tags = ?, updated_at = CURRENT_TIMESTAMP WHERE id IN ({targets})
+        ''', (', '.join(tags) or None,))
+        conn.execute(f'DELETE FROM request_tags WHERE request_id IN ({targets})')
+        conn.execute(f'''
+            INSERT INTO request_tags (request_id, project_id, tag) 
+            SELECT r.id, r.project_id, t.value 
+            FROM requests r, json_each(?) t 
+            WHERE r.id IN ({targets})
+        ''', (json.dumps(tags),))
+    elif action in ('block', 'unblock'):
+        conn.execute(f'''
+            UPDATE requests SET is_blocked = ?, updated_at = CURRENT_TIMESTAMP WHERE id IN ({targets})
+        ''', (1 if action == 'block' else 0,))
+    elif action == 'delete':
+        # Cascades to the requests' messages and tags
+        conn.execute(f'DELETE FROM requests WHERE id IN ({targets})')
+    else:
+        raise ValueError(f'unknown bulk action {action!r}')
+
+def current_admin():
+    """Name of the logged-in admin, which keys their read markers"""
+    return session.get('admin_name', ADMIN_USERNAME)
+
+def mark_request_read(conn, admin, request_id):
+    """Record that an admin has read a request's user messages so far, without committing"""
+    conn.execute('''
+        INSERT INTO admin_reads (admin, request_id, last_read_message_id) 
+        SELECT :admin, id, last_user_message_id FROM requests 
+        WHERE id = :request_id AND last_user_message_id > IFNULL(
+            (SELECT last_read_message_id FROM admin_reads WHERE admin = :admin AND request_id = :request_id), 0)
+        ON CONFLICT (admin, request_id) DO UPDATE 
+        SET last_read_message_id = excluded.last_read_message_id, read_at = CURRENT_TIMESTAMP
+    ''', {'admin': admin, 'request_id': request_id})
+
+def get_inbox(conn, admin, before=None, limit=None):
+    """Conversations with user messages the admin has not read, most recent activity first.
+    
+    Walks idx_requests_inbox backwards and checks each row's read marker, so
+    the messages table is never read. With before, a (last_message_at, id)
+    pair, only conversations with older activity are returned (keyset
+    pagination); limit defaults to one more than a page, to tell whether
+    another follows. CROSS JOIN keeps requests as the outer loop: left to
+    itself the planner starts from the projects and sorts every request they have.
+    """
+    keyset = ''
+    if before is not None:
+        keyset = 'AND (r.last_message_at, r.id) < (:before_at, :before_id)'
+    return conn.execute(f'''
+        SELECT r.*, p.name AS project_name 
+        FROM requests r 
+        CROSS JOIN projects p ON p.id = r.project_id 
+        LEFT JOIN admin_reads a ON a.admin = :admin AND a.request_id = r.id 
+        WHERE r.last_user_message_id IS NOT NULL 
+          AND r.last_user_message_id > IFNULL(a.last_read_message_id, 0) 
+          AND p.is_deleted = 0 {keyset}
+        ORDER BY r.last_message_at DESC, r.id DESC 
+        LIMIT :limit
+    ''', {'admin': admin, 'before_at': before and before[0], 'before_id': before and before[1],
+          'limit': limit or INBOX_PER_PAGE + 1}).fetchall()
+
+def get_unread_count(conn, admin):
+    """How many conversations the admin has not read, counted up to one past INBOX_BADGE_LIMIT.
+    
+    With sharding this adds up the shards' summaries in the catalog, so the
+    dashboard badge opens no shard.
+    """
+    if not SHARDS_ENABLED:
+        return len(get_inbox(conn, admin, limit=INBOX_BADGE_LIMIT + 1))
+    unread = conn.execute('''
+        SELECT COALESCE(SUM(IFNULL(mine.conversations, anyone.conversations)), 0) 
+        FROM shard_unread_counts anyone 
+        JOIN projects p ON p.id = anyone.project_id 
+        LEFT JOIN shard_unread_counts mine ON mine.project_id = anyone.project_id AND mine.admin = :admin 
+        WHERE anyone.admin = '' AND p.is_deleted = 0
+    ''', {'admin': admin}).fetchone()[0]
+    return min(unread, INBOX_BADGE_LIMIT + 1)
+
+def get_admin_inbox(admin, before=None, limit=None):
+    """get_inbox() over every shard, merged by most recent activity. Inside a request only."""
+    limit = limit or INBOX_PER_PAGE + 1
+    results = map_shards(lambda conn, project_ids: get_inbox(conn, admin, before, limit))
+    return merge_sorted(results, key=lambda row: (row['last_message_at'], row['id']), reverse=True, limit=limit)
+
+def get_user_conversations(conn, project_id, user_ip, schema='main'):
+    """Yield a user's requests in a project, newest first, each with its messages.
+    
+    One query walks idx_requests_project_user and, for each request,
+    idx_messages_request_created, in the order the page shows them; rows are
+    grouped as they come off the cursor, so only one conversation is held
+    in memory at a time.
+    """
+    rows = conn.execute(f'''
+        SELECT r.*, m.id AS message_id, m.sender_type, m.sender_name, m.message, 
+               m.created_at AS message_created_at 
+        FROM {schema}.requests r 
+        LEFT JOIN {schema}.messages m ON m.request_id = r.id 
+        WHERE r.project_id = ? AND r.user_ip = ? AND r.is_blocked = 0 
+        ORDER BY r.created_at DESC, r.id DESC, m.created_at, m.id
+    ''', (project_id, user_ip))
+    for _, group in itertools.groupby(rows, key=lambda row: row['id']):
+        group = list(group)
+        messages = [{'id': row['message_id'], 'request_id': row['id'], 'sender_type': row['sender_type'],
+                     'sender_name': row['sender_name'], 'message': row['message'],
+                     'created_at': row['message_created_at']}
+                    for row in group if row['message_id'] is not None]
+        yield {'request': group[0], 'messages': messages, 'archived': schema == 'archive'}
+
+def insert_message(conn, request_id, sender_type, sender_name, message_text):
+    """Add a chat message without committing; returns the new message id"""
+    cursor = conn.execute('''
+        INSERT INTO messages (request_id, sender_type, sender_name, message) 
+        VALUES (?, ?, ?, ?)
+    ''', (request_id, sender_type, sender_name, message_text))
+    return cursor.lastrowid
+
+def get_message_dict(conn, message_id):
+    row = conn.execute('SELECT * FROM messages WHERE id = ?', (message_id,)).fetchone()
+    return dict(row) if row else None
+
+def can_view_request(conn, request_id, viewer_ip=None):
+    """Admins (viewer_ip=None) see every request, users only their own non-blocked ones"""
+    if viewer_ip is None:
+        req = conn.execute('SELECT id FROM requests WHERE id = ?', (request_id,)).fetchone()
+    else:
+        req = conn.execute('SELECT id FROM requests WHERE id = ? AND user_ip = ? AND is_blocked = 0',
+                           (request_id, viewer_ip)).fetchone()
+    return req is not None
+
+def get_new_messages(conn, after, request_id=None, project_id=None, viewer_ip=None):
+    """Messages with an id above `after`, oldest first, visible to the viewer.
+    
+    Narrow the result to one request or one project; with viewer_ip set only
+    that user's non-blocked requests are included.
+    """
+    clauses = ['m.id > ?']
+    params = [after]
+    if request_id is not None:
+        clauses.append('m.request_id = ?')
+        params.append(request_id)
+    if project_id is not None:
+        clauses.append('r.project_id = ?')
+        params.append(project_id)
+    if viewer_ip is not None:
+        clauses.append('r.user_ip = ? AND r.is_blocked = 0')
+        params.append(viewer_ip)
+    params.append(MESSAGE_BATCH_SIZE)
+    
+    return conn.execute(f'''
+        SELECT m.* FROM messages m
+        JOIN requests r ON r.id = m.request_id
+        WHERE {' AND '.join(clauses)}
+        ORDER BY m.id
+        LIMIT ?
+    ''', params).fetchall()
+
+# Wakes up open event streams whenever this process commits a new message.
+# Streams also poll on a timer, which covers messages written by other processes.
+message_posted = threading.Condition()
+message_post_count = 0
+shard_post_counts = {}  # project id -> messages posted to its shard
+
+def notify_message_posted(project_id=None):
+    global message_post_count
+    with message_posted:
+        message_post_count += 1
+        if project_id is not None:
+            shard_post_counts[project_id] = shard_post_counts.get(project_id, 0) + 1
+        message_posted.notify_all()
+
+def poll_every_shard(after):
+    """Return poll(posted) for the admin's event stream over every shard.
+    
+    Each shard has a cursor of its own. They start at each shard's newest
+    message, except in the shard of `after` (a reconnecting browser's last
+    event), which resumes there; shards of projects created later start at
+    the beginning of their id range. After a post in this process only the
+    shards posted to are read. The timer reads the catalog's shard
+    summaries, and then only the shards with messages past their cursor;
+    other processes' posts show up there within SHARD_SUMMARY_DELAY.
+    """
+    catalog_pool = get_pool()
+    seen_counts = None
+    
+    def last_message_ids():
+        conn = catalog_pool.acquire()
+        try:
+            return dict(conn.execute('''
+                SELECT s.project_id, s.last_message_id FROM shard_summaries s 
+                JOIN projects p ON p.id = s.project_id WHERE p.is_deleted = 0
+            ''').fetchall())
+        finally:
+            catalog_pool.release(conn)
+    
+    cursors = last_message_ids()
+    if after:
+        cursors[request_project_id(after)] = after
+    
+    def poll(posted):
+        nonlocal seen_counts
+        with message_posted:
+            changed = None
+            if posted and seen_counts is not None:
+                changed = {project_id for project_id, count in shard_post_counts.items()
+                           if seen_counts.get(project_id) != count}
+            seen_counts = dict(shard_post_counts)
+        
+        if changed is None:
+            changed = {project_id for project_id, last_id in last_message_ids().items()
+                       if last_id > cursors.get(project_id, project_id << SHARD_ID_BITS)}
+        messages = []
+        for project_id in sorted(changed):
+            pool = get_shard_pool(project_id)
+            if pool is None:
+                continue
+            conn = pool.acquire()
+            try:
+                new_messages = get_new_messages(conn, cursors.get(project_id, project_id << SHARD_ID_BITS))
+            finally:
+                pool.release(conn)
+            if new_messages:
+                cursors[project_id] = new_messages[-1]['id']
+                messages.extend(new_messages)
+        return messages
+    
+    return poll
+
+def message_event_stream(request_id=None, project_id=None, viewer_ip=None):
+    """Build a text/event-stream response that pushes new messages as they are posted.
+    
+    The stream starts after the Last-Event-ID header (sent by reconnecting
+    browsers) or ?after=, and only borrows a pooled connection while it polls.
+    With sharding, the admin's stream of every message reads every shard;
+    see poll_every_shard().
+    """
+    after = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    if SHARDS_ENABLED and request_id is None and project_id is None:
+        poll = poll_every_shard(after)
+    else:
+        pool = get_pool()
+        if SHARDS_ENABLED:
+            pool = get_shard_pool(project_id if request_id is None else request_project_id(request_id)) or pool
+        last_id = after
+        
+        def poll(posted):
+            nonlocal last_id
+            conn = pool.acquire()
+            try:
+                messages = get_new_messages(conn, last_id, request_id=request_id,
+                                            project_id=project_id, viewer_ip=viewer_ip)
+            finally:
+                pool.release(conn)
+            if messages:
+                last_id = messages[-1]['id']
+            return messages
+    
+    def generate():
+        seen_posts = -1
+        while True:
+            with message_posted:
+                posted = message_posted.wait_for(lambda: message_post_count != seen_posts,
+                                                 timeout=SSE_POLL_INTERVAL)
+                seen_posts = message_post_count
+            
+            messages = poll(posted)
+            if not messages:
+                # Keeps proxies from timing out and notices closed connections
+                yield ': keepalive\n\n'
+                continue
+            for message in messages:
+                yield f"id: {message['id']}\nevent: message\ndata: {json.dumps(dict(message))}\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def wants_json():
+    """True when the client asked for JSON instead of an HTML redirect"""
+    best = request.accept_mimetypes.best_match(['text/html', 'application/json'])
+    return best == 'application/json'
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix.
+    
+    Words are quoted so that user input can never be parsed as FTS5 syntax.
+    """
+    terms = ['"' + term.replace('"', '""') + '"*' for term in text.split()]
+    return ' '.join(terms)
+
+def search_requests(conn, text, project_id=None, status=None, page=1, schema='main',
+                    per_page=SEARCH_RESULTS_PER_PAGE):
+    """Rank requests whose title, description or messages match `text`.
+    
+    Returns up to per_page + 1 rows for the given page, best match first,
+    each with the project name and a highlighted snippet.
+    schema='archive' searches the attached archive instead.
+    """
+    match_query = build_match_query(text)
+    if not match_query:
+        return []
+    
+    snippet_args = f"'{SNIPPET_START}', '{SNIPPET_END}', '…', {SNIPPET_TOKENS}"
+    # SQLite returns the snippet from the row that produced MIN(score)
+    return conn.execute(f'''
+        WITH hits AS (
+            SELECT rowid AS request_id, bm25(requests_fts, 10.0, 1.0) AS score,
+                   snippet(requests_fts, -1, {snippet_args}) AS snippet
+            FROM {schema}.requests_fts 
+            WHERE requests_fts MATCH :match
+            UNION ALL
+            SELECT m.request_id, bm25(messages_fts) AS score,
+                   snippet(messages_fts, 0, {snippet_args}) AS snippet
+            FROM {schema}.messages_fts 
+            JOIN {schema}.messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :match
+        ),
+        best AS (
+            SELECT request_id, MIN(score) AS score, snippet 
+            FROM hits 
+            GROUP BY request_id
         )
-    ''')
+        SELECT r.*, p.name AS project_name, best.score, best.snippet
+        FROM best
+        JOIN {schema}.requests r ON r.id = best.request_id
+        JOIN main.projects p ON p.id = r.project_id
+        WHERE p.is_deleted = 0
+          AND (:project_id IS NULL OR r.project_id = :project_id)
+          AND (:status IS NULL OR r.status = :status)
+        ORDER BY best.score, r.id DESC
+        LIMIT :limit OFFSET :offset
+    ''', {
+        'match': match_query,
+        'project_id': project_id,
+        'status': status,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    }).fetchall()
+
+def get_archived_requests(conn, project_id=None, status=None, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+    """Up to per_page + 1 archived requests of a page, most recently archived first; [] without an archive"""
+    if not attach_archive(conn, create=False):
+        return []
+    return conn.execute('''
+        SELECT r.*, p.name AS project_name, NULL AS snippet
+        FROM archive.requests r
+        JOIN main.projects p ON p.id = r.project_id
+        WHERE p.is_deleted = 0
+          AND (:project_id IS NULL OR r.project_id = :project_id)
+          AND (:status IS NULL OR r.status = :status)
+        ORDER BY r.archived_at DESC, r.id DESC
+        LIMIT :limit OFFSET :offset
+    ''', {
+        'project_id': project_id,
+        'status': status,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    }).fetchall()
+
+def get_results_page(query, project_id, page, key, reverse=False):
+    """One page of search or archive results, plus a row telling whether another page follows.
     
-    conn.commit()
-    conn.close()
+    query(conn, page, per_page) returns per_page + 1 rows of a page, in key
+    order. A single database, or a project's shard, pages by itself. Across
+    shards each returns its best page * SEARCH_RESULTS_PER_PAGE + 1 rows and
+    the page is cut from their merge. Inside a request only.
+    """
+    if not SHARDS_ENABLED or project_id is not None:
+        conn = get_db() if project_id is None else get_shard_db(project_id)
+        return query(conn, page, SEARCH_RESULTS_PER_PAGE)
+    per_page = SEARCH_RESULTS_PER_PAGE
+    results = map_shards(lambda conn, project_ids: query(conn, 1, page * per_page))
+    return merge_sorted(results, key, reverse, offset=(page - 1) * per_page, limit=per_page + 1)
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def search_rank(row):
+    """The order of search results: best score first, then newest"""
+    return row['score'], -row['id']
 
-def get_username_from_ip(ip):
-    """Generate a consistent username from IP address"""
-    hash_object = hashlib.md5(ip.encode())
-    return f"user_{hash_object.hexdigest()[:8]}"
+def highlight_snippet(snippet):
+    """Escape a search snippet and wrap the matched words in <mark>"""
+    escaped = str(escape(snippet or ''))
+    return Markup(escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>'))
 
-def get_user_preferences(ip):
-    """Get user preferences or create default ones"""
-    conn = get_db()
-    prefs = conn.execute('SELECT * FROM user_preferences WHERE user_ip = ?', (ip,)).fetchone()
+class DataVersions:
+    """Process-local copy of the data_versions table.
     
-    if not prefs:
-        # Create default preferences
-        conn.execute('''
-            INSERT INTO user_preferences (user_ip, language, theme) 
-            VALUES (?, ?, ?)
-        ''', (ip, 'en', 'light'))
-        conn.commit()
-        prefs = conn.execute('SELECT * FROM user_preferences WHERE user_ip = ?', (ip,)).fetchone()
+    A version is re-read from the database at most every `max_age` seconds, so
+    changes made by other worker processes show up within that window.
+    clear() makes this process see its own writes straight away. With
+    sharding, project and request versions are read from their shard.
+    """
     
-    conn.close()
-    return prefs
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def get(self, names):
+        """Return {name: (version, changed_at)}; unknown names are (0, None)"""
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for name in names:
+                entry = self._values.get(name)
+                if entry is not None and entry[0] > now:
+                    result[name] = entry[1]
+        
+        stale = [name for name in names if name not in result]
+        if stale:
+            databases = {}
+            for name in stale:
+                databases.setdefault(data_version_db(name), []).append(name)
+            found = {}
+            for conn, db_names in databases.items():
+                placeholders = ', '.join('?' * len(db_names))
+                rows = conn.execute(f'''
+                    SELECT name, version, changed_at FROM data_versions WHERE name IN ({placeholders})
+                ''', db_names).fetchall()
+                found.update((row['name'], (row['version'], row['changed_at'])) for row in rows)
+            with self._lock:
+                for name in stale:
+                    result[name] = found.get(name, (0, None))
+                    self._values[name] = (now + self.max_age, result[name])
+        return result
+    
+    def clear(self):
+        with self._lock:
+            self._values.clear()
 
-def get_display_name(ip):
-    """Get user's display name (custom nickname or auto-generated)"""
-    prefs = get_user_preferences(ip)
-    if prefs['custom_nickname']:
-        return prefs['custom_nickname']
-    return get_username_from_ip(ip)
+def data_version_db(name):
+    """The connection whose data_versions table counts a version: its shard, or the catalog"""
+    kind, _, key = name.partition(':')
+    if kind == 'project':
+        return get_shard_db(int(key))
+    if kind == 'request':
+        return get_request_db(int(key))
+    return get_db()
 
-def update_user_preferences(ip, **kwargs):
-    """Update user preferences"""
-    conn = get_db()
+data_versions = DataVersions(DATA_VERSION_MAX_AGE)
+page_cache = LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+def parse_timestamp(value):
+    """Parse an SQLite CURRENT_TIMESTAMP value (UTC) into an aware datetime"""
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+def render_cached_page(cache_key, version_names, render, modified_at=None):
+    """Serve a page from the rendered-page cache and answer conditional GETs.
+    
+    cache_key holds everything besides the data versions that the page
+    depends on (viewer, preferences, ...). render() runs on a miss and returns
+    the HTML, as a string or as chunks from render_page(), or a Response such
+    as a redirect that is passed through uncached. Chunks are sent as they
+    come and cached once the whole page has gone out. modified_at is an extra
+    timestamp folded into Last-Modified. Pages with pending flashed messages
+    are never cached.
+    """
+    if session.get('_flashes'):
+        return render()
+    
+    # Pages name assets by their hashes, so a changed asset changes every page
+    versions = data_versions.get(version_names)
+    assets_version = static_assets.manifest(reload=current_app.debug)['version']
+    etag = hashlib.sha1(repr((cache_key, sorted(versions.items()), assets_version)).encode()).hexdigest()
+    timestamps = [changed_at for _, changed_at in versions.values() if changed_at]
+    if modified_at:
+        timestamps.append(modified_at)
+    last_modified = parse_timestamp(max(timestamps)) if timestamps else None
+    
+    if request.if_none_match:
+        # Weak comparison, as compress_response() weakens the tags of gzipped pages
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and last_modified <= request.if_modified_since)
+    
+    if not_modified:
+        response = Response(status=304)
+    else:
+        body = page_cache.get(etag)
+        if body is None:
+            body = render()
+            if isinstance(body, str):
+                page_cache.set(etag, body)
+            elif isinstance(body, Iterator):
+                body = cache_chunks(etag, body)
+            else:
+                return body
+        response = Response(body, mimetype='text/html')
+    
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Pages are per visitor: browsers may keep them but must revalidate
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def cache_chunks(etag, chunks):
+    """Pass a streamed page through, caching it if it was sent in full"""
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+    page_cache.set(etag, ''.join(parts))
+
+def render_page(template_name, **context):
+    """Render a template as chunks of about STREAM_CHUNK_SIZE characters.
+    
+    The first chunk goes out while later parts of the page, and the cursors
+    they read, are still being worked through. Pages with flashed messages
+    are rendered in one piece: the session the flashes are taken from is
+    saved before a streamed body starts. So are pages for a test client
+    that keeps request contexts (`with client:`), which cannot hold the
+    extra context a stream pushes.
+    """
+    if session.get('_flashes') or 'werkzeug.debug.preserve_context' in request.environ:
+        return render_template(template_name, **context)
+    
+    chunks = stream_template(template_name, **context)
+    
+    def buffered():
+        try:
+            buffer = []
+            size = 0
+            for chunk in chunks:
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+            if buffer:
+                yield ''.join(buffer)
+        finally:
+            chunks.close()
+    
+    return buffered()
+
+def gzip_chunks(chunks):
+    """Compress a streamed body, flushing once about STREAM_CHUNK_SIZE bytes have come in.
+    
+    Page chunks are that size already, so each goes out as it is rendered;
+    small ones, like the lines of an export, are compressed together
+    instead of paying for a flush each.
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        pending = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= STREAM_CHUNK_SIZE:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@bp.after_app_request
+def compress_response(response):
+    """Gzip text responses for clients that accept it, streamed ones chunk by chunk"""
+    if (response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers
+            or response.status_code in (204, 206, 304) or request.method == 'HEAD'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    
+    if response.is_streamed:
+        response.response = gzip_chunks(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(body, COMPRESS_LEVEL, mtime=0))
+    response.content_encoding = 'gzip'
+    # The gzipped bytes differ from the plain ones, so the tag is only weak
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+@bp.after_app_request
+def forget_data_versions(response):
+    """Re-read data versions after this process changed something"""
+    if request.method not in ('GET', 'HEAD'):
+        data_versions.clear()
+    return response
+
+@bp.before_app_request
+def resume_deletion_jobs():
+    """Pick up deletion jobs left unfinished by a previous run, once per process"""
+    global deletion_resumed_pid
+    if deletion_resumed_pid == os.getpid():
+        return
+    deletion_resumed_pid = os.getpid()
+    if get_db().execute('SELECT 1 FROM deletion_jobs WHERE finished_at IS NULL LIMIT 1').fetchone():
+        start_deletion_worker()
+
+@bp.before_app_request
+def schedule_archiving():
+    """Start an archiving run every ARCHIVE_INTERVAL seconds, if set"""
+    if ARCHIVE_INTERVAL and (archive_last_started is None
+                             or time.monotonic() - archive_last_started >= ARCHIVE_INTERVAL):
+        start_archive_worker()
+
+class RequestStats:
+    """Where the time of one request went: SQL, templates and waits for a connection"""
+    
+    def __init__(self, log_statements=False):
+        self.started = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_started = None
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.statements = [] if log_statements else None
+    
+    def trace(self, statement):
+        """sqlite3 trace callback; also sees the statements run by triggers"""
+        self.sql_statements += 1
+    
+    def add_sql(self, sql, seconds):
+        self.sql_seconds += seconds
+        if self.statements is not None:
+            self.statements.append((seconds, ' '.join(sql.split())))
+    
+    def fork(self):
+        """Empty stats for work done in another thread, to merge() back once it is done"""
+        return RequestStats(log_statements=self.statements is not None)
     
-    # Ensure user preferences exist
-    get_user_preferences(ip)
+    def merge(self, other):
+        self.sql_statements += other.sql_statements
+        self.sql_seconds += other.sql_seconds
+        self.lock_waits += other.lock_waits
+        self.lock_wait_seconds += other.lock_wait_seconds
+        if self.statements is not None:
+            self.statements.extend(other.statements)
+
+class Metrics:
+    """Per-route request duration histograms and totals, exported in Prometheus text format"""
+    
+    COUNTERS = [
+        ('sql_statements', 'askme_sql_statements_total', 'SQL statements executed, including trigger statements'),
+        ('sql_seconds', 'askme_sql_seconds_total', 'Time spent executing SQL statements'),
+        ('template_seconds', 'askme_template_render_seconds_total', 'Time spent rendering templates'),
+        ('lock_waits', 'askme_db_lock_waits_total', 'Times a request waited for a pooled connection'),
+        ('lock_wait_seconds', 'askme_db_lock_wait_seconds_total', 'Time spent waiting for a pooled connection'),
+    ]
     
-    updates = []
-    values = []
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._routes = {}
+        self._lock = threading.Lock()
     
-    for key, value in kwargs.items():
-        if key in ['custom_nickname', 'language', 'theme']:
-            updates.append(f"{key} = ?")
-            values.append(value)
+    def observe(self, route, method, duration, stats):
+        with self._lock:
+            totals = self._routes.get((route, method))
+            if totals is None:
+                totals = self._routes[(route, method)] = {
+                    'buckets': [0] * len(self.buckets), 'count': 0, 'seconds': 0.0,
+                    **{name: 0 for name, _, _ in self.COUNTERS}}
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    totals['buckets'][i] += 1
+            totals['count'] += 1
+            totals['seconds'] += duration
+            for name, _, _ in self.COUNTERS:
+                totals[name] += getattr(stats, name)
     
-    if updates:
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        values.append(ip)
+    def render(self):
+        with self._lock:
+            routes = sorted((key, dict(totals, buckets=list(totals['buckets'])))
+                            for key, totals in self._routes.items())
         
-        query = f"UPDATE user_preferences SET {', '.join(updates)} WHERE user_ip = ?"
-        conn.execute(query, values)
-        conn.commit()
+        lines = ['# HELP askme_request_duration_seconds Time to build a response',
+                 '# TYPE askme_request_duration_seconds histogram']
+        for (route, method), totals in routes:
+            labels = f'route="{route}",method="{method}"'
+            for bound, count in zip(self.buckets, totals['buckets']):
+                lines.append(f'askme_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'askme_request_duration_seconds_bucket{{{labels},le="+Inf"}} {totals["count"]}')
+            lines.append(f'askme_request_duration_seconds_sum{{{labels}}} {totals["seconds"]}')
+            lines.append(f'askme_request_duration_seconds_count{{{labels}}} {totals["count"]}')
+        for name, metric, help_text in self.COUNTERS:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for (route, method), totals in routes:
+                lines.append(f'{metric}{{route="{route}",method="{method}"}} {totals[name]}')
+        return '\n'.join(lines) + '\n'
     
-    conn.close()
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+metrics = Metrics(METRICS_BUCKETS)
+
+# Request hooks and template signal receivers; create_app() only installs
+# them when METRICS is enabled, so they cost nothing otherwise
+def start_request_stats():
+    g.request_stats = RequestStats(log_statements=bool(current_app.config['SLOW_REQUEST_THRESHOLD']))
+
+def start_template_timer(sender, template, context, **extra):
+    stats = g.get('request_stats')
+    if stats is not None:
+        stats.template_started = time.perf_counter()
+
+def stop_template_timer(sender, template, context, **extra):
+    stats = g.get('request_stats')
+    if stats is not None and stats.template_started is not None:
+        stats.template_seconds += time.perf_counter() - stats.template_started
+        stats.template_started = None
+
+def record_request_stats(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    
+    config = current_app.config
+    args = (stats, request.endpoint or 'unmatched', request.method, request.full_path,
+            config['SLOW_REQUEST_THRESHOLD'], current_app.logger)
+    # A streamed page renders, and runs its queries, after this hook, so it
+    # is recorded once the body is sent. Event streams stay open for minutes
+    # and are recorded when they start.
+    if response.is_streamed and response.mimetype != 'text/event-stream':
+        response.call_on_close(lambda: observe_request(*args))
+    else:
+        observe_request(*args)
+    return response
+
+def observe_request(stats, route, method, path, threshold, logger):
+    duration = time.perf_counter() - stats.started
+    metrics.observe(route, method, duration, stats)
+    
+    if threshold and duration >= threshold:
+        statements = '\n'.join(f'  {seconds * 1000:8.2f} ms  {sql}' for seconds, sql in stats.statements)
+        logger.warning(
+            'Slow request: %s %s took %.1f ms (%d statements, %.1f ms SQL, %.1f ms templates, %d lock waits)\n%s',
+            method, path, duration * 1000, stats.sql_statements,
+            stats.sql_seconds * 1000, stats.template_seconds * 1000, stats.lock_waits, statements)
 
-# Admin credentials (hardcoded)
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"  # Change this in production
 
-@app.context_processor
+class StaticAssets:
+    """Content-hashed names and gzip copies of the files under a folder.
+    
+    The folder is read once, on first use: css/style.css is served as
+    css/style.<hash>.css, and files that compress are also kept gzipped in
+    memory. Relative url() references in stylesheets are rewritten to the
+    hashed names, so fonts and images are cached as long as the stylesheet.
+    With reload=True the folder is read again when any file has changed.
+    """
+    
+    CSS_URL = re.compile(rb'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self._manifest = None
+        self._lock = threading.Lock()
+    
+    def manifest(self, reload=False):
+        """{'files': {path: asset}, 'hashed': {hashed path: asset}, 'version': digest}"""
+        with self._lock:
+            if self._manifest is None or (reload and self._manifest['stamp'] != self._stamp()):
+                self._manifest = self._load()
+            return self._manifest
+    
+    def get(self, path, reload=False):
+        return self.manifest(reload)['files'].get(path)
+    
+    def _stamp(self):
+        stamp = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                info = os.stat(os.path.join(root, name))
+                stamp.append((root, name, info.st_mtime_ns, info.st_size))
+        return sorted(stamp)
+    
+    def _load(self):
+        stamp = self._stamp()
+        bodies = {}
+        for root, name, _, _ in stamp:
+            path = os.path.relpath(os.path.join(root, name), self.folder).replace(os.sep, '/')
+            with open(os.path.join(root, name), 'rb') as f:
+                bodies[path] = f.read()
+        
+        # Stylesheets last, so that the files they refer to have their names
+        files = {}
+        for path in sorted(bodies, key=lambda path: path.endswith('.css')):
+            body = bodies[path]
+            if path.endswith('.css'):
+                body = self.CSS_URL.sub(lambda match: self._hashed_reference(match, path, files), body)
+            files[path] = self._asset(path, body)
+        
+        version = hashlib.sha256(''.join(sorted(asset['url_path'] for asset in files.values())).encode())
+        return {'files': files, 'hashed': {asset['url_path']: asset for asset in files.values()},
+                'version': version.hexdigest(), 'stamp': stamp}
+    
+    def _hashed_reference(self, match, path, files):
+        reference = match.group(2).decode()
+        target, suffix = re.match(r'([^?#]*)(.*)', reference).groups()
+        if not target or ':' in target or target.startswith('/'):
+            return match.group(0)
+        directory = posixpath.dirname(path)
+        asset = files.get(posixpath.normpath(posixpath.join(directory, target)))
+        if asset is None:
+            return match.group(0)
+        hashed = posixpath.relpath(asset['url_path'], directory or '.')
+        return f'url({hashed}{suffix})'.encode()
+    
+    def _asset(self, path, body):
+        digest = hashlib.sha256(body).hexdigest()
+        stem, extension = posixpath.splitext(path)
+        compressed = None
+        if extension in ASSET_COMPRESSED_TYPES and len(body) >= ASSET_MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(body, 9, mtime=0)
+            if len(compressed) >= len(body):
+                compressed = None
+        return {
+            'url_path': f'{stem}.{digest[:ASSET_HASH_LENGTH]}{extension}',
+            'body': body,
+            'gzip': compressed,
+            'etag': digest[:32],
+            'mimetype': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        }
+
+static_assets = StaticAssets(ASSETS_FOLDER)
+
+def asset_url(path):
+    """URL of a file under static/ by its hashed name; vendored files not
+    fetched yet are loaded from their CDN"""
+    asset = static_assets.get(path, reload=current_app.debug)
+    if asset is None and path in VENDOR_ASSETS:
+        return VENDOR_ASSETS[path]
+    return url_for('main.asset', filename=asset['url_path'] if asset else path)
+
+@bp.app_context_processor
 def utility_processor():
-    return dict(get_username_from_ip=get_username_from_ip)
+    return dict(get_username_from_ip=get_username_from_ip, asset_url=asset_url)
 
-@app.route('/')
+@bp.route('/')
 def index():
     user_ip = request.remote_addr
     user_prefs = get_user_preferences(user_ip)
     
-    conn = get_db()
-    projects = conn.execute('SELECT * FROM projects WHERE is_locked = 0').fetchall()
-    conn.close()
+    def render():
+        conn = get_db()
+        projects = conn.execute('SELECT * FROM projects WHERE is_locked = 0 AND is_deleted = 0').fetchall()
+        
+        return render_template('index.html', projects=projects, user_prefs=user_prefs)
     
-    return render_template('index.html', projects=projects, user_prefs=user_prefs)
+    cache_key = ('index', user_ip, bool(session.get('admin')), preferences_key(user_prefs))
+    return render_cached_page(cache_key, ['projects'], render, user_prefs.get('updated_at'))
 
-@app.route('/preferences', methods=['POST'])
+@bp.route('/preferences', methods=['POST'])
 def update_preferences():
     user_ip = request.remote_addr
     
+    retry_after = take_write_token(user_ip)
+    if retry_after:
+        return too_many_requests(retry_after)
+    
     # For admin users, use 'admin' as identifier
     if session.get('admin'):
         user_ip = 'admin'
@@ -172,9 +3180,39 @@ def update_preferences():
                           theme=theme)
     
     flash('Preferences updated successfully!')
-    return redirect(request.referrer or url_for('index'))
+    return redirect(request.referrer or url_for('main.index'))
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    """A static file. Hashed names never change content, so browsers keep
+    them for a year; plain names must be revalidated."""
+    manifest = static_assets.manifest(reload=current_app.debug)
+    entry = manifest['hashed'].get(filename)
+    immutable = entry is not None
+    if entry is None:
+        entry = manifest['files'].get(filename)
+    if entry is None:
+        return Response('Not found', status=404, mimetype='text/plain')
+    
+    response = Response(mimetype=entry['mimetype'])
+    response.vary.add('Accept-Encoding')
+    if entry['gzip'] and request.accept_encodings['gzip']:
+        response.set_data(entry['gzip'])
+        response.content_encoding = 'gzip'
+        response.set_etag(entry['etag'] + '-gzip')
+    else:
+        response.set_data(entry['body'])
+        response.set_etag(entry['etag'])
+    
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-@app.route('/admin/login', methods=['GET', 'POST'])
+@bp.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     # Get admin preferences
     user_prefs = get_user_preferences('admin')
@@ -185,64 +3223,363 @@ def admin_login():
         
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
             session['admin'] = True
-            return redirect(url_for('admin_dashboard'))
+            session['admin_name'] = username
+            return redirect(url_for('main.admin_dashboard'))
         else:
             flash('Invalid credentials')
     
     return render_template('admin_login.html', user_prefs=user_prefs)
 
-@app.route('/admin/logout')
+@bp.route('/admin/logout')
 def admin_logout():
     session.pop('admin', None)
-    return redirect(url_for('index'))
+    session.pop('admin_name', None)
+    return redirect(url_for('main.index'))
 
-@app.route('/admin')
+@bp.route('/admin')
 def admin_dashboard():
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     # Get admin preferences (using 'admin' as IP)
     user_prefs = get_user_preferences('admin')
     
+    # Keyset cursors: ?after=<project_id> pages through projects, while
+    # ?project=<id>&requests_after=<request_id> pages through one project's requests
+    after = request.args.get('after', 0, type=int)
+    only_project = request.args.get('project', type=int)
+    requests_after = request.args.get('requests_after', type=int)
+    tag = request.args.get('tag', '').strip().lower() or None
+    status = request.args.get('status') or None
+    
     conn = get_db()
-    projects = conn.execute('SELECT * FROM projects').fetchall()
-    
-    # Group requests by project with their messages
-    projects_with_requests = []
-    for project in projects:
-        requests = conn.execute('''
-            SELECT * FROM requests 
-            WHERE project_id = ? 
-            ORDER BY created_at DESC
-        ''', (project['id'],)).fetchall()
-        
-        requests_with_messages = []
-        for req in requests:
-            messages = conn.execute('''
-                SELECT * FROM messages 
-                WHERE request_id = ? 
-                ORDER BY created_at ASC
-            ''', (req['id'],)).fetchall()
-            requests_with_messages.append({
-                'request': req,
-                'messages': messages
-            })
+    if only_project is not None:
+        projects = conn.execute('SELECT * FROM projects WHERE id = ? AND is_deleted = 0', (only_project,)).fetchall()
+    else:
+        projects = conn.execute('''
+            SELECT * FROM projects
+            WHERE id > ? AND is_deleted = 0
+            ORDER BY id
+            LIMIT ?
+        ''', (after, DASHBOARD_PROJECTS_PER_PAGE + 1)).fetchall()
+    
+    next_after = None
+    if len(projects) > DASHBOARD_PROJECTS_PER_PAGE:
+        projects = projects[:DASHBOARD_PROJECTS_PER_PAGE]
+        next_after = projects[-1]['id']
+    
+    project_ids = [p['id'] for p in projects]
+    facets = {}
+    for shard_facets in map_shards(get_request_facets, project_ids):
+        facets.update(shard_facets)
+    deletion_jobs = conn.execute('''
+        SELECT * FROM deletion_jobs WHERE finished_at IS NULL ORDER BY id
+    ''').fetchall()
+    status_totals = {row['status']: row['requests'] for row in get_status_totals(conn)}
+    unread_count = get_unread_count(conn, current_admin())
+    # The live message stream starts here, as no messages are on the page yet.
+    # The catalog of a sharded database has none: its stream starts at the
+    # newest message of every shard.
+    last_message_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    
+    # Match each project with its requests while the page streams; both come
+    # in project id order. Conversations and edit forms are not rendered
+    # here: the page fetches them from the fragment routes when they are opened.
+    def projects_with_requests():
+        groups = itertools.chain.from_iterable(map_shards(
+            lambda conn, project_ids: get_dashboard_requests(conn, project_ids, requests_after, tag, status),
+            project_ids))
+        group_id, group = next(groups, (None, []))
+        for project in projects:
+            requests = []
+            if group_id == project['id']:
+                requests = group
+                group_id, group = next(groups, (None, []))
+            requests_next_after = None
+            if len(requests) > DASHBOARD_REQUESTS_PER_PROJECT:
+                requests = requests[:DASHBOARD_REQUESTS_PER_PROJECT]
+                requests_next_after = requests[-1]['id']
+            
+            yield {
+                'project': project,
+                'requests': requests,
+                'requests_next_after': requests_next_after,
+                'facets': facets[project['id']]
+            }
+    
+    return render_page('admin_dashboard.html',
+                         projects=projects,
+                         projects_with_requests=projects_with_requests(),
+                         next_after=next_after,
+                         only_project=only_project,
+                         last_message_id=last_message_id,
+                         deletion_jobs=deletion_jobs,
+                         status_totals=status_totals,
+                         unread_count=unread_count, inbox_badge_limit=INBOX_BADGE_LIMIT,
+                         tag=tag, status=status,
+                         statuses=REQUEST_STATUSES,
+                         user_prefs=user_prefs)
+
+def render_request_fragment(request_id, template):
+    """Render a dashboard fragment of one request, cached under its data version"""
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
+    
+    def render():
+        conn = get_request_db(request_id)
+        req = conn.execute('SELECT * FROM requests WHERE id = ?', (request_id,)).fetchone()
+        if not req:
+            return jsonify(error='Request not found'), 404
         
-        projects_with_requests.append({
-            'project': project,
-            'requests_with_messages': requests_with_messages
-        })
+        messages = conn.execute('''
+            SELECT * FROM messages 
+            WHERE request_id = ? 
+            ORDER BY created_at ASC, id ASC
+        ''', (request_id,)).fetchall()
+        return render_template(template, req=req, messages=messages)
     
-    conn.close()
+    return render_cached_page(('fragment', template, request_id), [f'request:{request_id}'], render)
+
+@bp.route('/admin/request/<int:request_id>/conversation')
+def admin_request_conversation(request_id):
+    """Messages and reply form of a request, loaded when its dashboard card is expanded"""
+    if session.get('admin'):
+        # Opening a conversation reads it; only writes when there is something new
+        conn = get_request_db(request_id)
+        mark_request_read(conn, current_admin(), request_id)
+        conn.commit()
+    return render_request_fragment(request_id, 'request_conversation.html')
+
+@bp.route('/admin/request/<int:request_id>/edit')
+def admin_request_edit(request_id):
+    """Edit modal of a request, loaded when its edit button is clicked"""
+    return render_request_fragment(request_id, 'request_edit_modal.html')
+
+@bp.route('/admin/inbox')
+def admin_inbox():
+    """Conversations with unread user messages, most recent activity first.
+    
+    ?before=<request_id> continues after the last conversation of a page.
+    """
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    user_prefs = get_user_preferences('admin')
+    before = request.args.get('before', type=int)
+    conversations = []
+    if before is None:
+        conversations = get_admin_inbox(current_admin())
+    else:
+        cursor = get_request_db(before).execute('''
+            SELECT last_message_at, id FROM requests WHERE id = ?
+        ''', (before,)).fetchone()
+        if cursor:
+            conversations = get_admin_inbox(current_admin(), tuple(cursor))
     
-    return render_template('admin_dashboard.html', 
-                         projects_with_requests=projects_with_requests,
+    next_before = None
+    if len(conversations) > INBOX_PER_PAGE:
+        conversations = conversations[:INBOX_PER_PAGE]
+        next_before = conversations[-1]['id']
+    return render_template('admin_inbox.html', conversations=conversations,
+                         before=before, next_before=next_before, user_prefs=user_prefs)
+
+@bp.route('/admin/inbox/<int:request_id>/read', methods=['POST'])
+def mark_read(request_id):
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    conn = get_request_db(request_id)
+    mark_request_read(conn, current_admin(), request_id)
+    conn.commit()
+    
+    if wants_json():
+        return jsonify(request_id=request_id)
+    return redirect(request.referrer or url_for('main.admin_inbox'))
+
+@bp.route('/admin/deletions')
+def admin_deletions():
+    """Progress of the most recent project deletions, as JSON"""
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
+    
+    jobs = get_db().execute('SELECT * FROM deletion_jobs ORDER BY id DESC LIMIT 20').fetchall()
+    return jsonify(jobs=[dict(job) for job in jobs])
+
+def dataset_filters(values):
+    """Read the project, since and until filters of an export or import; raises ValueError"""
+    project_ids = [int(part) for value in values.getlist('project') for part in value.split(',') if part.strip()]
+    since, until = (date.fromisoformat(values[name]) if values.get(name) else None for name in ('since', 'until'))
+    return {'project_ids': project_ids or None, 'since': since, 'until': until}
+
+@bp.route('/admin/export')
+def admin_export():
+    """Download the dataset, or the filtered part of it, as JSON Lines.
+    
+    The response is streamed from a connection of its own while it is being
+    written, so its size is not limited by memory.
+    """
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
+    try:
+        filters = dataset_filters(request.args)
+    except ValueError:
+        return jsonify(error='Invalid export filter'), 400
+    
+    def stream():
+        conn = connect_db()
+        try:
+            yield from export_jsonl(conn, **filters)
+        finally:
+            conn.close()
+    
+    filename = f"askme-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.jsonl"
+    return Response(stream(), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@bp.route('/admin/import', methods=['POST'])
+def admin_import():
+    """Add the records of an uploaded JSON Lines export, reading it line by line"""
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    upload = request.files.get('file')
+    try:
+        if not upload:
+            raise ValueError('choose a file to import')
+        counts = import_jsonl(get_db(), upload.stream, **dataset_filters(request.form))
+    except ValueError as error:
+        if wants_json():
+            return jsonify(error=f'Import failed: {error}'), 400
+        flash(f'Import failed: {error}')
+        return redirect(url_for('main.admin_dashboard'))
+    
+    if wants_json():
+        return jsonify(**counts)
+    flash(f"Imported {counts['projects']} project(s), {counts['requests']} request(s) "
+          f"and {counts['messages']} message(s)")
+    return redirect(url_for('main.admin_dashboard'))
+
+@bp.route('/admin/search')
+def admin_search():
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    user_prefs = get_user_preferences('admin')
+    query = request.args.get('q', '').strip()
+    project_id = request.args.get('project', type=int)
+    status = request.args.get('status') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    
+    def search(conn, page, per_page):
+        return search_requests(conn, query, project_id, status, page, per_page=per_page)
+    
+    projects = get_db().execute('SELECT id, name FROM projects WHERE is_deleted = 0 ORDER BY name').fetchall()
+    results = get_results_page(search, project_id, page, key=search_rank) if query else []
+    
+    has_next = len(results) > SEARCH_RESULTS_PER_PAGE
+    return render_template('admin_search.html',
+                         results=results[:SEARCH_RESULTS_PER_PAGE],
+                         query=query, project_id=project_id, status=status,
+                         page=page, has_next=has_next, projects=projects,
+                         statuses=REQUEST_STATUSES,
+                         highlight_snippet=highlight_snippet,
+                         user_prefs=user_prefs)
+
+@bp.route('/admin/archive')
+def admin_archive():
+    """Archived requests, most recently archived first, or those matching a search"""
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    user_prefs = get_user_preferences('admin')
+    query = request.args.get('q', '').strip()
+    project_id = request.args.get('project', type=int)
+    status = request.args.get('status') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    
+    def search(conn, page, per_page):
+        if not attach_archive(conn, create=False):
+            return []
+        return search_requests(conn, query, project_id, status, page, schema='archive', per_page=per_page)
+    
+    def list_archived(conn, page, per_page):
+        return get_archived_requests(conn, project_id, status, page, per_page)
+    
+    projects = get_db().execute('SELECT id, name FROM projects WHERE is_deleted = 0 ORDER BY name').fetchall()
+    if query:
+        results = get_results_page(search, project_id, page, key=search_rank)
+    else:
+        results = get_results_page(list_archived, project_id, page,
+                                   key=lambda row: (row['archived_at'], row['id']), reverse=True)
+    
+    has_next = len(results) > SEARCH_RESULTS_PER_PAGE
+    return render_template('admin_archive.html',
+                         results=results[:SEARCH_RESULTS_PER_PAGE],
+                         query=query, project_id=project_id, status=status,
+                         page=page, has_next=has_next, projects=projects,
+                         statuses=REQUEST_STATUSES, archive_after_days=f'{ARCHIVE_AFTER_DAYS:g}',
+                         highlight_snippet=highlight_snippet,
                          user_prefs=user_prefs)
 
-@app.route('/admin/project/create', methods=['POST'])
+@bp.route('/admin/archive/<int:request_id>/conversation')
+def admin_archived_conversation(request_id):
+    """Messages of an archived request, loaded when its card is expanded"""
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
+    
+    conn = get_request_db(request_id)
+    req = None
+    if attach_archive(conn, create=False):
+        req = conn.execute('SELECT * FROM archive.requests WHERE id = ?', (request_id,)).fetchone()
+    if not req:
+        return jsonify(error='Request not found'), 404
+    
+    messages = conn.execute('''
+        SELECT * FROM archive.messages 
+        WHERE request_id = ? 
+        ORDER BY created_at ASC, id ASC
+    ''', (request_id,)).fetchall()
+    return render_template('archived_conversation.html', req=req, messages=messages)
+
+@bp.route('/admin/archive/<int:request_id>/restore', methods=['POST'])
+def restore_request(request_id):
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    conn = get_request_db(request_id)
+    if not restore_archived_request(conn, request_id):
+        flash('Request not found in the archive')
+        return redirect(url_for('main.admin_archive'))
+    
+    project_id = conn.execute('SELECT project_id FROM requests WHERE id = ?', (request_id,)).fetchone()[0]
+    flash('Request restored from the archive')
+    return redirect(url_for('main.admin_dashboard', project=project_id))
+
+@bp.route('/admin/archive/run', methods=['POST'])
+def run_archiving():
+    """Start archiving resolved requests in the background"""
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    start_archive_worker()
+    flash(f'Archiving completed and rejected requests without activity for {ARCHIVE_AFTER_DAYS:g} days '
+          'in the background.')
+    return redirect(url_for('main.admin_archive'))
+
+@bp.route('/admin/metrics')
+def admin_metrics():
+    """Per-route latency histograms and SQL, template and lock totals for Prometheus"""
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
+    if not current_app.config['METRICS']:
+        return jsonify(error='Metrics are disabled'), 404
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/admin/project/create', methods=['POST'])
 def create_project():
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     name = request.form['name']
     description = request.form['description']
@@ -255,14 +3592,13 @@ def create_project():
         flash('Project created successfully')
     except sqlite3.IntegrityError:
         flash('Project name already exists')
-    conn.close()
     
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
-@app.route('/admin/project/<int:project_id>/toggle_lock', methods=['POST'])
+@bp.route('/admin/project/<int:project_id>/toggle_lock', methods=['POST'])
 def toggle_project_lock(project_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     conn = get_db()
     project = conn.execute('SELECT * FROM projects WHERE id = ?', (project_id,)).fetchone()
@@ -270,14 +3606,14 @@ def toggle_project_lock(project_id):
     
     conn.execute('UPDATE projects SET is_locked = ? WHERE id = ?', (new_status, project_id))
     conn.commit()
-    conn.close()
+    refresh_project_copy(conn, project_id)
     
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
-@app.route('/admin/project/<int:project_id>/edit', methods=['POST'])
+@bp.route('/admin/project/<int:project_id>/edit', methods=['POST'])
 def edit_project(project_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     name = request.form['name']
     description = request.form['description']
@@ -287,180 +3623,422 @@ def edit_project(project_id):
         conn.execute('UPDATE projects SET name = ?, description = ? WHERE id = ?', 
                     (name, description, project_id))
         conn.commit()
+        refresh_project_copy(conn, project_id)
         flash('Project updated successfully')
     except sqlite3.IntegrityError:
         flash('Project name already exists')
-    conn.close()
     
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
-@app.route('/admin/project/<int:project_id>/delete', methods=['POST'])
+@bp.route('/admin/project/<int:project_id>/delete', methods=['POST'])
 def delete_project(project_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
-    conn = get_db()
-    # Delete messages first, then requests, then project
-    conn.execute('DELETE FROM messages WHERE request_id IN (SELECT id FROM requests WHERE project_id = ?)', (project_id,))
-    conn.execute('DELETE FROM requests WHERE project_id = ?', (project_id,))
-    conn.execute('DELETE FROM projects WHERE id = ?', (project_id,))
-    conn.commit()
-    conn.close()
+    # The project disappears now; its requests and messages are deleted in
+    # the background so that the write lock is only held for short chunks
+    if schedule_project_deletion(get_db(), project_id) is not None:
+        start_deletion_worker()
+        flash('Project deleted. Its requests and messages are being removed in the background.')
     
-    flash('Project deleted successfully')
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
-@app.route('/admin/request/<int:request_id>/update', methods=['POST'])
+@bp.route('/admin/request/<int:request_id>/update', methods=['POST'])
 def update_request(request_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     status = request.form.get('status')
-    tags = request.form.get('tags')
+    tags = parse_tags(request.form.get('tags'))
     is_blocked = 1 if request.form.get('is_blocked') else 0
     
-    conn = get_db()
+    conn = get_request_db(request_id)
     conn.execute('''
         UPDATE requests 
         SET status = ?, tags = ?, is_blocked = ?, updated_at = CURRENT_TIMESTAMP
         WHERE id = ?
-    ''', (status, tags, is_blocked, request_id))
+    ''', (status, ', '.join(tags) or None, is_blocked, request_id))
+    set_request_tags(conn, request_id, tags)
     conn.commit()
-    conn.close()
     
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
 
-@app.route('/admin/request/<int:request_id>/delete', methods=['POST'])
+@bp.route('/admin/request/<int:request_id>/delete', methods=['POST'])
 def delete_request(request_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
-    conn = get_db()
-    # Delete messages first, then request
-    conn.execute('DELETE FROM messages WHERE request_id = ?', (request_id,))
+    conn = get_request_db(request_id)
+    # Cascades to the request's messages and tags
     conn.execute('DELETE FROM requests WHERE id = ?', (request_id,))
     conn.commit()
-    conn.close()
     
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
+
+@bp.route('/admin/requests/bulk', methods=['POST'])
+def bulk_update_requests():
+    """Change or delete many requests in one transaction, or one per shard when sharded.
+    
+    scope=selected targets the checked request_id values, scope=filter every
+    request matching project, status, tag and user_ip. Across shards the
+    action is not atomic: a failing shard leaves the others changed.
+    """
+    if not session.get('admin'):
+        return redirect(url_for('main.admin_login'))
+    
+    action = request.form.get('action')
+    new_status = request.form.get('set_status')
+    tags = parse_tags(request.form.get('set_tags'))
+    if action not in BULK_ACTIONS or (action == 'status' and new_status not in REQUEST_STATUSES):
+        flash('Choose a bulk action')
+        return redirect(request.referrer or url_for('main.admin_dashboard'))
+    
+    selection = {}
+    if request.form.get('scope') == 'filter':
+        selection = {
+            'project_id': request.form.get('project', type=int),
+            'status': request.form.get('status') or None,
+            'tag': request.form.get('tag', '').strip().lower() or None,
+            'user_ip': request.form.get('user_ip', '').strip() or None,
+        }
+        if not any(value is not None for value in selection.values()):
+            flash('Set a filter before applying a bulk action to it')
+            return redirect(request.referrer or url_for('main.admin_dashboard'))
+    else:
+        selection['request_ids'] = request.form.getlist('request_id', type=int)
+    
+    # Only the shards that can hold targets
+    project_ids = None
+    if selection.get('project_id') is not None:
+        project_ids = [selection['project_id']]
+    elif 'request_ids' in selection:
+        project_ids = sorted({request_project_id(request_id) for request_id in selection['request_ids']})
+    
+    def apply(conn, project_ids):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count = select_bulk_requests(conn, **selection)
+            apply_bulk_action(conn, action, new_status, tags)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return count
+    
+    count = sum(map_shards(apply, project_ids))
+    
+    if wants_json():
+        return jsonify(action=action, count=count)
+    flash(f'{BULK_ACTIONS[action]} {count} request(s)')
+    return redirect(request.referrer or url_for('main.admin_dashboard'))
 
-@app.route('/request/<int:request_id>/message', methods=['POST'])
+@bp.route('/request/<int:request_id>/message', methods=['POST'])
 def add_message(request_id):
     user_ip = request.remote_addr
     display_name = get_display_name(user_ip)
     message_text = request.form['message']
     
-    # Check if request exists and user has access
-    conn = get_db()
+    # Check if request exists and user has access; replying to an archived
+    # request brings it back, once the reply has passed the limits below
+    conn = get_request_db(request_id)
     req = conn.execute('SELECT * FROM requests WHERE id = ? AND user_ip = ? AND is_blocked = 0', 
                       (request_id, user_ip)).fetchone()
+    archived = False
+    if not req and attach_archive(conn, create=False):
+        req = conn.execute('''
+            SELECT * FROM archive.requests 
+            WHERE id = ? AND user_ip = ? AND is_blocked = 0
+              AND project_id IN (SELECT id FROM main.projects WHERE is_deleted = 0)
+        ''', (request_id, user_ip)).fetchone()
+        archived = req is not None
     
     if not req:
         flash('Request not found or access denied')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
+    
+    # One charge per message, to the IP's bucket and the project's
+    retry_after = take_write_token(user_ip, req['project_id'])
+    if retry_after:
+        return too_many_requests(retry_after)
+    
+    # The same message posted twice in a row is only stored once; the
+    # repeat gets the first one back
+    key, is_new = claim_submission(user_ip, 'message', request_id, message_text)
+    if not is_new:
+        message_id = recent_submissions.get(key)
+        if wants_json():
+            return jsonify(message=get_message_dict(conn, message_id) if message_id else None), 200
+        return redirect(url_for('main.project_detail', project_id=req['project_id']))
+    
+    # Another reply may have restored it meanwhile, or the request been removed
+    if archived and not restore_archived_request(conn, request_id, user_ip) and not conn.execute(
+            'SELECT 1 FROM requests WHERE id = ?', (request_id,)).fetchone():
+        recent_submissions.invalidate(key)
+        flash('Request not found or access denied')
+        return redirect(url_for('main.index'))
     
     # Add message
-    conn.execute('''
-        INSERT INTO messages (request_id, sender_type, sender_name, message) 
-        VALUES (?, ?, ?, ?)
-    ''', (request_id, 'user', display_name, message_text))
-    conn.commit()
-    conn.close()
+    try:
+        message_id = run_write(
+            lambda conn: insert_message(conn, request_id, 'user', display_name, message_text),
+            req['project_id'])
+    except Exception:
+        recent_submissions.invalidate(key)
+        raise
+    recent_submissions.set(key, message_id)
+    notify_message_posted(req['project_id'])
     
-    return redirect(url_for('project_detail', project_id=req['project_id']))
+    if wants_json():
+        return jsonify(message=get_message_dict(conn, message_id)), 201
+    return redirect(url_for('main.project_detail', project_id=req['project_id']))
 
-@app.route('/admin/request/<int:request_id>/message', methods=['POST'])
+@bp.route('/admin/request/<int:request_id>/message', methods=['POST'])
 def admin_add_message(request_id):
     if not session.get('admin'):
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('main.admin_login'))
     
     message_text = request.form['message']
     
-    conn = get_db()
-    conn.execute('''
-        INSERT INTO messages (request_id, sender_type, sender_name, message) 
-        VALUES (?, ?, ?, ?)
-    ''', (request_id, 'admin', 'Admin', message_text))
-    conn.commit()
-    conn.close()
+    # The foreign key would reject a reply to a deleted request
+    conn = get_request_db(request_id)
+    if not can_view_request(conn, request_id):
+        if wants_json():
+            return jsonify(error='Request not found'), 404
+        flash('Request not found')
+        return redirect(url_for('main.admin_dashboard'))
+    
+    admin = current_admin()
+    
+    def write(conn):
+        # Replying means the admin has read the conversation
+        message_id = insert_message(conn, request_id, 'admin', 'Admin', message_text)
+        mark_request_read(conn, admin, request_id)
+        return message_id
+    
+    message_id = run_write(write, request_project_id(request_id))
+    notify_message_posted(request_project_id(request_id))
+    
+    if wants_json():
+        return jsonify(message=get_message_dict(conn, message_id)), 201
+    return redirect(url_for('main.admin_dashboard'))
+
+@bp.route('/request/<int:request_id>/messages')
+def request_messages(request_id):
+    """Messages of one conversation newer than ?after=<message_id>, as JSON"""
+    viewer_ip = None if session.get('admin') else request.remote_addr
+    after = request.args.get('after', 0, type=int)
+    
+    conn = get_request_db(request_id)
+    if not can_view_request(conn, request_id, viewer_ip):
+        return jsonify(error='Request not found or access denied'), 404
+    
+    messages = get_new_messages(conn, after, request_id=request_id, viewer_ip=viewer_ip)
+    return jsonify(messages=[dict(message) for message in messages],
+                   last_id=messages[-1]['id'] if messages else after)
+
+@bp.route('/request/<int:request_id>/events')
+def request_events(request_id):
+    """Server-Sent Events stream of new messages in one conversation"""
+    viewer_ip = None if session.get('admin') else request.remote_addr
+    if not can_view_request(get_request_db(request_id), request_id, viewer_ip):
+        return jsonify(error='Request not found or access denied'), 404
+    
+    return message_event_stream(request_id=request_id, viewer_ip=viewer_ip)
+
+@bp.route('/project/<int:project_id>/events')
+def project_events(project_id):
+    """Server-Sent Events stream of new messages in the viewer's conversations of a project"""
+    viewer_ip = None if session.get('admin') else request.remote_addr
+    project = get_db().execute('SELECT * FROM projects WHERE id = ? AND is_deleted = 0', (project_id,)).fetchone()
+    if not project or (viewer_ip is not None and project['is_locked']):
+        return jsonify(error='Project not found or locked'), 404
+    
+    return message_event_stream(project_id=project_id, viewer_ip=viewer_ip)
+
+@bp.route('/admin/events')
+def admin_events():
+    """Server-Sent Events stream of every new message, for the admin dashboard"""
+    if not session.get('admin'):
+        return jsonify(error='Admin login required'), 403
     
-    return redirect(url_for('admin_dashboard'))
+    return message_event_stream()
 
-@app.route('/project/<int:project_id>')
+@bp.route('/project/<int:project_id>')
 def project_detail(project_id):
     user_ip = request.remote_addr
     user_prefs = get_user_preferences(user_ip)
     display_name = get_display_name(user_ip)
     
-    conn = get_db()
-    project = conn.execute('SELECT * FROM projects WHERE id = ? AND is_locked = 0', 
-                          (project_id,)).fetchone()
-    
-    if not project:
-        flash('Project not found or locked')
-        return redirect(url_for('index'))
-    
-    # Get user requests with their messages
-    user_requests = conn.execute('''
-        SELECT * FROM requests 
-        WHERE project_id = ? AND user_ip = ? AND is_blocked = 0
-        ORDER BY created_at DESC
-    ''', (project_id, user_ip)).fetchall()
-    
-    # Get messages for each request
-    requests_with_messages = []
-    for req in user_requests:
-        messages = conn.execute('''
-            SELECT * FROM messages 
-            WHERE request_id = ? 
-            ORDER BY created_at ASC
-        ''', (req['id'],)).fetchall()
-        requests_with_messages.append({
-            'request': req,
-            'messages': messages
-        })
-    
-    conn.close()
+    def render():
+        project = get_db().execute('SELECT * FROM projects WHERE id = ? AND is_locked = 0 AND is_deleted = 0', 
+                                   (project_id,)).fetchone()
+        
+        if not project:
+            flash('Project not found or locked')
+            return redirect(url_for('main.index'))
+        
+        conn = get_shard_db(project_id)
+        # Archived requests are only read when asked for
+        schemas = ['main']
+        if show_archived and attach_archive(conn, create=False):
+            schemas.append('archive')
+        request_count = sum(conn.execute(f'''
+            SELECT COUNT(*) FROM {schema}.requests 
+            WHERE project_id = ? AND user_ip = ? AND is_blocked = 0
+        ''', (project_id, user_ip)).fetchone()[0] for schema in schemas)
+        
+        # The user's requests with their messages are read while the page streams
+        requests_with_messages = itertools.chain.from_iterable(
+            get_user_conversations(conn, project_id, user_ip, schema) for schema in schemas)
+        return render_page('project_detail.html', project=project, 
+                           requests_with_messages=requests_with_messages, 
+                           request_count=request_count, show_archived=show_archived,
+                           username=display_name, user_prefs=user_prefs)
     
-    return render_template('project_detail.html', project=project, 
-                         requests_with_messages=requests_with_messages, 
-                         username=display_name, user_prefs=user_prefs)
+    # Archiving and restoring change the project's hot rows, and so its data version
+    show_archived = request.args.get('archived') == '1'
+    cache_key = ('project', project_id, user_ip, bool(session.get('admin')), preferences_key(user_prefs),
+                 show_archived)
+    return render_cached_page(cache_key, ['projects', f'project:{project_id}'], render,
+                              user_prefs.get('updated_at'))
 
-@app.route('/project/<int:project_id>/request', methods=['POST'])
+@bp.route('/project/<int:project_id>/request', methods=['POST'])
 def create_request(project_id):
     user_ip = request.remote_addr
+    retry_after = take_write_token(user_ip, project_id)
+    if retry_after:
+        return too_many_requests(retry_after)
+    
     display_name = get_display_name(user_ip)
     
     conn = get_db()
-    project = conn.execute('SELECT * FROM projects WHERE id = ? AND is_locked = 0', 
+    project = conn.execute('SELECT * FROM projects WHERE id = ? AND is_locked = 0 AND is_deleted = 0', 
                           (project_id,)).fetchone()
     
     if not project:
         flash('Project not found or locked')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     title = request.form['title']
     description = request.form['description']
     
-    # Create the request
-    cursor = conn.execute('''
-        INSERT INTO requests (project_id, username, user_ip, title, description) 
-        VALUES (?, ?, ?, ?, ?)
-    ''', (project_id, display_name, user_ip, title, description))
-    request_id = cursor.lastrowid
+    # A double-submitted form creates the request once
+    key, is_new = claim_submission(user_ip, 'request', project_id, title, description)
+    if not is_new:
+        flash('Request submitted successfully')
+        return redirect(url_for('main.project_detail', project_id=project_id))
     
-    # Add initial message with the description
-    if description:
-        conn.execute('''
-            INSERT INTO messages (request_id, sender_type, sender_name, message) 
-            VALUES (?, ?, ?, ?)
-        ''', (request_id, 'user', display_name, description))
+    def write(conn):
+        # Create the request
+        cursor = conn.execute('''
+            INSERT INTO requests (project_id, username, user_ip, title, description) 
+            VALUES (?, ?, ?, ?, ?)
+        ''', (project_id, display_name, user_ip, title, description))
+        request_id = cursor.lastrowid
+        
+        # Add initial message with the description
+        if description:
+            insert_message(conn, request_id, 'user', display_name, description)
+        return request_id
     
-    conn.commit()
-    conn.close()
+    try:
+        request_id = run_write(write, project_id)
+    except Exception:
+        recent_submissions.invalidate(key)
+        raise
+    recent_submissions.set(key, request_id)
+    notify_message_posted(project_id)
     
     flash('Request submitted successfully')
-    return redirect(url_for('project_detail', project_id=project_id))
+    return redirect(url_for('main.project_detail', project_id=project_id))
+
+def create_app(config=None):
+    """Build and configure the application.
+    
+    Settings are applied in this order, later ones winning: the defaults
+    above, the Python file named by the ASKME_CONFIG environment variable,
+    ASKME_* environment variables (ASKME_SECRET_KEY, ASKME_DATABASE,
+    ASKME_DB_POOL_SIZE, ASKME_METRICS, ...) and finally the `config` mapping. The database
+    settings apply to the whole process, which serves one application.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY=None,
+        DATABASE=DATABASE,
+        DB_POOL_SIZE=DB_POOL_SIZE,
+        DB_POOL_TIMEOUT=DB_POOL_TIMEOUT,
+        DB_JOURNAL_MODE=DB_PRAGMAS['journal_mode'],
+        DB_SYNCHRONOUS=DB_PRAGMAS['synchronous'],
+        DB_BUSY_TIMEOUT=DB_PRAGMAS['busy_timeout'],
+        DB_MMAP_SIZE=DB_PRAGMAS['mmap_size'],
+        SHARDS=SHARDS_ENABLED,
+        SHARD_FOLDER=SHARD_FOLDER,
+        WRITE_QUEUE=WRITE_QUEUE_ENABLED,
+        METRICS=METRICS_ENABLED,
+        SLOW_REQUEST_THRESHOLD=SLOW_REQUEST_THRESHOLD,
+        ARCHIVE_DATABASE=ARCHIVE_DATABASE,
+        ARCHIVE_AFTER_DAYS=ARCHIVE_AFTER_DAYS,
+        ARCHIVE_INTERVAL=ARCHIVE_INTERVAL,
+        RATE_LIMIT=RATE_LIMIT_ENABLED,
+        RATE_LIMIT_BURST=RATE_LIMIT_BURST,
+        RATE_LIMIT_RATE=RATE_LIMIT_RATE,
+        RATE_LIMIT_PROJECT_BURST=RATE_LIMIT_PROJECT_BURST,
+        RATE_LIMIT_PROJECT_RATE=RATE_LIMIT_PROJECT_RATE,
+        DUPLICATE_WINDOW=DUPLICATE_WINDOW,
+    )
+    if os.environ.get('ASKME_CONFIG'):
+        app.config.from_envvar('ASKME_CONFIG')
+    app.config.from_prefixed_env('ASKME')
+    if config:
+        app.config.update(config)
+    
+    if not app.config['SECRET_KEY']:
+        # Only safe for a single process: every process would get its own key
+        # and reject the others' session cookies. serve.py forks workers after
+        # this point, so they share it.
+        app.config['SECRET_KEY'] = secrets.token_hex(16)
+    
+    configure_database(app.config)
+    app.register_blueprint(bp)
+    app.teardown_appcontext(release_db)
+    if app.config['METRICS']:
+        app.before_request(start_request_stats)
+        app.after_request(record_request_stats)
+        before_render_template.connect(start_template_timer, app)
+        template_rendered.connect(stop_template_timer, app)
+    return app
+
+def pragma_choice(setting, value, choices):
+    """A PRAGMA value from the settings, checked since it is pasted into the statement"""
+    value = str(value).upper()
+    if value not in choices:
+        raise ValueError(f"{setting} must be one of {', '.join(choices)}, not {value!r}")
+    return value
+
+def configure_database(config):
+    """Point the process-wide database layer at an application's settings"""
+    global DATABASE, DB_POOL_SIZE, DB_POOL_TIMEOUT, SHARDS_ENABLED, SHARD_FOLDER, WRITE_QUEUE_ENABLED
+    global ARCHIVE_DATABASE, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL
+    DATABASE = config['DATABASE']
+    DB_POOL_SIZE = int(config['DB_POOL_SIZE'])
+    DB_POOL_TIMEOUT = float(config['DB_POOL_TIMEOUT'])
+    DB_PRAGMAS['journal_mode'] = pragma_choice('DB_JOURNAL_MODE', config['DB_JOURNAL_MODE'], JOURNAL_MODES)
+    DB_PRAGMAS['synchronous'] = pragma_choice('DB_SYNCHRONOUS', config['DB_SYNCHRONOUS'], SYNCHRONOUS_LEVELS)
+    DB_PRAGMAS['busy_timeout'] = int(config['DB_BUSY_TIMEOUT'])
+    DB_PRAGMAS['mmap_size'] = int(config['DB_MMAP_SIZE'])
+    SHARDS_ENABLED = bool(config['SHARDS'])
+    SHARD_FOLDER = config['SHARD_FOLDER'] or None
+    WRITE_QUEUE_ENABLED = bool(config['WRITE_QUEUE'])
+    ARCHIVE_DATABASE = config['ARCHIVE_DATABASE'] or None
+    ARCHIVE_AFTER_DAYS = float(config['ARCHIVE_AFTER_DAYS'])
+    ARCHIVE_INTERVAL = float(config['ARCHIVE_INTERVAL'])
+    recent_submissions.ttl = float(config['DUPLICATE_WINDOW'])
+    for setting in ('RATE_LIMIT_RATE', 'RATE_LIMIT_PROJECT_RATE'):
+        # A bucket that never refills would lock an IP out for good
+        if float(config[setting]) <= 0:
+            raise ValueError(f'{setting} must be a positive number of writes per second, not {config[setting]!r}')
+
+app = create_app()
 
 if __name__ == '__main__':
     init_db()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Fetch the vendored front-end libraries, or list the static assets.
+
+Pages load Bootstrap and Font Awesome from static/vendor when the files are
+there, and from public CDNs otherwise. Run `fetch` once on a machine with
+internet access and commit static/vendor, so servers without outbound
+access never wait on a CDN. `list` prints every file under static/ with
+its hashed name and its size as served, plain and gzipped.
+
+    python assets.py fetch
+    python assets.py list
+"""
+
+import argparse
+import os
+import sys
+import urllib.request
+
+import app as askme
+
+DOWNLOAD_TIMEOUT = 30  # seconds
+
+def fetch(force=False):
+    for path, url in askme.VENDOR_ASSETS.items():
+        target = os.path.join(askme.ASSETS_FOLDER, *path.split('/'))
+        if os.path.exists(target) and not force:
+            print(f'{path}: already there')
+            continue
+        with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            body = response.read()
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Write beside the target first, so a failed download leaves no partial file
+        with open(target + '.part', 'wb') as f:
+            f.write(body)
+        os.replace(target + '.part', target)
+        print(f'{path}: {len(body)} bytes from {url}')
+
+def list_assets():
+    files = askme.static_assets.manifest()['files']
+    for path, asset in sorted(files.items()):
+        compressed = f"{len(asset['gzip'])} gzipped" if asset['gzip'] else 'not compressed'
+        print(f"{asset['url_path']}  {len(asset['body'])} bytes, {compressed}")
+    for path, url in askme.VENDOR_ASSETS.items():
+        if path not in files:
+            print(f'{path}  missing, loaded from {url}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['fetch', 'list'])
+    parser.add_argument('--force', action='store_true', help='download files that are already there again')
+    args = parser.parse_args()
+    
+    if args.command == 'fetch':
+        try:
+            fetch(args.force)
+        except OSError as error:
+            sys.exit(f'Download failed: {error}')
+    else:
+        list_assets()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Measure sustained message inserts per second with and without the
+group-commit write queue.
+
+Every worker thread stands in for an HTTP handler posting a message: it
+waits for its insert to be committed before sending the next one.
+
+    python benchmarks/group_commit.py --threads 32 --seconds 5
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Add the repository root to the Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as askme
+
+def write_message(conn):
+    return askme.insert_message(conn, 1, 'user', 'bench', 'Benchmark message ' + 'x' * 64)
+
+def measure(database, threads, seconds, batched):
+    """Return the number of committed inserts per second"""
+    writer = None
+    if batched:
+        writer = askme.GroupCommitWriter(database, askme.WRITE_QUEUE_MAX_BATCH,
+                                         askme.WRITE_QUEUE_MAX_DELAY)
+    counts = [0] * threads
+    deadline = time.monotonic() + seconds
+    
+    def worker(index):
+        conn = None if batched else askme.connect_db(database)
+        while time.monotonic() < deadline:
+            if batched:
+                writer.submit(write_message).result()
+            else:
+                write_message(conn)
+                conn.commit()
+            counts[index] += 1
+        if conn is not None:
+            conn.close()
+    
+    started = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - started
+    
+    if writer is not None:
+        writer.stop()
+    return sum(counts) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32, help='concurrent writers')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each run')
+    parser.add_argument('--synchronous', default=askme.DB_PRAGMAS['synchronous'],
+                        help='PRAGMA synchronous to run with (FULL shows the fsync cost)')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    askme.DB_PRAGMAS['synchronous'] = args.synchronous
+    results = {'threads': args.threads, 'seconds': args.seconds, 'synchronous': args.synchronous}
+    for mode in ['direct', 'batched']:
+        directory = tempfile.mkdtemp()
+        database = os.path.join(directory, 'askme.db')
+        try:
+            askme.DATABASE = database
+            askme.init_db()
+            conn = askme.connect_db(database)
+            conn.execute("INSERT INTO projects (name) VALUES ('Benchmark')")
+            conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title) 
+                VALUES (1, 'bench', '127.0.0.1', 'Benchmark')
+            ''')
+            conn.commit()
+            conn.close()
+            
+            results[mode] = round(measure(database, args.threads, args.seconds, mode == 'batched'), 1)
+            print(f"{mode:>8}: {results[mode]:>10.1f} inserts/s")
+        finally:
+            shutil.rmtree(directory)
+    
+    results['speedup'] = round(results['batched'] / results['direct'], 2)
+    print(f" speedup: {results['speedup']:>10.2f}x")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""Measure the latency and throughput of every route against synthetic data.
+
+Each route is driven twice: through the Flask test client from one thread,
+and over HTTP by a pool of threads against a local threaded server. The
+p50/p95/p99 latencies, requests per second and database size are printed
+and written to JSON. With --baseline the run fails when a route's p95
+latency regresses past the stored results.
+
+    python benchmarks/routes.py --scale small --output results.json --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlencode
+
+# Add the repository root to the Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+import app as askme
+from seed import SCALES, WORDS, generate
+
+SAMPLE_SIZE = 5000  # requests and owners kept in memory to pick targets from
+HTTP_TIMEOUT = 30  # seconds
+
+class Targets:
+    """Ids the scenarios pick from, loaded from the database once.
+    
+    Destructive scenarios consume rows created up front for them, so every
+    run deletes, locks and edits the same kind of rows.
+    """
+    
+    def __init__(self, conn, rng, disposable):
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.open_projects = [row[0] for row in conn.execute('SELECT id FROM projects WHERE is_locked = 0')]
+        rows = conn.execute('SELECT id, project_id, user_ip FROM requests WHERE is_blocked = 0').fetchall()
+        self.owned_requests = [dict(row) for row in rng.sample(rows, min(SAMPLE_SIZE, len(rows)))]
+        self.ips = sorted({row['user_ip'] for row in self.owned_requests})
+        
+        # Throwaway rows for the routes that delete or change projects and requests
+        project_ids = []
+        for _ in range(disposable):
+            cursor = conn.execute("INSERT INTO projects (name, description) VALUES (?, 'disposable')",
+                                  (f'Disposable {len(project_ids)} {time.time()}',))
+            project_ids.append(cursor.lastrowid)
+        request_ids = []
+        for _ in range(disposable):
+            cursor = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title)
+                VALUES (?, 'bench', '127.0.0.1', 'Disposable')
+            ''', (project_ids[0],))
+            request_ids.append(cursor.lastrowid)
+            askme.insert_message(conn, cursor.lastrowid, 'user', 'bench', 'Disposable message')
+        # Resolved requests idle since long before the generated data, moved to
+        # the archive: half to be read there, half to be restored
+        archived_ids = []
+        for _ in range(2 * disposable):
+            cursor = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title, status, created_at, updated_at)
+                VALUES (?, 'bench', '127.0.0.1', 'Archived', 'completed', '2000-01-01', '2000-01-01')
+            ''', (project_ids[0],))
+            archived_ids.append(cursor.lastrowid)
+            conn.execute('''
+                INSERT INTO messages (request_id, sender_type, sender_name, message, created_at)
+                VALUES (?, 'user', 'bench', 'Archived message', '2000-01-01')
+            ''', (cursor.lastrowid,))
+        conn.commit()
+        askme.archive_resolved_requests(conn, older_than_days=(datetime.now() - datetime(2001, 1, 1)).days)
+        self.disposable_projects = deque(project_ids[1:])
+        self.disposable_requests = deque(request_ids)
+        self.archived_requests = archived_ids[:disposable]
+        self.disposable_archived = deque(archived_ids[disposable:])
+    
+    def pick(self, values):
+        with self.lock:
+            return self.rng.choice(values)
+    
+    def unique(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+    
+    def word(self):
+        return self.pick(WORDS)
+    
+    def take(self, values):
+        with self.lock:
+            return values.popleft() if values else 0
+
+def owned(targets, path):
+    """A user's own request: `path` formatted with it, no form data, the owner's IP"""
+    req = targets.pick(targets.owned_requests)
+    return path.format(**req), None, req['user_ip']
+
+def post_owned(targets, path, data):
+    path, _, ip = owned(targets, path)
+    return path, data, ip
+
+def any_request(targets, path):
+    return path.format(**targets.pick(targets.owned_requests))
+
+def bulk_selection(targets):
+    """A bulk status change of a few requests, picked the way the dashboard's checkboxes are"""
+    request_ids = [targets.pick(targets.owned_requests)['id'] for _ in range(5)]
+    return {'action': 'status', 'set_status': targets.pick(askme.REQUEST_STATUSES), 'request_id': request_ids}
+
+def import_upload(targets):
+    """A small export, of a project with one conversation, as an uploaded file"""
+    records = [
+        {'type': 'askme', 'version': askme.EXPORT_FORMAT_VERSION},
+        {'type': 'project', 'id': 1, 'name': f'Imported {targets.unique()} {time.time()}'},
+        {'type': 'request', 'id': 1, 'project_id': 1, 'username': 'bench', 'user_ip': '127.0.0.1',
+         'title': f'Imported {targets.word()}', 'created_at': '2024-06-01 12:00:00'},
+        {'type': 'message', 'id': 1, 'request_id': 1, 'sender_type': 'user', 'sender_name': 'bench',
+         'message': f'Imported {targets.word()}', 'created_at': '2024-06-01 12:00:00'},
+    ]
+    body = ''.join(json.dumps(record) + '\n' for record in records).encode()
+    return {'file': (io.BytesIO(body), 'askme.jsonl')}
+
+def encode_form(data):
+    """The body and Content-Type of form data for HTTP; a (file, filename) value makes it multipart"""
+    if not any(isinstance(value, tuple) for value in data.values()):
+        return urlencode(data, doseq=True), 'application/x-www-form-urlencoded'
+    boundary = f'askme-benchmark-{time.time_ns()}'
+    parts = []
+    for name, value in data.items():
+        if isinstance(value, tuple):
+            file, filename = value
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                         f'Content-Type: application/octet-stream\r\n\r\n'.encode() + file.getvalue() + b'\r\n')
+        else:
+            for item in value if isinstance(value, list) else [value]:
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                             f'{item}\r\n'.encode())
+    return b''.join(parts) + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+# Every route of app.py: (name, method, admin, build), where build(targets)
+# returns (path, form data or None, client IP). Event streams are timed to
+# their first chunk. A full run fails when a route has no scenario here.
+def scenario_routes():
+    return [
+        ('index', 'GET', False, lambda t: ('/', None, t.pick(t.ips))),
+        ('project_detail', 'GET', False, lambda t: owned(t, '/project/{project_id}')),
+        ('create_request', 'POST', False, lambda t: (
+            f'/project/{t.pick(t.open_projects)}/request',
+            {'title': f'Benchmark {t.word()}', 'description': f'Please {t.word()} {t.word()}'},
+            t.pick(t.ips))),
+        ('add_message', 'POST', False, lambda t: post_owned(t, '/request/{id}/message', {'message': f'More {t.word()}'})),
+        ('request_messages', 'GET', False, lambda t: owned(t, '/request/{id}/messages?after=0')),
+        ('request_events', 'GET', False, lambda t: owned(t, '/request/{id}/events')),
+        ('project_events', 'GET', False, lambda t: owned(t, '/project/{project_id}/events')),
+        ('update_preferences', 'POST', False, lambda t: (
+            '/preferences', {'nickname': f'{t.word()}_{t.unique()}', 'language': 'en', 'theme': 'dark'},
+            t.pick(t.ips))),
+        ('admin_login', 'GET', False, lambda t: ('/admin/login', None, '127.0.0.1')),
+        ('admin_login_submit', 'POST', False, lambda t: (
+            '/admin/login', {'username': askme.ADMIN_USERNAME, 'password': 'wrong'}, '127.0.0.1')),
+        ('admin_logout', 'GET', False, lambda t: ('/admin/logout', None, '127.0.0.1')),
+        ('admin_dashboard', 'GET', True, lambda t: ('/admin', None, '127.0.0.1')),
+        ('admin_dashboard_filtered', 'GET', True, lambda t: (
+            '/admin?' + urlencode({'tag': 'bug', 'status': 'pending'}), None, '127.0.0.1')),
+        ('admin_dashboard_project', 'GET', True, lambda t: (
+            any_request(t, '/admin?project={project_id}'), None, '127.0.0.1')),
+        ('admin_request_conversation', 'GET', True, lambda t: (
+            any_request(t, '/admin/request/{id}/conversation'), None, '127.0.0.1')),
+        ('admin_request_edit', 'GET', True, lambda t: (
+            any_request(t, '/admin/request/{id}/edit'), None, '127.0.0.1')),
+        ('admin_search', 'GET', True, lambda t: (
+            '/admin/search?' + urlencode({'q': f'{t.word()} {t.word()}'}), None, '127.0.0.1')),
+        ('admin_metrics', 'GET', True, lambda t: ('/admin/metrics', None, '127.0.0.1')),
+        ('admin_events', 'GET', True, lambda t: ('/admin/events', None, '127.0.0.1')),
+        ('admin_inbox', 'GET', True, lambda t: ('/admin/inbox', None, '127.0.0.1')),
+        ('mark_read', 'POST', True, lambda t: (any_request(t, '/admin/inbox/{id}/read'), {}, '127.0.0.1')),
+        ('admin_deletions', 'GET', True, lambda t: ('/admin/deletions', None, '127.0.0.1')),
+        ('admin_export', 'GET', True, lambda t: (
+            f'/admin/export?project={t.pick(t.open_projects)}', None, '127.0.0.1')),
+        ('admin_import', 'POST', True, lambda t: ('/admin/import', import_upload(t), '127.0.0.1')),
+        ('admin_archive', 'GET', True, lambda t: ('/admin/archive', None, '127.0.0.1')),
+        ('admin_archive_search', 'GET', True, lambda t: (
+            '/admin/archive?' + urlencode({'q': 'archived'}), None, '127.0.0.1')),
+        ('admin_archived_conversation', 'GET', True, lambda t: (
+            f'/admin/archive/{t.pick(t.archived_requests)}/conversation', None, '127.0.0.1')),
+        ('restore_request', 'POST', True, lambda t: (
+            f'/admin/archive/{t.take(t.disposable_archived)}/restore', {}, '127.0.0.1')),
+        # ARCHIVE_AFTER_DAYS is set past the generated data, so runs scan without moving anything
+        ('run_archiving', 'POST', True, lambda t: ('/admin/archive/run', {}, '127.0.0.1')),
+        ('asset', 'GET', False, lambda t: (
+            '/assets/' + askme.static_assets.get('css/style.css')['url_path'], None, t.pick(t.ips))),
+        ('static', 'GET', False, lambda t: ('/static/css/style.css', None, t.pick(t.ips))),
+        ('create_project', 'POST', True, lambda t: (
+            '/admin/project/create', {'name': f'Benchmark {t.unique()} {time.time()}', 'description': ''},
+            '127.0.0.1')),
+        ('edit_project', 'POST', True, lambda t: (
+            f'/admin/project/{t.pick(t.disposable_projects)}/edit',
+            {'name': f'Edited {t.unique()} {time.time()}', 'description': t.word()}, '127.0.0.1')),
+        ('toggle_project_lock', 'POST', True, lambda t: (
+            f'/admin/project/{t.pick(t.disposable_projects)}/toggle_lock', {}, '127.0.0.1')),
+        ('update_request', 'POST', True, lambda t: (
+            any_request(t, '/admin/request/{id}/update'),
+            {'status': t.pick(askme.REQUEST_STATUSES), 'tags': f'{t.word()}, bug'}, '127.0.0.1')),
+        ('admin_add_message', 'POST', True, lambda t: (
+            any_request(t, '/admin/request/{id}/message'), {'message': f'Answer {t.word()}'}, '127.0.0.1')),
+        ('bulk_update_requests', 'POST', True, lambda t: ('/admin/requests/bulk', bulk_selection(t), '127.0.0.1')),
+        ('delete_request', 'POST', True, lambda t: (
+            f'/admin/request/{t.take(t.disposable_requests)}/delete', {}, '127.0.0.1')),
+        ('delete_project', 'POST', True, lambda t: (
+            f'/admin/project/{t.take(t.disposable_projects)}/delete', {}, '127.0.0.1')),
+    ]
+
+def routes_without_scenario(app, targets, scenarios):
+    """The endpoints of app that no scenario reaches; builds each scenario's call once"""
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    for name, method, admin, build in scenarios:
+        path, _, _ = build(targets)
+        covered.add(adapter.match(path.split('?', 1)[0], method=method)[0])
+    return sorted({rule.endpoint for rule in app.url_map.iter_rules()} - covered)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, round(fraction * (len(sorted_values) - 1)))]
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+    }
+
+def run_test_client(app, targets, scenarios, iterations):
+    """Time each route through the Flask test client, one call at a time"""
+    results = {}
+    for name, method, admin, build in scenarios:
+        latencies = []
+        with app.test_client() as client:
+            if admin:
+                with client.session_transaction() as sess:
+                    sess['admin'] = True
+            started = time.perf_counter()
+            for _ in range(iterations):
+                path, data, ip = build(targets)
+                call_started = time.perf_counter()
+                response = client.open(path, method=method, data=data,
+                                       environ_base={'REMOTE_ADDR': ip})
+                if response.is_streamed and response.mimetype == 'text/event-stream':
+                    next(response.response)
+                else:
+                    response.get_data()
+                response.close()
+                latencies.append(time.perf_counter() - call_started)
+                if response.status_code >= 500:
+                    raise RuntimeError(f'{name}: {method} {path} returned {response.status_code}')
+            results[name] = summarize(latencies, time.perf_counter() - started)
+    return results
+
+def admin_cookie(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=HTTP_TIMEOUT)
+    body = urlencode({'username': askme.ADMIN_USERNAME, 'password': askme.ADMIN_PASSWORD})
+    conn.request('POST', '/admin/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+def run_http(app, targets, scenarios, requests_per_route, threads):
+    """Time each route over HTTP with `threads` concurrent clients.
+    
+    Every call comes from 127.0.0.1, the most active IP in the generated data,
+    so user routes aimed at other users' requests take their access-denied path.
+    """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    port = server.server_port
+    cookie = admin_cookie(port)
+    results = {}
+    try:
+        for name, method, admin, build in scenarios:
+            latencies = []
+            failures = []
+            remaining = [requests_per_route]
+            lock = threading.Lock()
+            
+            def worker():
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=HTTP_TIMEOUT)
+                while True:
+                    with lock:
+                        if not remaining[0]:
+                            break
+                        remaining[0] -= 1
+                    path, data, _ = build(targets)
+                    headers = {'Cookie': cookie} if admin else {}
+                    body = None
+                    if data is not None:
+                        body, headers['Content-Type'] = encode_form(data)
+                    call_started = time.perf_counter()
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    if response.getheader('Content-Type', '').startswith('text/event-stream'):
+                        response.read1()
+                        # Streams never end; drop the connection instead
+                        conn.close()
+                    else:
+                        response.read()
+                    elapsed = time.perf_counter() - call_started
+                    with lock:
+                        latencies.append(elapsed)
+                        if response.status >= 500:
+                            failures.append(f'{method} {path} returned {response.status}')
+                conn.close()
+            
+            started = time.perf_counter()
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            if failures:
+                raise RuntimeError(f'{name}: {failures[0]}')
+            results[name] = summarize(latencies, time.perf_counter() - started)
+    finally:
+        server.shutdown()
+    return results
+
+def database_size(database):
+    return sum(os.path.getsize(path) for path in [database, database + '-wal']
+               if os.path.exists(path))
+
+def compare(results, baseline, tolerance, slack_ms):
+    """List the routes whose p95 latency grew past the baseline"""
+    regressions = []
+    for mode, routes in baseline['routes'].items():
+        for name, expected in routes.items():
+            actual = results['routes'].get(mode, {}).get(name)
+            if actual is None:
+                continue
+            limit = expected['p95_ms'] * (1 + tolerance) + slack_ms
+            if actual['p95_ms'] > limit:
+                regressions.append(f"{mode} {name}: p95 {actual['p95_ms']:.2f} ms > "
+                                   f"{limit:.2f} ms (baseline {expected['p95_ms']:.2f} ms)")
+    return regressions
+
+def print_table(results):
+    for mode, routes in results['routes'].items():
+        print(f'\n{mode}')
+        print(f"{'route':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+        for name, stats in routes.items():
+            print(f"{name:<28} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+                  f"{stats['p99_ms']:>9.2f} {stats['rps']:>9.1f}")
+    print(f"\ndatabase: {results['database_bytes'] / 1024 / 1024:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='small', help='synthetic data preset')
+    parser.add_argument('--projects', type=int, help='override the preset')
+    parser.add_argument('--requests', type=int, help='override the preset')
+    parser.add_argument('--messages', type=int, help='override the preset')
+    parser.add_argument('--ips', type=int, help='override the preset')
+    parser.add_argument('--seed', type=int, default=1, help='data and target selection seed')
+    parser.add_argument('--database', help='reuse or keep the generated database at this path')
+    parser.add_argument('--iterations', type=int, default=100, help='test client calls per route')
+    parser.add_argument('--http-requests', type=int, default=200, help='HTTP requests per route, 0 skips')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--routes', help='comma-separated route names to run (default: all)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='fail when p95 latencies regress past this results file')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed relative p95 growth')
+    parser.add_argument('--slack-ms', type=float, default=5.0, help='allowed absolute p95 growth')
+    args = parser.parse_args()
+    
+    sizes = dict(SCALES[args.scale])
+    for name in sizes:
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+    scenarios = scenario_routes()
+    if args.routes:
+        wanted = set(args.routes.split(','))
+        scenarios = [scenario for scenario in scenarios if scenario[0] in wanted]
+    
+    directory = None
+    database = args.database
+    if database is None:
+        directory = tempfile.mkdtemp()
+        database = os.path.join(directory, 'askme.db')
+    try:
+        if not os.path.exists(database):
+            print(f'Generating {sizes} ...')
+            print(f'  done in {generate(database, seed=args.seed, **sizes):.1f}s')
+        size = database_size(database)
+        
+        # Every HTTP call comes from one IP: limits would measure the 429 path
+        app = askme.create_app({'DATABASE': database, 'SECRET_KEY': 'benchmark',
+                                'RATE_LIMIT': False, 'DUPLICATE_WINDOW': 0,
+                                'ARCHIVE_AFTER_DAYS': (datetime.now() - datetime(2000, 1, 1)).days})
+        askme.init_db()
+        conn = askme.connect_db(database)
+        # Spare disposable rows: one for the coverage check below, and one left
+        # for the routes that pick among them after the last deletion
+        targets = Targets(conn, random.Random(args.seed), args.iterations + args.http_requests + 2)
+        conn.close()
+        if not args.routes:
+            missing = routes_without_scenario(app, targets, scenarios)
+            if missing:
+                sys.exit(f"Routes without a benchmark scenario: {', '.join(missing)}")
+        
+        results = {
+            'scale': sizes,
+            'seed': args.seed,
+            'database_bytes': size,
+            'routes': {'test_client': run_test_client(app, targets, scenarios, args.iterations)},
+        }
+        if args.http_requests:
+            results['routes']['http'] = run_http(app, targets, scenarios, args.http_requests, args.threads)
+            results['threads'] = args.threads
+        askme.stop_writer()
+        askme.get_pool().close()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['scale'] != results['scale']:
+            sys.exit(f"Baseline was recorded at scale {baseline['scale']}, not {results['scale']}")
+        regressions = compare(results, baseline, args.tolerance, args.slack_ms)
+        if regressions:
+            print('\nRegressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print('\nNo regressions against the baseline.')
+
+if __name__ == '__main__':
+    main()
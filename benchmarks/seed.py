@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Fill an AskMe database with seeded synthetic projects, requests and messages.
+
+The same seed and scale always produce the same data. Activity is skewed the
+way real traffic is: a few projects and a few IP addresses account for most
+requests, and most conversations are short while some run long. The most
+active IP is 127.0.0.1, so local HTTP load sees a heavy user's pages.
+
+    python benchmarks/seed.py /tmp/askme-bench.db --projects 1000 --requests 200000 --messages 2000000
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Add the repository root to the Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as askme
+
+SCALES = {
+    'small': {'projects': 50, 'requests': 5000, 'messages': 50000, 'ips': 2000},
+    'medium': {'projects': 200, 'requests': 40000, 'messages': 400000, 'ips': 10000},
+    'large': {'projects': 1000, 'requests': 200000, 'messages': 2000000, 'ips': 50000},
+}
+
+CHUNK_SIZE = 10000  # rows per executemany() and per transaction
+IP_SKEW = 0.9  # Zipf exponent of requests per IP address
+PROJECT_SKEW = 0.9  # Zipf exponent of requests per project
+THREAD_SKEW = 0.6  # Zipf exponent of messages per request
+LOCKED_PROJECT_RATE = 0.05
+BLOCKED_REQUEST_RATE = 0.02
+PREFERENCES_RATE = 0.1  # IP addresses with stored preferences
+STATUS_WEIGHTS = {'pending': 40, 'approved': 20, 'rejected': 10, 'completed': 30}
+TAGS = ['bug', 'feature', 'enhancement', 'question', 'docs', 'ui', 'performance',
+        'security', 'billing', 'mobile', 'api', 'urgent']
+WORDS = ['add', 'allow', 'broken', 'button', 'cannot', 'crash', 'dark', 'mode', 'export',
+         'csv', 'login', 'page', 'slow', 'search', 'filter', 'support', 'email', 'error',
+         'upload', 'image', 'report', 'settings', 'missing', 'translation', 'update',
+         'please', 'thanks', 'when', 'after', 'every', 'time', 'user', 'project', 'list']
+HISTORY_DAYS = 365
+
+def zipf_cum_weights(count, skew):
+    """Cumulative weights where item k is chosen in proportion to 1 / k**skew"""
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+def ip_address(index):
+    if index == 0:
+        return '127.0.0.1'
+    return f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}'
+
+def sentence(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+def timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def insert_chunks(conn, sql, rows):
+    """Insert an iterable of rows in committed chunks, keeping memory flat"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            break
+        conn.executemany(sql, chunk)
+        conn.commit()
+
+def generate(database, projects, requests, messages, ips, seed=1):
+    """Create `database` with the schema and fill it; returns the elapsed seconds"""
+    started = time.monotonic()
+    rng = random.Random(seed)
+    askme.DATABASE = database
+    askme.init_db()
+    conn = askme.connect_db(database)
+    conn.execute('PRAGMA synchronous = OFF')
+    
+    start = datetime(2024, 1, 1)
+    step = timedelta(days=HISTORY_DAYS) / max(requests, 1)
+    
+    insert_chunks(conn, 'INSERT INTO projects (id, name, description, is_locked, created_at) VALUES (?, ?, ?, ?, ?)', (
+        (project_id, f'Project {project_id:05d}', sentence(rng, 4, 12),
+         int(rng.random() < LOCKED_PROJECT_RATE), timestamp(start))
+        for project_id in range(1, projects + 1)))
+    
+    nicknames = [(ip_address(index), f'{rng.choice(WORDS)}_{index}', rng.choice(['en', 'it']),
+                  rng.choice(['light', 'dark']))
+                 for index in range(ips) if rng.random() < PREFERENCES_RATE]
+    insert_chunks(conn, '''
+        INSERT INTO user_preferences (user_ip, custom_nickname, language, theme) VALUES (?, ?, ?, ?)
+    ''', nicknames)
+    
+    # Requests, in creation order, with their tags
+    ip_weights = zipf_cum_weights(ips, IP_SKEW)
+    project_weights = zipf_cum_weights(projects, PROJECT_SKEW)
+    statuses = list(STATUS_WEIGHTS)
+    status_weights = list(itertools.accumulate(STATUS_WEIGHTS.values()))
+    request_info = []  # (created_at, username) per request, for its messages
+    tag_rows = []
+    
+    def request_rows():
+        for request_id in range(1, requests + 1):
+            ip = ip_address(rng.choices(range(ips), cum_weights=ip_weights)[0])
+            project_id = rng.choices(range(1, projects + 1), cum_weights=project_weights)[0]
+            username = askme.get_username_from_ip(ip)
+            tags = sorted(set(rng.sample(TAGS, rng.choice([0, 0, 1, 1, 1, 2, 3]))))
+            created = start + step * request_id
+            status = rng.choices(statuses, cum_weights=status_weights)[0]
+            request_info.append((created, username))
+            tag_rows.extend((request_id, project_id, tag) for tag in tags)
+            description = sentence(rng, 8, 40) if rng.random() < 0.8 else None
+            yield (request_id, project_id, username, ip, sentence(rng, 3, 8).capitalize(),
+                   description, status, ', '.join(tags) or None,
+                   int(rng.random() < BLOCKED_REQUEST_RATE), timestamp(created), timestamp(created))
+    
+    insert_chunks(conn, '''
+        INSERT INTO requests (id, project_id, username, user_ip, title, description, status,
+                              tags, is_blocked, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', request_rows())
+    insert_chunks(conn, 'INSERT INTO request_tags (request_id, project_id, tag) VALUES (?, ?, ?)', tag_rows)
+    del tag_rows
+    
+    # Messages per request follow a Zipf law over a shuffled request order,
+    # so long threads are spread over projects and time
+    thread_weights = zipf_cum_weights(requests, THREAD_SKEW)
+    order = list(range(requests))
+    rng.shuffle(order)
+    counts = [0] * requests
+    remaining = messages
+    while remaining:
+        batch = min(remaining, CHUNK_SIZE * 10)
+        for rank in rng.choices(range(requests), cum_weights=thread_weights, k=batch):
+            counts[order[rank]] += 1
+        remaining -= batch
+    
+    def message_rows():
+        for index, count in enumerate(counts):
+            created, username = request_info[index]
+            sender = 'user'
+            for _ in range(count):
+                created += timedelta(minutes=rng.randint(1, 600))
+                yield (index + 1, sender, 'Admin' if sender == 'admin' else username,
+                       sentence(rng, 3, 30), timestamp(created))
+                sender = 'admin' if sender == 'user' and rng.random() < 0.6 else 'user'
+    
+    insert_chunks(conn, '''
+        INSERT INTO messages (request_id, sender_type, sender_name, message, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', message_rows())
+    
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    return time.monotonic() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='database file to create; must not exist yet')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='preset sizes')
+    parser.add_argument('--projects', type=int, help='override the preset')
+    parser.add_argument('--requests', type=int, help='override the preset')
+    parser.add_argument('--messages', type=int, help='override the preset')
+    parser.add_argument('--ips', type=int, help='distinct user IP addresses; override the preset')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    
+    if os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+    sizes = dict(SCALES[args.scale])
+    for name in sizes:
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+    
+    elapsed = generate(args.database, seed=args.seed, **sizes)
+    print(f"Generated {sizes['projects']} projects, {sizes['requests']} requests and "
+          f"{sizes['messages']} messages in {elapsed:.1f}s "
+          f"({os.path.getsize(args.database) / 1024 / 1024:.1f} MiB)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Export the AskMe dataset to JSON Lines, or import such an export.
+
+Both directions stream: the export is written row by row from open database
+cursors and the import reads one line at a time, inserting in chunks, so
+files of any size move in constant memory. The database is the one the
+application uses (ASKME_DATABASE or ASKME_CONFIG), unless --database is given.
+Use - for standard output or input.
+
+    python dataset.py export backup.jsonl
+    python dataset.py export - --project 3 --since 2024-01-01 | gzip > project-3.jsonl.gz
+    python dataset.py import backup.jsonl --until 2024-06-30
+"""
+
+import argparse
+import sys
+from datetime import date
+
+import app as askme
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='JSON Lines file to write or read, - for stdout or stdin')
+    parser.add_argument('--database', help='SQLite database (default: the application setting)')
+    parser.add_argument('--project', type=int, action='append', dest='project_ids', metavar='ID',
+                        help='only this project; repeat for more (on import, ids in the file)')
+    parser.add_argument('--since', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                        help='only requests created on or after this date')
+    parser.add_argument('--until', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                        help='only requests created on or before this date')
+    args = parser.parse_args()
+    
+    if args.database:
+        askme.DATABASE = args.database
+    askme.init_db()
+    filters = {'project_ids': args.project_ids, 'since': args.since, 'until': args.until}
+    conn = askme.connect_db()
+    try:
+        if args.command == 'export':
+            output = sys.stdout if args.path == '-' else open(args.path, 'w', encoding='utf-8')
+            with output:
+                output.writelines(askme.export_jsonl(conn, **filters))
+        else:
+            source = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+            with source:
+                try:
+                    counts = askme.import_jsonl(conn, source, **filters)
+                except ValueError as error:
+                    sys.exit(f'Import failed: {error}')
+            print(f"Imported {counts['projects']} projects, {counts['requests']} requests, "
+                  f"{counts['messages']} messages and {counts['preferences']} user preferences",
+                  file=sys.stderr)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
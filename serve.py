@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Production entry point: a pre-forking server for AskMe.
+
+The parent process loads the application, applies database migrations
+and binds the listening socket once, then forks one worker per CPU core
+(or --workers). Every worker inherits the same configuration and secret
+key and serves requests on the shared socket with a pool of threads.
+Workers that die are replaced; SIGINT or SIGTERM stops them all.
+
+    ASKME_SECRET_KEY=... ASKME_DATABASE=/var/lib/askme/askme.db python serve.py --port 8000
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+from app import app, init_db, static_assets
+
+def run_worker(app, host, port, fd):
+    """Serve requests on the inherited socket until told to stop"""
+    def stop(signum, frame):
+        raise SystemExit(0)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    server = make_server(host, port, app, threaded=True, fd=fd)
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        server.server_close()
+    # Leave through sys.exit so that atexit handlers flush the write queue
+    sys.exit(0)
+
+def spawn_worker(app, host, port, fd):
+    pid = os.fork()
+    if pid == 0:
+        run_worker(app, host, port, fd)
+    return pid
+
+def main():
+    parser = argparse.ArgumentParser(description='Run AskMe with several worker processes.')
+    parser.add_argument('--host', default=os.environ.get('ASKME_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('ASKME_PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('ASKME_WORKERS', os.cpu_count() or 1)),
+                        help='worker processes (default: one per CPU core)')
+    args = parser.parse_args()
+    
+    # Everything the workers share is prepared once, before forking: the
+    # application (and its secret key) was built on import, and the hashed,
+    # gzipped static assets are built here
+    init_db()
+    static_assets.manifest()
+    
+    listener = socket.create_server((args.host, args.port), backlog=1024)
+    listener.set_inheritable(True)
+    fd = listener.fileno()
+    
+    workers = {spawn_worker(app, args.host, args.port, fd) for _ in range(args.workers)}
+    print(f'AskMe listening on http://{args.host}:{args.port} with {args.workers} workers')
+    
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            print(f'Worker {pid} exited with status {status}, starting a new one', file=sys.stderr)
+            time.sleep(1)
+            workers.add(spawn_worker(app, args.host, args.port, fd))
+    
+    listener.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Split a database into per-project shards, or list the shards.
+
+With ASKME_SHARDS on, each project's requests and messages live in a SQLite
+file of their own, and the main database keeps the catalog: projects, user
+preferences and deletion jobs. `split` moves the rows of an existing
+database into the shards, with their archived rows into each shard's
+archive, then removes them from the main database and its archive. Request
+and message ids move into the project's id range: <project id> << 32 plus
+the old id. Stop the application first; turn sharding on before starting
+it again. `list` prints every project's shard with its size.
+
+    python shards.py split
+    python shards.py split --database /srv/askme/askme.db --force
+    python shards.py list
+"""
+
+import argparse
+import os
+import sys
+
+import app as askme
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+def count_rows(conn, schema, project_id):
+    """How many requests and messages of a project a schema holds"""
+    return tuple(conn.execute(f'''
+        SELECT COUNT(*), (SELECT COUNT(*) FROM {schema}.messages 
+                          WHERE request_id IN (SELECT id FROM {schema}.requests WHERE project_id = :project_id))
+        FROM {schema}.requests WHERE project_id = :project_id
+    ''', {'project_id': project_id}).fetchone())
+
+def copy_project(catalog, project_id, source_archive):
+    """Copy a project's rows into its new shard and check them; returns their counts per schema"""
+    offset = project_id << askme.SHARD_ID_BITS
+    requests = ', '.join(askme.REQUEST_FIELDS)
+    messages = ', '.join(askme.MESSAGE_FIELDS)
+    # The same columns, with the ids moved into the project's range
+    moved = {'id': f'id + {offset}', 'request_id': f'request_id + {offset}'}
+    source_requests = ', '.join(moved.get(field, field) for field in askme.REQUEST_FIELDS)
+    source_messages = ', '.join(moved.get(field, field) for field in askme.MESSAGE_FIELDS)
+    
+    shard = askme.connect_db(askme.prepare_shard(catalog, project_id))
+    try:
+        # Each schema of the shard with the schema its rows come from
+        schemas = {'main': 'source'}
+        shard.execute('ATTACH DATABASE ? AS source', (askme.DATABASE,))
+        if os.path.exists(source_archive):
+            askme.attach_archive(shard)
+            shard.execute('ATTACH DATABASE ? AS source_archive', (source_archive,))
+            schemas['archive'] = 'source_archive'
+        
+        shard.execute('BEGIN IMMEDIATE')
+        try:
+            # The triggers fill in the search indexes, counters and data versions
+            for schema, source in schemas.items():
+                archived_at = ', archived_at' if schema == 'archive' else ''
+                shard.execute(f'''
+                    INSERT INTO {schema}.requests ({requests}{archived_at})
+                    SELECT {source_requests}{archived_at} FROM {source}.requests WHERE project_id = ? ORDER BY id
+                ''', (project_id,))
+                shard.execute(f'''
+                    INSERT INTO {schema}.messages ({messages})
+                    SELECT {source_messages} FROM {source}.messages
+                    WHERE request_id IN (SELECT id FROM {source}.requests WHERE project_id = ?)
+                    ORDER BY id
+                ''', (project_id,))
+            shard.execute(f'''
+                INSERT INTO request_tags (request_id, project_id, tag)
+                SELECT request_id + {offset}, project_id, tag FROM source.request_tags WHERE project_id = ?
+            ''', (project_id,))
+            shard.execute(f'''
+                INSERT INTO admin_reads (admin, request_id, last_read_message_id, read_at)
+                SELECT a.admin, a.request_id + {offset}, a.last_read_message_id + {offset}, a.read_at
+                FROM source.admin_reads a JOIN source.requests r ON r.id = a.request_id
+                WHERE r.project_id = ?
+            ''', (project_id,))
+            
+            counts = {}
+            for schema, source in schemas.items():
+                counts[schema] = count_rows(shard, schema, project_id)
+                expected = count_rows(shard, source, project_id)
+                if counts[schema] != expected:
+                    raise RuntimeError(f'project {project_id}: copied {counts[schema]} of {expected} '
+                                       f'requests and messages to {schema}')
+            shard.commit()
+        except Exception:
+            shard.rollback()
+            raise
+    finally:
+        shard.close()
+    return counts
+
+def write_summary(catalog, project_id):
+    """Summarize a new shard in the catalog, with unread counts for every admin who has read markers there"""
+    shard = askme.connect_db(askme.shard_path(project_id))
+    try:
+        admins = [row[0] for row in shard.execute('SELECT DISTINCT admin FROM admin_reads')]
+        askme.write_shard_summary(catalog, shard, project_id, admins)
+    finally:
+        shard.close()
+
+def shard_has_requests(path):
+    conn = askme.connect_db(path)
+    try:
+        tables = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'requests'").fetchone()
+        return bool(tables and conn.execute('SELECT 1 FROM requests LIMIT 1').fetchone())
+    finally:
+        conn.close()
+
+def split(force=False):
+    askme.SHARDS_ENABLED = False
+    source_archive = askme.archive_path(askme.DATABASE)
+    catalog = askme.connect_db()
+    try:
+        askme.migrate_db(catalog)
+        # Shards keep their archives beside them, whatever ARCHIVE_DATABASE says
+        askme.SHARDS_ENABLED = True
+        if catalog.execute('SELECT 1 FROM deletion_jobs WHERE finished_at IS NULL LIMIT 1').fetchone():
+            sys.exit('Project deletions are still running; start the application until they finish')
+        schemas = askme.project_schemas(catalog)
+        if not any(catalog.execute(f'SELECT 1 FROM {schema}.requests LIMIT 1').fetchone() for schema in schemas):
+            sys.exit('Nothing to split: the database holds no requests')
+        for schema in schemas:
+            for table in ('requests', 'messages'):
+                largest = catalog.execute(f'SELECT MAX(id) FROM {schema}.{table}').fetchone()[0] or 0
+                if largest >> askme.SHARD_ID_BITS:
+                    sys.exit(f'{schema}.{table} has ids too large to move into the projects\' id ranges')
+        
+        project_ids = askme.live_project_ids(catalog)
+        paths = [askme.shard_path(project_id) for project_id in project_ids]
+        # Empty shards, as a sharded application creates them, are simply replaced
+        used = [path for path in paths if os.path.exists(path) and shard_has_requests(path)]
+        if used and not force:
+            sys.exit(f'{len(used)} shard(s) hold requests already, such as {used[0]}; use --force to replace them')
+        for path in paths:
+            remove_database(path)
+            remove_database(askme.archive_path(path))
+        
+        totals = {'main': [0, 0], 'archive': [0, 0]}
+        for project_id in project_ids:
+            counts = copy_project(catalog, project_id, source_archive)
+            for schema, (requests, messages) in counts.items():
+                totals[schema][0] += requests
+                totals[schema][1] += messages
+            print(f"project {project_id}: {counts['main'][0]} requests and {counts['main'][1]} messages"
+                  + (f", {counts['archive'][0]} and {counts['archive'][1]} archived" if 'archive' in counts else ''))
+        
+        # The catalog keeps no requests; deleting them cascades to their messages and tags
+        catalog.execute('BEGIN IMMEDIATE')
+        try:
+            catalog.execute('DELETE FROM main.requests')
+            catalog.execute("DELETE FROM data_versions WHERE name <> 'projects'")
+            catalog.execute('DELETE FROM project_request_counts')
+            # Instead it keeps a summary of each shard, for the admin's views across projects
+            for project_id in project_ids:
+                write_summary(catalog, project_id)
+            # Deletes leave tombstones in the search indexes; rebuilding them from the empty tables drops those
+            catalog.execute("INSERT INTO requests_fts (requests_fts) VALUES ('rebuild')")
+            catalog.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            catalog.commit()
+        except Exception:
+            catalog.rollback()
+            raise
+        if 'archive' in schemas:
+            catalog.execute('DETACH DATABASE archive')
+            remove_database(source_archive)
+        catalog.execute('VACUUM')
+    finally:
+        catalog.close()
+    print(f"Moved {totals['main'][0]} requests and {totals['main'][1]} messages "
+          f"({totals['archive'][0]} and {totals['archive'][1]} archived) of {len(project_ids)} projects "
+          f"into {os.path.dirname(askme.shard_path(0))}", file=sys.stderr)
+
+def list_shards():
+    catalog = askme.connect_db()
+    try:
+        projects = catalog.execute('SELECT id, name FROM projects WHERE is_deleted = 0 ORDER BY id').fetchall()
+    finally:
+        catalog.close()
+    for project in projects:
+        path = askme.shard_path(project['id'])
+        if not os.path.exists(path):
+            print(f"{path}  {project['name']}: not created yet")
+            continue
+        shard = askme.connect_db(path)
+        try:
+            requests = shard.execute('SELECT COALESCE(SUM(requests), 0) FROM project_request_counts').fetchone()[0]
+        finally:
+            shard.close()
+        size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+        print(f"{path}  {project['name']}: {requests} requests, {size} bytes")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['split', 'list'])
+    parser.add_argument('--database', help='SQLite database (default: the application setting)')
+    parser.add_argument('--folder', help='folder of the shards (default: the application setting)')
+    parser.add_argument('--force', action='store_true', help='replace shards that exist already')
+    args = parser.parse_args()
+    
+    if args.database:
+        askme.DATABASE = args.database
+    if args.folder:
+        askme.SHARD_FOLDER = args.folder
+    if args.command == 'split':
+        split(args.force)
+    else:
+        list_shards()
+
+if __name__ == '__main__':
+    main()
@@ -66,6 +66,153 @@ function switchLanguage(lang) {
     });
 }
 
+// Build a chat bubble matching the server-rendered markup
+function renderMessage(message) {
+    const isAdmin = message.sender_type === 'admin';
+    
+    const wrapper = document.createElement('div');
+    wrapper.className = 'message mb-2' + (isAdmin ? ' text-end' : '');
+    wrapper.dataset.messageId = message.id;
+    
+    const bubble = document.createElement('div');
+    bubble.className = 'd-inline-block p-2 rounded ' + (isAdmin ? 'bg-primary text-white' : 'bg-light');
+    bubble.style.maxWidth = '70%';
+    
+    const sender = document.createElement('strong');
+    sender.textContent = message.sender_name + ':';
+    const time = document.createElement('small');
+    time.className = isAdmin ? 'text-light' : 'text-muted';
+    time.textContent = message.created_at;
+    
+    bubble.append(sender, document.createElement('br'), message.message,
+                  document.createElement('br'), time);
+    wrapper.appendChild(bubble);
+    return wrapper;
+}
+
+// Append a message to its conversation, ignoring ones already shown
+function appendMessage(message) {
+    const container = document.querySelector(`.chat-container[data-request-id="${message.request_id}"]`);
+    if (!container || container.querySelector(`[data-message-id="${message.id}"]`)) {
+        return;
+    }
+    
+    const placeholder = container.querySelector('.chat-empty');
+    if (placeholder) {
+        placeholder.remove();
+    }
+    
+    container.appendChild(renderMessage(message));
+    container.scrollTop = container.scrollHeight;
+}
+
+// Send chat replies in the background instead of reloading the page.
+// Listens on the document so that forms loaded later as fragments work too.
+function initChatForms() {
+    document.addEventListener('submit', function(event) {
+        const form = event.target.closest('form.chat-form');
+        if (!form) {
+            return;
+        }
+        event.preventDefault();
+        
+        fetch(form.action, {
+            method: 'POST',
+            body: new FormData(form),
+            headers: { 'Accept': 'application/json' }
+        }).then(response => {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        }).then(data => {
+            // A repeated message comes back as the first one, or null while
+            // that is still being saved
+            if (data.message) {
+                appendMessage(data.message);
+            }
+            form.reset();
+        }).catch(error => {
+            console.error('Error sending message:', error);
+        });
+    });
+}
+
+// Fetch an HTML fragment; the browser revalidates it with its ETag
+function loadFragment(url) {
+    return fetch(url, { headers: { 'Accept': 'text/html' } }).then(response => {
+        if (!response.ok) {
+            throw new Error(response.statusText);
+        }
+        return response.text();
+    });
+}
+
+// Load admin conversations when their card is expanded, and edit forms when opened
+function initFragments() {
+    document.addEventListener('show.bs.collapse', function(event) {
+        const target = event.target;
+        if (!target.dataset.fragmentUrl || target.dataset.fragmentLoaded) {
+            return;
+        }
+        target.dataset.fragmentLoaded = 'true';
+        
+        loadFragment(target.dataset.fragmentUrl).then(html => {
+            target.innerHTML = html;
+            target.querySelectorAll('.chat-container').forEach(container => {
+                container.scrollTop = container.scrollHeight;
+            });
+        }).catch(error => {
+            delete target.dataset.fragmentLoaded;
+            console.error('Error loading conversation:', error);
+        });
+    });
+    
+    document.addEventListener('click', function(event) {
+        const button = event.target.closest('[data-fragment-modal]');
+        const container = document.getElementById('requestModalContainer');
+        if (!button || !container) {
+            return;
+        }
+        
+        loadFragment(button.dataset.fragmentModal).then(html => {
+            container.innerHTML = html;
+            new bootstrap.Modal(container.querySelector('.modal')).show();
+        }).catch(error => {
+            console.error('Error loading edit form:', error);
+        });
+    });
+}
+
+// "Select all" checkboxes for the admin bulk actions
+function initSelectAll() {
+    document.querySelectorAll('[data-select-all]').forEach(toggle => {
+        toggle.addEventListener('change', () => {
+            document.querySelectorAll(`input[type="checkbox"][name="${toggle.dataset.selectAll}"]`).forEach(box => {
+                box.checked = toggle.checked;
+            });
+        });
+    });
+}
+
+// Subscribe to the page's Server-Sent Events stream of new messages
+function initMessageStream() {
+    const streamRoot = document.querySelector('[data-message-stream]');
+    if (!streamRoot || !window.EventSource) {
+        return;
+    }
+    
+    let lastId = parseInt(streamRoot.dataset.messageAfter || '0', 10);
+    document.querySelectorAll('[data-message-id]').forEach(element => {
+        lastId = Math.max(lastId, parseInt(element.dataset.messageId, 10));
+    });
+    
+    const source = new EventSource(streamRoot.dataset.messageStream + '?after=' + lastId);
+    source.addEventListener('message', event => {
+        appendMessage(JSON.parse(event.data));
+    });
+}
+
 // Initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     // Theme is already set by the server-side script in the template
@@ -76,4 +223,9 @@ document.addEventListener('DOMContentLoaded', function() {
         // Scroll to bottom when new messages are added
         container.scrollTop = container.scrollHeight;
     });
+    
+    initChatForms();
+    initFragments();
+    initSelectAll();
+    initMessageStream();
 });
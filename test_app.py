@@ -2,12 +2,52 @@
 
 import sys
 import os
+import tempfile
+import shutil
+import re
+import logging
+import io
+import gzip
+import posixpath
+import json
+import time
 
 # Add the current directory to the Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+import app as askme
+import shards
 from app import app, init_db
 
+def clear_caches():
+    """Forget everything cached about the previous database"""
+    askme.preferences_cache.clear()
+    askme.page_cache.clear()
+    askme.data_versions.clear()
+    askme.recent_submissions.clear()
+    askme.rate_limits.clear()
+
+def use_temp_database():
+    """Point the application at a fresh, empty database and return the previous path"""
+    original_database = askme.DATABASE
+    askme.DATABASE = os.path.join(tempfile.mkdtemp(), 'askme.db')
+    clear_caches()
+    init_db()
+    return original_database
+
+def remove_temp_database(original_database):
+    """Drop the temporary database and point the application back at the original"""
+    askme.stop_writer()
+    askme.wait_for_summaries()
+    for worker in (askme.deletion_worker, askme.archive_worker):
+        if worker is not None:
+            worker.join()
+    askme.close_shards()
+    askme.get_pool().close()
+    shutil.rmtree(os.path.dirname(askme.DATABASE))
+    clear_caches()
+    askme.DATABASE = original_database
+
 def test_app():
     """Simple test to verify the application works"""
     
@@ -91,5 +131,1303 @@ def test_app():
         print("3. Visit http://localhost:5000")
         print("4. Admin login: http://localhost:5000/admin/login (admin/admin123)")
 
+def test_admin_dashboard_pagination():
+    """The dashboard pages through projects and requests with keyset cursors"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        for i in range(askme.DASHBOARD_PROJECTS_PER_PAGE + 5):
+            conn.execute('INSERT INTO projects (name) VALUES (?)', (f'Project {i:03d}',))
+        for i in range(askme.DASHBOARD_REQUESTS_PER_PROJECT + 3):
+            cursor = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title) 
+                VALUES (1, 'user', '127.0.0.1', ?)
+            ''', (f'Request {i:03d}',))
+            conn.execute('''
+                INSERT INTO messages (request_id, sender_type, sender_name, message) 
+                VALUES (?, 'user', 'user', ?)
+            ''', (cursor.lastrowid, f'Message {i:03d}'))
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            
+            response = client.get('/admin')
+            assert b'Project 019' in response.data
+            assert b'Project 020' not in response.data
+            assert b'after=20' in response.data
+            # Newest requests first, oldest ones on the next page
+            assert b'Request 022' in response.data
+            assert b'Request 002' not in response.data
+            
+            response = client.get('/admin?after=20')
+            assert b'Project 020' in response.data
+            assert b'Project 019' not in response.data
+            
+            response = client.get('/admin?project=1&requests_after=4')
+            assert b'Request 002' in response.data
+            assert b'Request 000' in response.data
+            assert b'Request 003' not in response.data
+    finally:
+        remove_temp_database(original_database)
+
+def test_route_queries_use_indexes():
+    """Every lookup issued by the routes is answered from an index, not a table SCAN"""
+    original_get_db = askme.get_db
+    original_database = use_temp_database()
+    statements = []
+    
+    def traced_get_db():
+        conn = original_get_db()
+        conn.set_trace_callback(statements.append)
+        return conn
+    
+    askme.get_db = traced_get_db
+    try:
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            client.post('/admin/project/create', data={'name': 'Indexed', 'description': ''})
+            client.post('/admin/project/1/edit', data={'name': 'Indexed', 'description': 'x'})
+            client.get('/')
+            client.post('/project/1/request', data={'title': 'Hello', 'description': 'First'})
+            client.post('/request/1/message', data={'message': 'Second'})
+            client.get('/project/1')
+            client.get('/request/1/messages?after=1')
+            client.get('/admin')
+            client.get('/admin?project=1&requests_after=1')
+            client.get('/admin?tag=bug&status=pending')
+            client.get('/admin/request/1/conversation')
+            client.get('/admin/request/1/edit')
+            client.get('/admin/search?q=hello&project=1&status=pending')
+            client.post('/admin/request/1/message', data={'message': 'Reply'})
+            client.get('/admin/inbox')
+            client.get('/admin/inbox?before=1')
+            client.post('/admin/inbox/1/read')
+            client.post('/admin/request/1/update', data={'status': 'approved', 'tags': 'bug'})
+            client.post('/admin/requests/bulk', data={'action': 'tags', 'set_tags': 'bug', 'scope': 'selected',
+                                                      'request_id': '1'})
+            client.post('/admin/requests/bulk', data={'action': 'status', 'set_status': 'approved',
+                                                      'scope': 'filter', 'project': 1, 'tag': 'bug',
+                                                      'status': 'pending', 'user_ip': '127.0.0.1'})
+            client.post('/preferences', data={'nickname': 'Tester'})
+            client.post('/admin/project/1/toggle_lock')
+            client.post('/admin/request/1/delete')
+            client.post('/admin/project/1/delete')
+        
+        conn = original_get_db()
+        conn.execute('CREATE TEMP TABLE bulk_requests (id INTEGER PRIMARY KEY)')
+        checked = 0
+        for statement in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()
+            for row in plan:
+                # Listing every project name (filter drop-downs) from its index is fine
+                if row['detail'].startswith('SCAN projects USING COVERING INDEX'):
+                    continue
+                # The inbox walks its partial index newest first and stops after a page
+                if row['detail'].startswith('SCAN r USING INDEX idx_requests_inbox'):
+                    continue
+                assert not re.match(r'SCAN (projects|requests|messages|user_preferences)\b', row['detail']), \
+                    f"{row['detail']} in: {statement}"
+            checked += 1
+        conn.close()
+        assert checked > 0
+    finally:
+        askme.get_db = original_get_db
+        remove_temp_database(original_database)
+
+def test_request_scoped_pooled_connection():
+    """A request reuses one pooled, WAL-mode connection that goes back to the pool"""
+    original_database = use_temp_database()
+    try:
+        with app.test_request_context('/'):
+            conn = askme.get_db()
+            assert askme.get_db() is conn
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+        
+        # The released connection is handed to the next request
+        with app.test_request_context('/'):
+            assert askme.get_db() is conn
+    finally:
+        remove_temp_database(original_database)
+
+def test_preferences_cache():
+    """Anonymous reads are served from the cache and never insert rows"""
+    original_database = use_temp_database()
+    try:
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            client.get('/')
+            client.get('/')
+            assert askme.preferences_cache.misses == 1
+            assert askme.preferences_cache.hits >= 1
+            
+            conn = askme.get_db()
+            assert conn.execute('SELECT COUNT(*) FROM user_preferences').fetchone()[0] == 0
+            conn.close()
+            
+            # A change is written through and the next read sees it
+            client.post('/preferences', data={'nickname': 'Ada', 'theme': 'dark'})
+            prefs = askme.get_user_preferences('127.0.0.1')
+            assert prefs['custom_nickname'] == 'Ada'
+            assert prefs['theme'] == 'dark'
+            conn = askme.get_db()
+            assert conn.execute('SELECT COUNT(*) FROM user_preferences').fetchone()[0] == 1
+            conn.close()
+    finally:
+        remove_temp_database(original_database)
+
+def test_incremental_messages_and_events():
+    """New messages are available as JSON and as an event stream, with the usual access rules"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Live')")
+        conn.execute('''
+            INSERT INTO requests (project_id, username, user_ip, title) 
+            VALUES (1, 'someone', '10.0.0.9', 'Not yours')
+        ''')
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            client.post('/project/1/request', data={'title': 'Chat', 'description': 'Hello'})
+            response = client.post('/request/2/message', data={'message': 'Second'},
+                                   headers={'Accept': 'application/json'})
+            assert response.status_code == 201
+            second_id = response.get_json()['message']['id']
+            
+            data = client.get('/request/2/messages').get_json()
+            assert [m['message'] for m in data['messages']] == ['Hello', 'Second']
+            data = client.get(f'/request/2/messages?after={second_id}').get_json()
+            assert data['messages'] == [] and data['last_id'] == second_id
+            
+            # Other users' requests stay hidden
+            assert client.get('/request/1/messages').status_code == 404
+            assert client.get('/request/1/events').status_code == 404
+            
+            response = client.get('/project/1/events')
+            assert response.mimetype == 'text/event-stream'
+            chunk = next(response.response)
+            assert chunk.startswith(f'id: {second_id - 1}\nevent: message\n'.encode())
+            response.close()
+            
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            assert client.get('/request/1/messages').status_code == 200
+    finally:
+        remove_temp_database(original_database)
+
+def test_full_text_search():
+    """Existing rows are backfilled into the search index and new ones are kept in sync"""
+    original_database = askme.DATABASE
+    askme.DATABASE = os.path.join(tempfile.mkdtemp(), 'askme.db')
+    clear_caches()
+    try:
+        # A database created before full-text search existed
+        conn = askme.connect_db()
+        for migration in askme.MIGRATIONS[:3]:
+            migration(conn.cursor())
+        conn.execute('PRAGMA user_version = 3')
+        conn.execute("INSERT INTO projects (name) VALUES ('Alpha'), ('Beta')")
+        conn.execute('''
+            INSERT INTO requests (project_id, username, user_ip, title, description) 
+            VALUES (1, 'u', '127.0.0.1', 'Login page crashes', 'Stack trace attached')
+        ''')
+        conn.execute('''
+            INSERT INTO messages (request_id, sender_type, sender_name, message) 
+            VALUES (1, 'user', 'u', 'It happens with <script> in the password')
+        ''')
+        conn.commit()
+        askme.migrate_db(conn)
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            client.post('/project/2/request', data={'title': 'Dark theme', 'description': 'Password field unreadable'})
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            
+            response = client.get('/admin/search?q=crash')
+            assert b'Login page crashes' in response.data
+            
+            # Matches in messages, highlighted and escaped
+            response = client.get('/admin/search?q=password')
+            assert b'Login page crashes' in response.data
+            assert b'Dark theme' in response.data
+            assert b'<mark>password</mark>' in response.data
+            assert b'&lt;script&gt;' in response.data
+            
+            response = client.get('/admin/search?q=password&project=2')
+            assert b'Login page crashes' not in response.data
+            assert b'Dark theme' in response.data
+            
+            response = client.get('/admin/search?q=password&status=approved')
+            assert b'No requests match' in response.data
+            
+            # FTS5 syntax in the query is treated as plain text
+            assert client.get('/admin/search?q=%22AND+(*').status_code == 200
+            
+            client.post('/admin/request/1/delete')
+            response = client.get('/admin/search?q=crash')
+            assert b'Login page crashes' not in response.data
+    finally:
+        remove_temp_database(original_database)
+
+def test_request_tags_and_facets():
+    """Tags are normalized into request_tags and drive the dashboard filters and counts"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Tracker')")
+        for title in ['Crash on save', 'Add dark mode', 'Typo in footer']:
+            conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title) 
+                VALUES (1, 'u', '127.0.0.1', ?)
+            ''', (title,))
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            client.post('/admin/request/1/update', data={'status': 'pending', 'tags': 'Bug, urgent, bug'})
+            client.post('/admin/request/2/update', data={'status': 'approved', 'tags': 'feature'})
+            client.post('/admin/request/3/update', data={'status': 'approved', 'tags': 'bug'})
+            
+            conn = askme.get_db()
+            tags = conn.execute('SELECT request_id, tag FROM request_tags ORDER BY request_id, tag').fetchall()
+            assert [tuple(row) for row in tags] == [(1, 'bug'), (1, 'urgent'), (2, 'feature'), (3, 'bug')]
+            assert conn.execute('SELECT tags FROM requests WHERE id = 1').fetchone()[0] == 'bug, urgent'
+            
+            facets = askme.get_request_facets(conn, [1])[1]
+            assert facets['statuses'] == {'pending': 1, 'approved': 2}
+            assert facets['tags'] == {'bug': 2, 'feature': 1, 'urgent': 1}
+            conn.close()
+            
+            response = client.get('/admin?tag=bug&status=approved')
+            assert b'Typo in footer' in response.data
+            assert b'Crash on save' not in response.data
+            assert b'Add dark mode' not in response.data
+            assert b'bug: 2' in response.data
+            
+            # Deleting a request drops its tags
+            client.post('/admin/request/3/delete')
+            conn = askme.get_db()
+            assert conn.execute("SELECT COUNT(*) FROM request_tags WHERE tag = 'bug'").fetchone()[0] == 1
+            conn.close()
+    finally:
+        remove_temp_database(original_database)
+
+def test_group_commit_writer():
+    """Queued writes are group-committed, isolated from each other and flushed on stop"""
+    original_database = use_temp_database()
+    askme.WRITE_QUEUE_ENABLED = True
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Busy')")
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            client.post('/project/1/request', data={'title': 'Queued', 'description': 'First'})
+            response = client.post('/request/1/message', data={'message': 'Second'},
+                                   headers={'Accept': 'application/json'})
+            assert response.get_json()['message']['message'] == 'Second'
+        
+        def failing_write(conn):
+            conn.execute("INSERT INTO messages (request_id, sender_type, sender_name, message) VALUES (1, 'user', 'u', 'lost')")
+            raise ValueError('rejected')
+        
+        def insert(text):
+            return lambda conn: askme.insert_message(conn, 1, 'user', 'u', text)
+        
+        writer = askme.get_writer()
+        futures = [writer.submit(insert('a')), writer.submit(failing_write), writer.submit(insert('b'))]
+        askme.stop_writer()
+        
+        assert all(future.done() for future in futures)
+        assert isinstance(futures[1].exception(), ValueError)
+        conn = askme.get_db()
+        messages = [row[0] for row in conn.execute('SELECT message FROM messages ORDER BY id')]
+        conn.close()
+        assert messages == ['First', 'Second', 'a', 'b']
+        assert writer.writes == 5
+    finally:
+        askme.WRITE_QUEUE_ENABLED = False
+        remove_temp_database(original_database)
+
+def test_create_app_configuration():
+    """Settings come from the environment and the config mapping, in that order"""
+    os.environ['ASKME_DB_POOL_SIZE'] = '3'
+    os.environ['ASKME_SECRET_KEY'] = 'from-environment'
+    try:
+        configured = askme.create_app({'DATABASE': 'other.db'})
+        assert configured.config['SECRET_KEY'] == 'from-environment'
+        assert askme.DATABASE == 'other.db'
+        assert askme.DB_POOL_SIZE == 3
+        assert 'main.index' in configured.view_functions
+        
+        configured = askme.create_app({'SECRET_KEY': 'explicit'})
+        assert configured.config['SECRET_KEY'] == 'explicit'
+        
+        # Connection pragmas follow the settings; unknown values are refused
+        askme.create_app({'DATABASE': 'other.db', 'DB_SYNCHRONOUS': 'full', 'DB_JOURNAL_MODE': 'delete'})
+        conn = askme.connect_db(':memory:')
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 2
+        conn.close()
+        assert askme.DB_PRAGMAS['journal_mode'] == 'DELETE'
+        try:
+            askme.create_app({'DB_SYNCHRONOUS': 'sometimes'})
+            assert False, 'an unknown synchronous level was accepted'
+        except ValueError as error:
+            assert 'DB_SYNCHRONOUS' in str(error)
+        try:
+            askme.create_app({'RATE_LIMIT_RATE': 0})
+            assert False, 'a rate limit that never refills was accepted'
+        except ValueError as error:
+            assert 'RATE_LIMIT_RATE' in str(error)
+    finally:
+        del os.environ['ASKME_DB_POOL_SIZE']
+        del os.environ['ASKME_SECRET_KEY']
+        askme.configure_database(app.config)
+
+def test_conditional_get_and_page_cache():
+    """Public pages carry validators, answer 304 and change when their data changes"""
+    original_database = use_temp_database()
+    try:
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.get('/')
+            etag = response.headers['ETag']
+            assert response.headers['Cache-Control'] == 'private, no-cache'
+            
+            response = client.get('/', headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.data == b''
+            
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            client.post('/admin/project/create', data={'name': 'Fresh', 'description': ''})
+            with client.session_transaction() as sess:
+                sess.pop('admin')
+                sess.pop('_flashes', None)
+            
+            response = client.get('/', headers={'If-None-Match': etag})
+            assert response.status_code == 200
+            assert b'Fresh' in response.data
+            etag = response.headers['ETag']
+            
+            # Served from the page cache while nothing changes
+            hits = askme.page_cache.hits
+            assert b'Fresh' in client.get('/').data
+            assert askme.page_cache.hits == hits + 1
+            
+            # The page depends on the visitor's preferences
+            client.post('/preferences', data={'theme': 'dark'})
+            with client.session_transaction() as sess:
+                sess.pop('_flashes', None)
+            response = client.get('/', headers={'If-None-Match': etag})
+            assert response.status_code == 200
+            
+            # Project pages change when a conversation does
+            response = client.get('/project/1')
+            etag = response.headers['ETag']
+            assert client.get('/project/1', headers={'If-None-Match': etag}).status_code == 304
+            client.post('/project/1/request', data={'title': 'New thread', 'description': ''})
+            with client.session_transaction() as sess:
+                sess.pop('_flashes', None)
+            response = client.get('/project/1', headers={'If-None-Match': etag})
+            assert response.status_code == 200
+            assert b'New thread' in response.data
+    finally:
+        remove_temp_database(original_database)
+
+def test_request_fragments():
+    """The dashboard lists request headers; conversations and edit forms are cached fragments"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Fragments')")
+        conn.execute('''
+            INSERT INTO requests (project_id, username, user_ip, title) 
+            VALUES (1, 'user', '127.0.0.1', 'Lazy thread')
+        ''')
+        askme.insert_message(conn, 1, 'user', 'user', 'Hidden until expanded')
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            assert client.get('/admin/request/1/conversation').status_code == 403
+            
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            response = client.get('/admin')
+            assert b'Lazy thread' in response.data
+            assert b'Hidden until expanded' not in response.data
+            assert b'/admin/request/1/conversation' in response.data
+            
+            response = client.get('/admin/request/1/conversation')
+            assert b'Hidden until expanded' in response.data
+            etag = response.headers['ETag']
+            assert client.get('/admin/request/1/conversation',
+                              headers={'If-None-Match': etag}).status_code == 304
+            assert client.get('/admin/request/2/conversation').status_code == 404
+            
+            # Replies from either side invalidate the conversation
+            client.post('/admin/request/1/message', data={'message': 'Admin answer'})
+            response = client.get('/admin/request/1/conversation', headers={'If-None-Match': etag})
+            assert response.status_code == 200
+            assert b'Admin answer' in response.data
+            client.post('/request/1/message', data={'message': 'User follow-up'})
+            assert b'User follow-up' in client.get('/admin/request/1/conversation').data
+            
+            # Updates invalidate the edit form
+            response = client.get('/admin/request/1/edit')
+            assert b'value="pending" selected' in response.data
+            client.post('/admin/request/1/update', data={'status': 'completed', 'tags': 'docs'})
+            response = client.get('/admin/request/1/edit')
+            assert b'value="completed" selected' in response.data
+            assert b'value="docs"' in response.data
+    finally:
+        remove_temp_database(original_database)
+
+def test_metrics_endpoint_and_slow_request_log():
+    """Instrumented apps export per-route metrics and log the statements of slow requests"""
+    original_database = use_temp_database()
+    # Every application built from this module logs through the same logger
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    app.logger.addHandler(handler)
+    try:
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            assert client.get('/admin/metrics').status_code == 404
+        
+        instrumented = askme.create_app({'METRICS': True, 'SLOW_REQUEST_THRESHOLD': 1e-9, 'TESTING': True})
+        askme.metrics.clear()
+        
+        with instrumented.test_client() as client:
+            assert client.get('/admin/metrics').status_code == 403
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            client.post('/admin/project/create', data={'name': 'Measured', 'description': ''})
+            client.get('/admin')
+            
+            response = client.get('/admin/metrics')
+            assert response.mimetype == 'text/plain'
+            samples = {}
+            for line in response.get_data(as_text=True).splitlines():
+                if not line.startswith('#'):
+                    name, value = line.rsplit(' ', 1)
+                    samples[name] = float(value)
+        
+        labels = '{route="main.admin_dashboard",method="GET"}'
+        assert samples['askme_request_duration_seconds_count' + labels] == 1
+        assert samples['askme_request_duration_seconds_bucket{route="main.admin_dashboard",method="GET",le="+Inf"}'] == 1
+        assert samples['askme_sql_statements_total' + labels] >= 3
+        assert samples['askme_sql_seconds_total' + labels] > 0
+        assert samples['askme_template_render_seconds_total' + labels] > 0
+        assert samples['askme_db_lock_waits_total' + labels] == 0
+        assert samples['askme_request_duration_seconds_count{route="main.create_project",method="POST"}'] == 1
+        
+        messages = [record.getMessage() for record in records]
+        assert any('Slow request: POST /admin/project/create' in message
+                   and 'INSERT INTO projects' in message for message in messages)
+    finally:
+        app.logger.removeHandler(handler)
+        remove_temp_database(original_database)
+        askme.configure_database(app.config)
+
+def test_bulk_request_operations():
+    """Bulk actions change or delete many requests, picked by id or by filter, in one POST"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Spam target')")
+        conn.execute("INSERT INTO projects (name) VALUES ('Quiet')")
+        for i in range(1200):
+            cursor = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title) 
+                VALUES (?, 'user', ?, ?)
+            ''', (1 if i < 1100 else 2, '10.0.0.66' if i % 2 else '10.0.0.1', f'Request {i}'))
+            askme.insert_message(conn, cursor.lastrowid, 'user', 'user', f'Message {i}')
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.post('/admin/requests/bulk', data={'action': 'delete', 'scope': 'filter', 'project': 1})
+            assert response.status_code == 302 and '/admin/login' in response.location
+            
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            json_headers = {'Accept': 'application/json'}
+            
+            # More ids than SQLite allows placeholders in one statement
+            response = client.post('/admin/requests/bulk', headers=json_headers, data={
+                'action': 'status', 'set_status': 'rejected', 'scope': 'selected',
+                'request_id': [str(i) for i in range(1, 1101)] + ['99999']})
+            assert response.get_json() == {'action': 'status', 'count': 1100}
+            
+            response = client.post('/admin/requests/bulk', headers=json_headers, data={
+                'action': 'tags', 'set_tags': 'Spam, wave', 'scope': 'filter',
+                'project': 1, 'user_ip': '10.0.0.66'})
+            assert response.get_json()['count'] == 550
+            
+            # Filtering on a tag that the action replaces still hits the same rows
+            response = client.post('/admin/requests/bulk', headers=json_headers, data={
+                'action': 'tags', 'set_tags': 'spam', 'scope': 'filter', 'tag': 'wave'})
+            assert response.get_json()['count'] == 550
+            
+            response = client.post('/admin/requests/bulk', headers=json_headers, data={
+                'action': 'block', 'scope': 'filter', 'tag': 'spam', 'status': 'rejected'})
+            assert response.get_json()['count'] == 550
+            
+            response = client.post('/admin/requests/bulk', data={'action': 'delete', 'scope': 'filter'},
+                                   follow_redirects=True)
+            assert b'Set a filter before applying a bulk action to it' in response.data
+            response = client.post('/admin/requests/bulk', data={'action': 'status', 'set_status': 'bogus',
+                                                                 'scope': 'selected', 'request_id': '1'},
+                                   follow_redirects=True)
+            assert b'Choose a bulk action' in response.data
+            
+            response = client.post('/admin/requests/bulk', data={
+                'action': 'delete', 'scope': 'filter', 'project': 1, 'tag': 'spam'}, follow_redirects=True)
+            assert b'Deleted 550 request(s)' in response.data
+        
+        conn = askme.get_db()
+        counts = conn.execute('''
+            SELECT (SELECT COUNT(*) FROM requests WHERE project_id = 1),
+                   (SELECT COUNT(*) FROM requests WHERE project_id = 1 AND status = 'rejected' AND is_blocked = 0),
+                   (SELECT COUNT(*) FROM requests WHERE project_id = 2 AND status = 'pending'),
+                   (SELECT COUNT(*) FROM messages),
+                   (SELECT COUNT(*) FROM request_tags)
+        ''').fetchone()
+        conn.close()
+        assert tuple(counts) == (550, 550, 100, 650, 0)
+    finally:
+        remove_temp_database(original_database)
+
+def test_background_project_deletion():
+    """Deleting a project hides it at once and removes its rows in chunks, even after a restart"""
+    original_database = use_temp_database()
+    original_chunk_size = askme.DELETION_CHUNK_SIZE
+    askme.DELETION_CHUNK_SIZE = 2
+    try:
+        conn = askme.get_db()
+        assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+        for name in ['Doomed', 'Survivor', 'Crashed']:
+            project_id = conn.execute('INSERT INTO projects (name) VALUES (?)', (name,)).lastrowid
+            for i in range(3):
+                request_id = conn.execute('''
+                    INSERT INTO requests (project_id, username, user_ip, title, tags) 
+                    VALUES (?, 'user', '127.0.0.1', ?, 'bug')
+                ''', (project_id, f'{name} request {i}')).lastrowid
+                askme.set_request_tags(conn, request_id, ['bug'])
+                for j in range(3):
+                    askme.insert_message(conn, request_id, 'user', 'user', f'{name} message {i}.{j}')
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            
+            # Deleting a single request cascades to its messages and tags
+            client.post('/admin/request/4/delete')
+            
+            response = client.post('/admin/project/1/delete', follow_redirects=True)
+            assert b'being removed in the background' in response.data
+            assert b'Survivor' in response.data
+            assert b'Doomed' not in response.data or b'Deletions in progress' in response.data
+            assert client.get('/project/1').status_code == 302
+            response = client.post('/admin/project/create', data={'name': 'Doomed', 'description': ''},
+                                   follow_redirects=True)
+            assert b'Project created successfully' in response.data
+            
+            askme.deletion_worker.join()
+            jobs = client.get('/admin/deletions').get_json()['jobs']
+            assert jobs[0]['project_name'] == 'Doomed'
+            assert jobs[0]['finished_at'] is not None
+            assert (jobs[0]['requests_deleted'], jobs[0]['messages_deleted']) == (3, 9)
+            assert (jobs[0]['requests_total'], jobs[0]['messages_total']) == (3, 9)
+            
+            # A job left behind by a process that stopped is resumed by the next one
+            conn = askme.connect_db()
+            askme.schedule_project_deletion(conn, 3)
+            conn.close()
+            askme.deletion_resumed_pid = None
+            assert b'Crashed' not in client.get('/').data
+            askme.deletion_worker.join()
+        
+        conn = askme.connect_db()
+        counts = conn.execute('''
+            SELECT (SELECT COUNT(*) FROM projects), (SELECT COUNT(*) FROM requests), 
+                   (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM request_tags),
+                   (SELECT COUNT(*) FROM deletion_jobs WHERE finished_at IS NULL)
+        ''').fetchone()
+        conn.close()
+        # Survivor (with two of its requests) and the new Doomed project remain
+        assert tuple(counts) == (2, 2, 6, 2, 0)
+    finally:
+        askme.DELETION_CHUNK_SIZE = original_chunk_size
+        remove_temp_database(original_database)
+
+def test_dataset_export_import():
+    """The dataset survives a JSON Lines export and import, in chunks, with new ids and filters"""
+    original_database = use_temp_database()
+    original_chunk_size = askme.IMPORT_CHUNK_SIZE
+    askme.IMPORT_CHUNK_SIZE = 3
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (id, name, description) VALUES (7, 'Alpha', 'First')")
+        conn.execute("INSERT INTO projects (id, name, is_locked) VALUES (9, 'Beta', 1)")
+        for i, (project_id, created_at) in enumerate([(7, '2024-01-05 10:00:00'), (7, '2024-02-10 12:00:00'),
+                                                      (9, '2024-02-11 08:30:00')]):
+            request_id = conn.execute('''
+                INSERT INTO requests (id, project_id, username, user_ip, title, tags, created_at) 
+                VALUES (?, ?, 'user', '10.0.0.5', ?, 'bug, ui', ?)
+            ''', (100 + i, project_id, f'Request {i} caf\u00e9', created_at)).lastrowid
+            askme.set_request_tags(conn, request_id, ['bug', 'ui'])
+            for j in range(i + 1):
+                askme.insert_message(conn, request_id, 'user', 'user', f'Message {i}.{j}')
+        conn.execute("INSERT INTO user_preferences (user_ip, custom_nickname) VALUES ('10.0.0.5', 'Nick')")
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            assert client.get('/admin/export').status_code == 403
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            
+            response = client.get('/admin/export')
+            assert response.is_streamed
+            assert response.mimetype == 'application/x-ndjson'
+            export = response.get_data()
+            records = [json.loads(line) for line in export.splitlines()]
+            assert [record['type'] for record in records] == [
+                'askme', 'preferences', 'project', 'request', 'message', 'request', 'message', 'message',
+                'project', 'request', 'message', 'message', 'message']
+            
+            response = client.get('/admin/export?project=7&since=2024-02-01')
+            records = [json.loads(line) for line in response.get_data().splitlines()]
+            assert [record['type'] for record in records] == ['askme', 'project', 'request', 'message', 'message']
+            assert records[2]['id'] == 101
+        
+        remove_temp_database(original_database)
+        original_database = use_temp_database()
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Beta')")
+        conn.execute("INSERT INTO requests (project_id, username, user_ip, title) VALUES (1, 'u', '10.0.0.9', 'Local')")
+        conn.commit()
+        conn.close()
+        
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            json_headers = {'Accept': 'application/json'}
+            
+            response = client.post('/admin/import', headers=json_headers,
+                                   data={'file': (io.BytesIO(export), 'askme.jsonl')})
+            # Beta already exists here, so its request joins that project
+            assert response.get_json() == {'projects': 1, 'requests': 3, 'messages': 6, 'preferences': 1}
+            
+            conn = askme.connect_db()
+            rows = conn.execute('''
+                SELECT r.id, p.name, r.title, r.created_at, COUNT(m.id) AS messages 
+                FROM requests r JOIN projects p ON p.id = r.project_id LEFT JOIN messages m ON m.request_id = r.id 
+                GROUP BY r.id ORDER BY r.id
+            ''').fetchall()
+            assert [tuple(row) for row in rows] == [
+                (1, 'Beta', 'Local', rows[0]['created_at'], 0),
+                (2, 'Alpha', 'Request 0 caf\u00e9', '2024-01-05 10:00:00', 1),
+                (3, 'Alpha', 'Request 1 caf\u00e9', '2024-02-10 12:00:00', 2),
+                (4, 'Beta', 'Request 2 caf\u00e9', '2024-02-11 08:30:00', 3)]
+            assert conn.execute('SELECT COUNT(*) FROM request_tags').fetchone()[0] == 6
+            assert conn.execute("SELECT custom_nickname FROM user_preferences").fetchone()[0] == 'Nick'
+            conn.close()
+            
+            # Filters use the project ids of the file
+            response = client.post('/admin/import', headers=json_headers, data={
+                'file': (io.BytesIO(export), 'askme.jsonl'), 'project': '7', 'until': '2024-01-31'})
+            assert response.get_json() == {'projects': 0, 'requests': 1, 'messages': 1, 'preferences': 0}
+            
+            broken = export.split(b'\n')
+            broken.insert(4, b'{"type": "message", "id": 1, "request_id": 555}')
+            response = client.post('/admin/import', data={'file': (io.BytesIO(b'\n'.join(broken)), 'askme.jsonl')},
+                                   follow_redirects=True)
+            assert b'Import failed: line 5: message 1 does not follow its request' in response.data
+            
+            # A row the schema rejects fails its chunk, lines 4 to 6, with a 400 rather than a 500
+            broken = [json.loads(line) for line in export.splitlines()]
+            broken[3]['title'] = None
+            response = client.post('/admin/import', headers=json_headers, data={
+                'file': (io.BytesIO(''.join(json.dumps(record) + '\n' for record in broken).encode()), 'askme.jsonl')})
+            assert response.status_code == 400
+            assert response.get_json() == {
+                'error': 'Import failed: lines 4-6: NOT NULL constraint failed: requests.title'}
+            
+            # So does a project the schema rejects, before anything is committed
+            conn = askme.connect_db()
+            projects = conn.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+            response = client.post('/admin/import', headers=json_headers, data={'file': (io.BytesIO(
+                b'{"type": "askme", "version": 1}\n{"type": "project", "id": 1, "name": null}\n'), 'askme.jsonl')})
+            assert response.status_code == 400
+            assert response.get_json() == {
+                'error': 'Import failed: line 2: NOT NULL constraint failed: projects.name'}
+            assert conn.execute('SELECT COUNT(*) FROM projects').fetchone()[0] == projects
+            conn.close()
+    finally:
+        askme.IMPORT_CHUNK_SIZE = original_chunk_size
+        remove_temp_database(original_database)
+
+def test_archive_resolved_requests():
+    """Old resolved requests move to the archive, stay readable and searchable, and come back on reply"""
+    original_database = use_temp_database()
+    original_batch_size = askme.ARCHIVE_BATCH_SIZE
+    askme.ARCHIVE_BATCH_SIZE = 2
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Archived project')")
+        old = '2023-01-01 10:00:00'
+        for title, status, updated_at in [('Old completed zebra', 'completed', old),
+                                          ('Old rejected', 'rejected', old),
+                                          ('Old completed but busy', 'completed', old),
+                                          ('Old pending', 'pending', old),
+                                          ('Fresh completed', 'completed', None),
+                                          ('Old completed other user', 'completed', old)]:
+            request_id = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title, status, tags, created_at, updated_at) 
+                VALUES (1, 'user', ?, ?, ?, 'bug', COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+            ''', ('10.0.0.2' if 'other' in title else '127.0.0.1', title, status, updated_at, updated_at)).lastrowid
+            askme.set_request_tags(conn, request_id, ['bug'])
+            message_id = askme.insert_message(conn, request_id, 'user', 'user', f'About the {title.lower()}')
+            if 'busy' not in title:
+                conn.execute('UPDATE messages SET created_at = ? WHERE id = ?', (old, message_id))
+        conn.commit()
+        
+        assert askme.archive_resolved_requests(conn) == 3
+        assert askme.archive_resolved_requests(conn) == 0
+        assert [row[0] for row in conn.execute('SELECT id FROM requests ORDER BY id')] == [3, 4, 5]
+        assert [row[0] for row in conn.execute('SELECT id FROM archive.requests ORDER BY id')] == [1, 2, 6]
+        assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 3
+        assert conn.execute('SELECT COUNT(*) FROM archive.messages').fetchone()[0] == 3
+        assert conn.execute('SELECT COUNT(*) FROM request_tags').fetchone()[0] == 3
+        assert askme.search_requests(conn, 'zebra') == []
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            # Users see their own archived requests only when they ask for them
+            assert b'Old completed zebra' not in client.get('/project/1').data
+            page = client.get('/project/1?archived=1').data
+            assert b'Old completed zebra' in page and b'Archived</span>' in page
+            assert b'other user' not in page
+            
+            # A reply over the rate limit leaves the request archived
+            while not askme.rate_limits.take('127.0.0.1', float(app.config['RATE_LIMIT_BURST']),
+                                             float(app.config['RATE_LIMIT_RATE'])):
+                pass
+            assert client.post('/request/1/message', data={'message': 'Too soon'}).status_code == 429
+            conn = askme.connect_db()
+            assert conn.execute('SELECT COUNT(*) FROM requests WHERE id = 1').fetchone()[0] == 0
+            conn.close()
+            askme.rate_limits.clear()
+            
+            # Replying brings the conversation back with its history and tags
+            response = client.post('/request/1/message', data={'message': 'Still broken'},
+                                   headers={'Accept': 'application/json'})
+            assert response.status_code == 201
+            response = client.post('/request/6/message', data={'message': 'Not mine'})
+            assert response.status_code == 302 and response.location.endswith('/')
+            conn = askme.connect_db()
+            messages = conn.execute('SELECT message FROM messages WHERE request_id = 1 ORDER BY id').fetchall()
+            assert [row[0] for row in messages] == ['About the old completed zebra', 'Still broken']
+            assert conn.execute('SELECT tag FROM request_tags WHERE request_id = 1').fetchone()[0] == 'bug'
+            assert [row['id'] for row in askme.search_requests(conn, 'zebra')] == [1]
+            conn.close()
+            
+            assert client.get('/admin/archive').status_code == 302
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            
+            page = client.get('/admin/archive').data
+            assert b'Old rejected' in page and b'Old completed zebra' not in page
+            page = client.get('/admin/archive?q=rejected').data
+            assert b'<mark>rejected</mark>' in page
+            page = client.get('/admin/archive/2/conversation').data
+            assert b'About the old rejected' in page
+            assert client.get('/admin/archive/1/conversation').status_code == 404
+            
+            response = client.post('/admin/archive/2/restore', follow_redirects=True)
+            assert b'Request restored from the archive' in response.data
+            
+            # Archived rows are exported, and deleted with their project
+            export = client.get('/admin/export').get_data()
+            assert export.count(b'"type": "request"') == 6
+            
+            response = client.post('/admin/archive/run', follow_redirects=True)
+            assert b'in the background' in response.data
+            askme.archive_worker.join()
+            
+            client.post('/admin/project/1/delete')
+            askme.deletion_worker.join()
+            jobs = client.get('/admin/deletions').get_json()['jobs']
+            assert (jobs[0]['requests_deleted'], jobs[0]['requests_total']) == (6, 6)
+        
+        conn = askme.connect_db()
+        askme.attach_archive(conn)
+        assert conn.execute('''
+            SELECT (SELECT COUNT(*) FROM requests) + (SELECT COUNT(*) FROM archive.requests) 
+                   + (SELECT COUNT(*) FROM archive.messages)
+        ''').fetchone()[0] == 0
+        conn.close()
+    finally:
+        askme.ARCHIVE_BATCH_SIZE = original_batch_size
+        remove_temp_database(original_database)
+
+def test_activity_counters_and_inbox():
+    """Triggers keep the activity counters exact, and the inbox lists unread conversations by activity"""
+    original_database = use_temp_database()
+    original_per_page = askme.INBOX_PER_PAGE
+    askme.INBOX_PER_PAGE = 2
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Counted')")
+        for title in ['First', 'Second', 'Third']:
+            conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title) VALUES (1, 'user', '127.0.0.1', ?)
+            ''', (title,))
+        ids = [askme.insert_message(conn, request_id, 'user', 'user', f'Message {request_id}')
+               for request_id in (1, 2, 3, 1)]
+        reply_id = askme.insert_message(conn, 2, 'admin', 'Admin', 'Reply')
+        conn.execute("UPDATE requests SET status = 'approved' WHERE id = 3")
+        conn.commit()
+        
+        counters = conn.execute('''
+            SELECT id, message_count, last_message_id, last_sender_type, last_user_message_id 
+            FROM requests ORDER BY id
+        ''').fetchall()
+        assert [tuple(row) for row in counters] == [(1, 2, ids[3], 'user', ids[3]),
+                                                    (2, 2, reply_id, 'admin', ids[1]),
+                                                    (3, 1, ids[2], 'user', ids[2])]
+        assert askme.get_request_facets(conn, [1])[1]['statuses'] == {'pending': 2, 'approved': 1}
+        
+        # Deleting the last message falls back to the one before it
+        conn.execute('DELETE FROM messages WHERE id = ?', (ids[3],))
+        conn.commit()
+        row = conn.execute('SELECT message_count, last_message_id FROM requests WHERE id = 1').fetchone()
+        assert tuple(row) == (1, ids[0])
+        conn.execute("UPDATE messages SET created_at = '2024-01-0' || request_id")
+        conn.execute("UPDATE requests SET last_message_at = '2024-01-0' || id")
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            assert client.get('/admin/inbox').status_code == 302
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+                sess['admin_name'] = 'alice'
+            
+            # Newest activity first, a page at a time
+            page = client.get('/admin/inbox').get_data(as_text=True)
+            assert page.index('Third') < page.index('Second') and 'First' not in page
+            assert 'before=2' in page
+            page = client.get('/admin/inbox?before=2').get_data(as_text=True)
+            assert 'First' in page and 'Third' not in page and 'before=' not in page
+            
+            # Opening, replying to or marking a conversation reads it, for this admin only
+            client.get('/admin/request/3/conversation')
+            client.post('/admin/request/2/message', data={'message': 'Done'})
+            response = client.post('/admin/inbox/1/read', headers={'Accept': 'application/json'})
+            assert response.get_json() == {'request_id': 1}
+            assert 'No unread conversations' in client.get('/admin/inbox').get_data(as_text=True)
+            
+            conn = askme.connect_db()
+            assert len(askme.get_inbox(conn, 'bob')) == 3
+            askme.insert_message(conn, 3, 'user', 'user', 'One more thing')
+            conn.commit()
+            assert [row['id'] for row in askme.get_inbox(conn, 'alice')] == [3]
+            conn.close()
+            
+            page = client.get('/admin').get_data(as_text=True)
+            assert 'Awaiting reply' in page and 'Pending: 2' in page
+    finally:
+        askme.INBOX_PER_PAGE = original_per_page
+        remove_temp_database(original_database)
+
+def test_rate_limits_and_duplicate_submissions():
+    """User writes are limited per IP and project, and repeated submissions are stored once"""
+    original_database = use_temp_database()
+    original_config = dict(app.config)
+    app.config.update(RATE_LIMIT_BURST=4, RATE_LIMIT_RATE=0.01,
+                      RATE_LIMIT_PROJECT_BURST=2, RATE_LIMIT_PROJECT_RATE=0.01)
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name) VALUES ('Limited')")
+        conn.execute("INSERT INTO projects (name) VALUES ('Other')")
+        conn.commit()
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            # A double-submitted form creates one request; the repeat still takes a token
+            for _ in range(2):
+                response = client.post('/project/1/request', data={'title': 'Twice', 'description': 'Same'})
+                assert response.status_code == 302
+            response = client.post('/project/1/request', data={'title': 'Third', 'description': ''})
+            assert response.status_code == 429
+            assert response.headers['Retry-After'] == '100'
+            
+            # The project bucket is spent, and the IP bucket has one token left
+            response = client.post('/project/2/request', data={'title': 'Elsewhere', 'description': ''})
+            assert response.status_code == 302
+            response = client.post('/preferences', data={'nickname': 'Spammer'},
+                                   headers={'Accept': 'application/json'})
+            assert response.status_code == 429 and response.get_json()['retry_after'] == 100
+            
+            # Other IPs and admins are not affected
+            response = client.post('/preferences', data={'nickname': 'Other'},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.9'})
+            assert response.status_code == 302
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            assert client.post('/preferences', data={'theme': 'dark'}).status_code == 302
+        
+        conn = askme.connect_db()
+        titles = [row[0] for row in conn.execute('SELECT title FROM requests ORDER BY id')]
+        assert titles == ['Twice', 'Elsewhere']
+        assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+        conn.close()
+        
+        # A repeated message returns the first one instead of adding another
+        app.config.update(RATE_LIMIT=False)
+        with app.test_client() as client:
+            first = client.post('/request/1/message', data={'message': 'Hello?'},
+                                headers={'Accept': 'application/json'})
+            second = client.post('/request/1/message', data={'message': 'Hello?'},
+                                 headers={'Accept': 'application/json'})
+            assert first.status_code == 201 and second.status_code == 200
+            assert first.get_json() == second.get_json()
+            askme.recent_submissions.clear()
+            assert client.post('/request/1/message', data={'message': 'Hello?'}).status_code == 302
+        conn = askme.connect_db()
+        assert conn.execute('SELECT message_count FROM requests WHERE id = 1').fetchone()[0] == 3
+        conn.execute('''
+            INSERT INTO requests (project_id, username, user_ip, title) VALUES (2, 'user', '10.0.0.7', 'Chatty')
+        ''')
+        conn.commit()
+        conn.close()
+        
+        # Each message takes one token from the IP's bucket, so a full bucket allows burst messages
+        app.config.update(RATE_LIMIT=True, RATE_LIMIT_PROJECT_BURST=0)
+        askme.rate_limits.clear()
+        with app.test_client() as client:
+            for i in range(4):
+                response = client.post('/request/3/message', data={'message': f'Message {i}'},
+                                       environ_base={'REMOTE_ADDR': '10.0.0.7'})
+                assert response.status_code == 302
+            response = client.post('/request/3/message', data={'message': 'One too many'},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.7'})
+            assert response.status_code == 429
+        
+        # Idle buckets are dropped once full again, and memory stays bounded
+        buckets = askme.TokenBuckets(max_entries=3)
+        for ip in ['a', 'b', 'c', 'd']:
+            assert buckets.take(ip, 1, 0.01) == 0
+        assert len(buckets) == 3
+        assert round(buckets.take('b', 1, 0.01)) == 100
+        buckets = askme.TokenBuckets(max_entries=3)
+        buckets.take('fast', 1, 1000)
+        time.sleep(0.01)
+        buckets.take('slow', 1, 0.01)
+        assert len(buckets) == 1
+    finally:
+        app.config.clear()
+        app.config.update(original_config)
+        remove_temp_database(original_database)
+
+def test_static_assets():
+    """Assets are served under content-hashed names, gzipped, and cached for a year"""
+    original_database = use_temp_database()
+    original_assets = askme.static_assets
+    folder = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(folder, 'vendor', 'fontawesome', 'css'))
+        os.makedirs(os.path.join(folder, 'vendor', 'fontawesome', 'webfonts'))
+        with open(os.path.join(folder, 'vendor', 'fontawesome', 'css', 'all.min.css'), 'w') as f:
+            f.write('.fa{src:url(../webfonts/fa-solid-900.woff2) format("woff2"),url("data:,x")}' * 20)
+        with open(os.path.join(folder, 'vendor', 'fontawesome', 'webfonts', 'fa-solid-900.woff2'), 'wb') as f:
+            f.write(os.urandom(512))
+        askme.static_assets = askme.StaticAssets(folder)
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            # Vendored files are used once they are there; missing ones come from the CDN
+            page = client.get('/').get_data(as_text=True)
+            css_url = re.search(r'href="(/assets/vendor/fontawesome/css/all\.min\.[0-9a-f]{12}\.css)"', page).group(1)
+            assert askme.VENDOR_ASSETS['vendor/bootstrap/css/bootstrap.min.css'] in page
+            
+            response = client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+            assert response.headers['Vary'] == 'Accept-Encoding'
+            css = gzip.decompress(response.data).decode()
+            
+            # Stylesheets refer to fonts by their hashed names too
+            font_url = re.search(r'url\((\.\./webfonts/fa-solid-900\.[0-9a-f]{12}\.woff2)\)', css).group(1)
+            assert 'url("data:,x")' in css
+            response = client.get(posixpath.normpath(posixpath.join(posixpath.dirname(css_url), font_url)),
+                                  headers={'Accept-Encoding': 'gzip'})
+            assert response.status_code == 200 and 'Content-Encoding' not in response.headers
+            
+            etag = client.get(css_url).headers['ETag']
+            assert client.get(css_url, headers={'If-None-Match': etag}).status_code == 304
+            
+            # Plain names still work, but must be revalidated
+            response = client.get('/assets/vendor/fontawesome/css/all.min.css')
+            assert response.headers['Cache-Control'] == 'no-cache'
+            assert client.get('/assets/vendor/missing.css').status_code == 404
+    finally:
+        askme.static_assets = original_assets
+        shutil.rmtree(folder)
+        remove_temp_database(original_database)
+
+def test_streamed_and_compressed_pages():
+    """Big pages stream from their cursors, and text responses are gzipped when the client accepts it"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        conn.execute("INSERT INTO projects (name, description) VALUES ('Streamed', 'A busy project')")
+        for number in range(1, 31):
+            request_id = conn.execute('''
+                INSERT INTO requests (project_id, username, user_ip, title, created_at) 
+                VALUES (1, 'user', '127.0.0.1', ?, ?)
+            ''', (f'Request number {number}', f'2024-01-{number:02d}')).lastrowid
+            for reply in range(3):
+                askme.insert_message(conn, request_id, 'user' if reply % 2 == 0 else 'admin', 'someone',
+                                     f'Reply {reply} to request {number}')
+        conn.commit()
+        conn.close()
+        
+        # Outside `with`, the test client does not keep request contexts, so pages stream
+        app.config['TESTING'] = True
+        client = app.test_client()
+        response = client.get('/project/1', headers={'Accept-Encoding': 'gzip'})
+        # Streamed bodies have no Content-Length
+        assert response.headers['Content-Encoding'] == 'gzip' and 'Content-Length' not in response.headers
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert response.headers['ETag'].startswith('W/')
+        page = gzip.decompress(response.data).decode()
+        assert 'Total Requests:</strong> 30' in page
+        assert page.index('Request number 30') < page.index('Request number 10')
+        assert page.index('Reply 0 to request 7') < page.index('Reply 1 to request 7') < page.index('Reply 2 to request 7')
+        
+        # The streamed page was cached on the way out, and weak tags revalidate
+        response = client.get('/project/1')
+        assert 'Content-Length' in response.headers and response.get_data(as_text=True) == page
+        assert client.get('/project/1', headers={'If-None-Match': f'W/"{response.get_etag()[0]}"'}).status_code == 304
+        
+        # Pages that show a flashed message are rendered whole, so the message is shown once
+        response = client.post('/project/1/request', data={'title': 'Flashed', 'description': ''},
+                               follow_redirects=True)
+        assert 'Content-Length' in response.headers and b'Request submitted successfully' in response.data
+        assert b'Request submitted successfully' not in client.get('/project/1').data
+        
+        with client.session_transaction() as sess:
+            sess['admin'] = True
+        response = client.get('/admin', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Length' not in response.headers
+        page = gzip.decompress(response.data).decode()
+        assert 'Request number 30' in page and 'editProjectModal1' in page
+        response = client.get('/admin')
+        assert 'Content-Encoding' not in response.headers and b'Request number 30' in response.data
+        
+        # Small streamed chunks, like export lines, are flushed together rather than one by one
+        lines = [f'{{"type": "message", "id": {i}}}\n' for i in range(2000)]
+        parts = list(askme.gzip_chunks(iter(lines)))
+        assert 1 < len(parts) < 10
+        assert gzip.decompress(b''.join(parts)).decode() == ''.join(lines)
+        
+        # Small responses are not worth compressing
+        response = client.get('/request/1/messages?after=2', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers and response.get_json()['messages']
+        
+        # Metrics take in the rendering and queries of a streamed page, which run after the view returns
+        instrumented = askme.create_app({'METRICS': True, 'TESTING': True})
+        askme.metrics.clear()
+        client = instrumented.test_client()
+        with client.session_transaction() as sess:
+            sess['admin'] = True
+        response = client.get('/admin')
+        assert response.is_streamed and b'Request number 30' in response.data
+        # Servers close the body once it is sent; the test client leaves that to the caller
+        response.close()
+        samples = dict(line.rsplit(' ', 1) for line in askme.metrics.render().splitlines()
+                       if not line.startswith('#'))
+        labels = '{route="main.admin_dashboard",method="GET"}'
+        assert samples['askme_request_duration_seconds_count' + labels] == '1'
+        assert float(samples['askme_template_render_seconds_total' + labels]) > 0
+        assert float(samples['askme_sql_seconds_total' + labels]) > 0
+    finally:
+        remove_temp_database(original_database)
+        askme.configure_database(app.config)
+
+def test_sharded_storage():
+    """Split into shards, each project's requests live in a file of their own behind the same routes"""
+    original_database = use_temp_database()
+    try:
+        conn = askme.get_db()
+        for name in ['North', 'South']:
+            project_id = conn.execute('INSERT INTO projects (name) VALUES (?)', (name,)).lastrowid
+            for i in range(2):
+                request_id = conn.execute('''
+                    INSERT INTO requests (project_id, username, user_ip, title, tags) 
+                    VALUES (?, 'user', '127.0.0.1', ?, 'bug')
+                ''', (project_id, f'{name} walrus {i}')).lastrowid
+                askme.set_request_tags(conn, request_id, ['bug'])
+                askme.insert_message(conn, request_id, 'user', 'user', f'{name} question {i}')
+        conn.commit()
+        conn.close()
+        
+        shards.split()
+        assert askme.SHARDS_ENABLED
+        # Ids move into their project's range, and the catalog keeps no requests
+        north, south = (1 << askme.SHARD_ID_BITS), (2 << askme.SHARD_ID_BITS)
+        conn = askme.connect_db(askme.shard_path(2))
+        rows = conn.execute('SELECT id, message_count, last_user_message_id FROM requests ORDER BY id').fetchall()
+        assert [tuple(row) for row in rows] == [(south + 3, 1, south + 3), (south + 4, 1, south + 4)]
+        assert conn.execute('SELECT COUNT(*) FROM request_tags').fetchone()[0] == 2
+        conn.close()
+        conn = askme.connect_db()
+        assert conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0] == 0
+        conn.close()
+        
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            page = client.get('/project/1').get_data(as_text=True)
+            assert 'North walrus 1' in page and 'South' not in page
+            client.post('/project/2/request', data={'title': 'South news', 'description': 'Fresh'})
+            
+            with client.session_transaction() as sess:
+                sess['admin'] = True
+            json_headers = {'Accept': 'application/json'}
+            events = client.get('/admin/events')
+            # The stream starts at the newest message of every shard
+            assert next(events.response) == b': keepalive\n\n'
+            response = client.post(f'/admin/request/{north + 1}/message', data={'message': 'Reply'},
+                                   headers=json_headers)
+            assert response.status_code == 201 and response.get_json()['message']['id'] == north + 3
+            assert next(events.response).startswith(f'id: {north + 3}\n'.encode())
+            events.close()
+            
+            # Cross-project views fan out over the shards and merge their results
+            askme.wait_for_summaries()
+            page = client.get('/admin').get_data(as_text=True)
+            assert 'South news' in page and 'North walrus 0' in page and 'Pending: 5' in page
+            page = client.get('/admin/inbox').get_data(as_text=True)
+            assert page.index('South news') < page.index('South walrus 1') < page.index('North walrus 1')
+            assert 'North walrus 0' not in page
+            page = client.get('/admin/search?q=walrus').get_data(as_text=True)
+            assert all(f'{name} walrus {i}' in page for name in ['North', 'South'] for i in range(2))
+            response = client.post('/admin/requests/bulk', headers=json_headers, data={
+                'action': 'status', 'set_status': 'completed', 'request_id': [north + 2, south + 3, south + 9]})
+            assert response.get_json()['count'] == 2
+            
+            # The dashboard's totals and unread badge come from the catalog's summaries of the
+            # shards, written in the background shortly after a shard changes. A pool closed to
+            # make room reopens without preparing its shard again.
+            original_pools_open, original_prepare_shard = askme.SHARD_POOLS_OPEN, askme.prepare_shard
+            prepared = []
+            askme.SHARD_POOLS_OPEN = 1
+            askme.prepare_shard = lambda catalog, project_id: (prepared.append(project_id)
+                                                               or original_prepare_shard(catalog, project_id))
+            try:
+                askme.wait_for_summaries()
+                poll = askme.poll_every_shard(0)
+                page = client.get('/admin').get_data(as_text=True)
+                assert 'Pending: 3' in page and 'Completed: 2' in page
+                assert '<span class="badge bg-danger">4</span>' in page
+                client.post(f'/admin/inbox/{south + 3}/read')
+                # The catalog's write lock is not taken until the summaries are written
+                assert askme.summary_worker.is_alive()
+                assert '<span class="badge bg-danger">4</span>' in client.get('/admin').get_data(as_text=True)
+                askme.wait_for_summaries()
+                assert '<span class="badge bg-danger">3</span>' in client.get('/admin').get_data(as_text=True)
+                # The timer only reads the shards whose summary shows messages past their cursor
+                assert poll(False) == []
+                client.post(f'/request/{south + 4}/message', data={'message': 'Any news?'})
+                askme.wait_for_summaries()
+                assert [message['message'] for message in poll(False)] == ['Any news?']
+                assert prepared == []
+            finally:
+                askme.SHARD_POOLS_OPEN, askme.prepare_shard = original_pools_open, original_prepare_shard
+            
+            # Statements run on the fan-out threads count in the request's stats
+            with app.test_request_context():
+                askme.g.request_stats = stats = askme.RequestStats()
+                results = askme.map_shards(lambda conn, project_ids: conn.execute('SELECT 1').fetchall())
+                # One per shard, and one on the catalog to list the projects
+                assert len(results) == 2 and stats.sql_statements == 3
+            
+            # A new project gets a shard of its own, with ids from its range
+            client.post('/admin/project/create', data={'name': 'East', 'description': ''})
+            client.post('/project/3/request', data={'title': 'East first', 'description': ''})
+            assert 'East first' in client.get('/admin?project=3').get_data(as_text=True)
+            conn = askme.connect_db(askme.shard_path(3))
+            assert conn.execute('SELECT id FROM requests').fetchone()[0] == (3 << askme.SHARD_ID_BITS) + 1
+            conn.close()
+            
+            # Deleting a project removes its shard
+            client.post('/admin/project/1/delete')
+            askme.deletion_worker.join()
+            assert not os.path.exists(askme.shard_path(1))
+            job = client.get('/admin/deletions').get_json()['jobs'][0]
+            assert (job['requests_deleted'], job['messages_deleted'], job['finished_at'] is not None) == (2, 3, True)
+            assert client.get(f'/request/{north + 1}/messages').status_code == 404
+            records = [json.loads(line) for line in client.get('/admin/export').get_data().splitlines()]
+            assert [record['type'] for record in records].count('request') == 4
+    finally:
+        askme.SHARDS_ENABLED = False
+        remove_temp_database(original_database)
+
 if __name__ == '__main__':
     test_app()
+    test_admin_dashboard_pagination()
+    test_route_queries_use_indexes()
+    test_request_scoped_pooled_connection()
+    test_preferences_cache()
+    test_incremental_messages_and_events()
+    test_full_text_search()
+    test_request_tags_and_facets()
+    test_group_commit_writer()
+    test_create_app_configuration()
+    test_conditional_get_and_page_cache()
+    test_request_fragments()
+    test_metrics_endpoint_and_slow_request_log()
+    test_bulk_request_operations()
+    test_background_project_deletion()
+    test_dataset_export_import()
+    test_archive_resolved_requests()
+    test_activity_counters_and_inbox()
+    test_rate_limits_and_duplicate_submissions()
+    test_static_assets()
+    test_streamed_and_compressed_pages()
+    test_sharded_storage()